@@ -0,0 +1,92 @@
+"""
+Compare the streaming HTML text extractor with the full BeautifulSoup parse it
+replaced, on a corpus of saved messages.
+
+    python benchmarks/bench_html_text.py [CORPUS_DIRECTORY]
+
+The corpus directory holds .html files, or .eml files whose text/html parts are
+used. Without one, a synthetic corpus of marketing style emails is used.
+"""
+
+import email
+import time
+import tracemalloc
+from pathlib import Path
+
+import click
+from bs4 import BeautifulSoup
+
+from imessage_email_alert import iMessageEmailAlert
+from imessage_email_alert.html_text import html_to_text
+
+
+def load_corpus(directory: Path) -> list:
+    corpus = []
+    for file in sorted(directory.iterdir()):
+        if file.suffix == ".html":
+            corpus.append(file.read_text(errors="replace"))
+        elif file.suffix == ".eml":
+            message = email.message_from_bytes(file.read_bytes())
+            for part in message.walk():
+                if part.get_content_type() == "text/html":
+                    corpus.append(part.get_content())
+    return corpus
+
+
+def synthetic_corpus(count: int = 20) -> list:
+    """
+    Emails of about 250 KB, mostly nested tables and inline styles
+    """
+    row = (
+        '<tr><td style="padding:0;font-family:Arial,sans-serif;color:#333">'
+        '<table role="presentation" width="100%"><tr>'
+        '<td><a href="https://example.com/track?id=123&amp;utm_source=email">'
+        "Today's deal on something you looked at</a></td>"
+        '<td><img src="https://example.com/pixel.gif" width="1" height="1"></td>'
+        "</tr></table></td></tr>"
+    )
+    html = (
+        "<!DOCTYPE html><html><head><style>"
+        + "td { padding: 0; } " * 500
+        + "</style><script>var tracking = {};</script></head><body><table>"
+        + row * 900
+        + "</table></body></html>"
+    )
+    return [html] * count
+
+
+def measure(function, corpus: list) -> (float, int):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for html in corpus:
+        function(html)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+@click.command()
+@click.argument("corpus_dir", required=False, type=click.Path(exists=True))
+@click.option("--limit", default=iMessageEmailAlert.message_length * 4)
+def main(corpus_dir, limit):
+    corpus = load_corpus(Path(corpus_dir)) if corpus_dir else synthetic_corpus()
+    total_bytes = sum(len(html.encode("utf-8")) for html in corpus)
+    print(f"{len(corpus)} messages, {total_bytes / 1024:.0f} KB of HTML")
+
+    def beautiful_soup(html):
+        return BeautifulSoup(html, "html.parser").get_text()[:limit]
+
+    def streaming(html):
+        return html_to_text(html, limit=limit)
+
+    for name, function in [("BeautifulSoup", beautiful_soup), ("streaming", streaming)]:
+        elapsed, peak = measure(function, corpus)
+        print(
+            f"{name:>14}: {elapsed / len(corpus) * 1000:8.2f} ms/message, "
+            f"peak memory {peak / 1024:8.0f} KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Measure how long each entry point takes to start in a fresh interpreter, and
+check that none of them import the google client libraries, HTML parsers or
+asyncio before they are needed.
+
+    python benchmarks/bench_import_time.py --runs 10 --max-ms 300
+
+Exits with 1 if an entry point is slower than --max-ms, or imports a module it
+shouldn't, so it can guard the cold start in CI.
+"""
+
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+# Modules that only the gmail and async paths need
+HEAVY_MODULES = (
+    "googleapiclient",
+    "google.auth",
+    "google_auth_oauthlib",
+    "httplib2",
+    "bs4",
+    "asyncio",
+    "http.server",
+)
+
+
+def entry_points(directory: Path) -> dict:
+    """
+    The command line of each entry point, and whether it may import the heavy
+    modules
+    """
+    messages = directory / "messages"
+    messages.mkdir(exist_ok=True)
+    return {
+        "import": (["-c", "import imessage_email_alert"], False),
+        "--help": (["-m", "imessage_email_alert", "--help"], False),
+        "bad argument": (["-m", "imessage_email_alert", "--drain-size", "x"], False),
+        "--test-messages": (
+            [
+                "-m",
+                "imessage_email_alert",
+                "--test-messages",
+                str(messages),
+                "--log-dir",
+                str(directory),
+                # Only checked to exist
+                "--credentials-file",
+                str(directory),
+                "--token-file",
+                str(directory),
+                "+15555550100",
+            ],
+            False,
+        ),
+        "stub sender --help": (
+            ["-m", "imessage_email_alert.stub_sender", "--help"],
+            False,
+        ),
+        "gmail client": (["-c", "import imessage_email_alert.get_email_message"], True),
+    }
+
+
+def run_once(arguments: list) -> float:
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + arguments,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - started
+
+
+def imported_modules(arguments: list) -> set:
+    """
+    The modules the entry point imports, from python -X importtime
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + arguments,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            modules.add(line.rsplit("|", 1)[1].strip())
+    return modules
+
+
+@click.command()
+@click.option("--runs", default=5, help="Fresh interpreters to start per entry point")
+@click.option("--max-ms", type=float, help="Fail if an entry point takes longer")
+def main(runs, max_ms):
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (arguments, heavy_allowed) in entry_points(Path(directory)).items():
+            seconds = [run_once(arguments) for _ in range(runs)]
+            median = statistics.median(seconds) * 1000
+            heavy = sorted(
+                module
+                for module in imported_modules(arguments)
+                if module in HEAVY_MODULES
+            )
+            print(
+                f"{name:>20}: median {median:7.1f}ms, min {min(seconds) * 1000:7.1f}ms"
+                f"{', imports ' + ', '.join(heavy) if heavy else ''}"
+            )
+            if heavy_allowed:
+                continue
+            if heavy or (max_ms is not None and median > max_ms):
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Measure the throughput, in MB/s of email body, of the single pass text normalizer
+against the multi-pass version it replaced, on large bodies with many URLs.
+
+    python benchmarks/bench_normalize_text.py
+"""
+
+import re
+import time
+
+import click
+
+from imessage_email_alert import iMessageEmailAlert
+from imessage_email_alert.normalize_text import normalize_text
+
+http_match = re.compile(r"(.*)(http[s]*://[^?]*)\?[\S]*(.*)$")
+
+
+def legacy_normalize_text(text: str, limit: int) -> str:
+    """
+    The normalizing _process_message used to do
+    """
+    text = text.replace("\r\n", "\n")
+    for unicode_char in ["\u200c", "&#847;", "&zwnj;", "&nbsp;"]:
+        text = text.replace(unicode_char, "")
+    new_text = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if line != "":
+            match_result = http_match.match(line)
+            if match_result is not None:
+                line = "".join(group for group in match_result.groups() if group)
+            new_text.append(line)
+    text = "\n\n".join(new_text)
+    if len(text) > limit:
+        text = f"{text[:limit]}\n\n........"
+    return text
+
+
+def make_body(size: int) -> str:
+    line = (
+        "Shop now&nbsp;at https://shop.example.com/deal?utm_source=email"
+        "&utm_campaign=spring&id=1234567890 or view https://example.com/view?u=abc"
+        "&zwnj;\r\n\r\n   \r\n"
+    )
+    return line * (size // len(line))
+
+
+def throughput(function, body: str, limit: int, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(body, limit)
+    elapsed = time.perf_counter() - start
+    return len(body.encode("utf-8")) * repeat / elapsed / 1024 / 1024
+
+
+@click.command()
+@click.option("--size", default=1024 * 1024, help="Size of the body in bytes")
+@click.option("--repeat", default=5)
+def main(size, repeat):
+    body = make_body(size)
+    for limit in [iMessageEmailAlert.message_length, None]:
+        name = "no limit" if limit is None else f"limit {limit}"
+        legacy = throughput(
+            legacy_normalize_text, body, limit or len(body), max(1, repeat // 5)
+        )
+        single_pass = throughput(normalize_text, body, limit, repeat)
+        print(
+            f"{name:>10}: legacy {legacy:10.1f} MB/s, single pass "
+            f"{single_pass:10.1f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Run the whole iMessageEmailAlert loop against a local FakeGmail and a stub
+sender, and measure the throughput and the time from a message arriving in the
+mailbox to its alert being sent.
+
+    python benchmarks/bench_process_messages.py --messages 500 --drain 50
+
+Messages arrive at --arrival-rate per second, or all at once with 0. Gmail
+round trips take --gmail-latency seconds and --gmail-error-rate of them fail,
+sends take --send-latency seconds. --corpus replays messages saved with
+--save-messages instead of synthetic ones. --instances runs several alerts
+sharing the mailbox with label leases, like separate daemons would. --push
+polls when FakeGmail publishes a change to a local stand-in for Pub/Sub,
+instead of on the --poll-interval and --idle-interval schedule.
+
+    python benchmarks/bench_process_messages.py --messages 20 --arrival-rate 0.5 \
+        --poll-interval 2 --idle-interval 30 --push
+"""
+
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import click
+from google.oauth2.credentials import Credentials
+
+from imessage_email_alert import AsyncPipeline, iMessageEmailAlert
+from imessage_email_alert.archive import load_saved_messages
+from imessage_email_alert.fake_gmail import FakeGmail
+from imessage_email_alert.get_email_message import EmailMessage, GetEmailMessage
+from imessage_email_alert.push import LocalSubscriber
+from imessage_email_alert.stub_sender import StubImessage
+
+TAG = re.compile(r"\[bench (\d+)\]")
+
+
+def synthetic_corpus(count: int, seed: int) -> list:
+    """
+    Plain text and HTML messages of a few hundred bytes to a few hundred KB
+    """
+    generator = random.Random(seed)
+    paragraph = (
+        "Your order has shipped and is on its way. Track it at "
+        "https://example.com/track?id=123&utm_source=email&utm_medium=alert\n\n"
+    )
+    messages = []
+    for i in range(count):
+        body = paragraph * generator.choice([1, 5, 50, 500])
+        if generator.random() < 0.5:
+            body = (
+                "<html><body><p>"
+                + body.replace("\n\n", "</p><p>")
+                + "</p></body></html>"
+            )
+        messages.append(
+            EmailMessage(
+                from_email="shop@example.com",
+                to_email="me@example.com",
+                subject=f"Order {i}",
+                body=body,
+            )
+        )
+    return messages
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+@click.command()
+@click.option("--messages", "count", default=200, help="Messages to deliver")
+@click.option(
+    "--arrival-rate", default=0.0, help="Messages per second, 0 for all at once"
+)
+@click.option("--gmail-latency", default=0.02, help="Seconds per gmail round trip")
+@click.option(
+    "--gmail-error-rate", default=0.0, help="Fraction of gmail requests that fail"
+)
+@click.option("--send-latency", default=0.05, help="Seconds per send")
+@click.option("--engine", type=click.Choice(["sync", "async"]), default="sync")
+@click.option("--drain", "drain_size", type=int, help="Messages per poll")
+@click.option("--incremental-sync/--full-sync", default=False)
+@click.option("--lazy-body/--full-body", default=False)
+@click.option("--digest-window", type=float, help="Coalesce alerts into digests")
+@click.option(
+    "--instances", default=1, help="Alerts sharing the mailbox with label leases"
+)
+@click.option("--poll-interval", default=0.05, help="Seconds between busy polls")
+@click.option("--idle-interval", default=0.5, help="Longest time between polls")
+@click.option("--push/--poll", default=False, help="Poll on notifications of new mail")
+@click.option("--corpus", type=click.Path(exists=True, file_okay=False))
+@click.option("--seed", default=1)
+@click.option("--timeout", default=600.0, help="Give up after this many seconds")
+def main(
+    count,
+    arrival_rate,
+    gmail_latency,
+    gmail_error_rate,
+    send_latency,
+    engine,
+    drain_size,
+    incremental_sync,
+    lazy_body,
+    digest_window,
+    instances,
+    poll_interval,
+    idle_interval,
+    push,
+    corpus,
+    seed,
+    timeout,
+):
+    templates = (
+        list(load_saved_messages(Path(corpus)))
+        if corpus
+        else synthetic_corpus(100, seed)
+    )
+    gmail = FakeGmail(latency=gmail_latency, error_rate=gmail_error_rate, seed=seed)
+    sender = StubImessage(latency=send_latency)
+
+    if instances > 1 and engine == "async":
+        raise click.UsageError("--instances only works with the sync engine")
+
+    runs = []
+    stops = []
+    for instance in range(instances):
+        subscriber = None
+        if push:
+            subscriber = LocalSubscriber()
+            gmail.add_topic(f"projects/bench/topics/{instance}", subscriber)
+        alert = iMessageEmailAlert(
+            "+15555550100",
+            log_dir=Path(tempfile.mkdtemp()),
+            incremental_sync=incremental_sync,
+            drain_size=drain_size,
+            poll_interval=poll_interval,
+            idle_interval=idle_interval,
+            lazy_body=lazy_body,
+            digest_window=digest_window,
+            sender=sender,
+            worker_id=f"bench-{instance}" if instances > 1 else None,
+            subscriber=subscriber,
+            watch_topic=f"projects/bench/topics/{instance}",
+            safety_interval=idle_interval,
+        )
+        alert.gmail = GetEmailMessage(
+            credentials=Credentials(token="fake-token"),
+            transport_factory=gmail.http,
+            incremental=incremental_sync,
+            lazy_body=lazy_body,
+            body_limit=alert.message_length * 4,
+        )
+        # Back off for less time after the injected errors than after real ones
+        alert.scheduler.base_backoff = 0.05
+        alert.scheduler.max_backoff = 1
+
+        if engine == "async":
+            runner = AsyncPipeline(alert, batch_size=drain_size or 10)
+            runs.append(runner.run)
+            stops.append(runner.stop)
+        else:
+            runs.append(alert.process_messages)
+            stops.append(alert.stop)
+    loops = [threading.Thread(target=run, daemon=True) for run in runs]
+
+    arrived = {}
+
+    def feed():
+        start = time.monotonic()
+        for i in range(count):
+            if arrival_rate:
+                delay = start + i / arrival_rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            template = templates[i % len(templates)]
+            arrived[i] = time.monotonic()
+            gmail.add_email_message(
+                EmailMessage(
+                    from_email=template.from_email,
+                    to_email=template.to_email,
+                    subject=f"{template.subject} [bench {i}]",
+                    body=template.body,
+                )
+            )
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    started = time.monotonic()
+    feeder.start()
+    for loop in loops:
+        loop.start()
+
+    delivered = {}
+    duplicates = 0
+    checked = 0
+    deadline = started + timeout
+    while len(delivered) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+        sent = sender.sent[checked:]
+        checked += len(sent)
+        for sent_at, text in sent:
+            # A digest has the tags of all its messages
+            for match in TAG.finditer(text):
+                duplicates += int(match.group(1)) in delivered
+                delivered.setdefault(int(match.group(1)), sent_at)
+    for stop in stops:
+        stop()
+    for loop in loops:
+        loop.join(timeout=30)
+
+    elapsed = max(delivered.values(), default=started) - started
+    latencies = [delivered[i] - arrived[i] for i in delivered]
+    print(f"{len(delivered)} of {count} messages delivered in {elapsed:.2f}s")
+    if latencies:
+        print(f"  throughput: {len(delivered) / elapsed:8.1f} messages/s")
+        print(
+            f"  ingestion to send latency: mean {statistics.mean(latencies):.3f}s, "
+            f"p50 {percentile(latencies, 50):.3f}s, "
+            f"p99 {percentile(latencies, 99):.3f}s, "
+            f"max {max(latencies):.3f}s"
+        )
+    print(f"  sends: {len(sender.sent)}, duplicates: {duplicates}")
+    print(f"  gmail requests: {dict(gmail.calls)}")
+
+
+if __name__ == "__main__":
+    main()
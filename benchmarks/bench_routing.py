@@ -0,0 +1,99 @@
+"""
+Measure how many messages per second the routing rules decide, with the
+Aho-Corasick matchers of RuleSet against checking every rule in turn, as the
+number of rules grows.
+
+    python benchmarks/bench_routing.py --rules 1000 --rules 5000
+"""
+
+import random
+import time
+
+import click
+
+from imessage_email_alert.get_email_message import EmailMessage
+from imessage_email_alert.routing import Rule, RuleSet
+
+
+def linear_route(rules: list, message: EmailMessage):
+    """
+    Check every rule against the message, keeping the best one
+    """
+    headers = {
+        "senders": message.from_email.lower(),
+        "subjects": message.subject.lower(),
+        "keywords": message.body[: RuleSet.BODY_SCAN_LIMIT].lower(),
+    }
+    best = None
+    for rule in rules:
+        if all(
+            any(pattern.lower() in headers[header] for pattern in getattr(rule, header))
+            for header in headers
+            if getattr(rule, header)
+        ):
+            if best is None or rule.priority > best.priority:
+                best = rule
+    return best
+
+
+def make_rules(count: int, generator: random.Random) -> list:
+    rules = []
+    for number in range(count):
+        rule = Rule(f"rule {number}", priority=generator.randint(0, 10))
+        kind = generator.choice(["senders", "subjects", "keywords"])
+        if kind == "senders":
+            rule.senders = [f"alerts@shop{number}.example.com"]
+        else:
+            setattr(rule, kind, [f"order{number}", f"invoice{number}"])
+        rules.append(rule)
+    return rules
+
+
+def make_messages(count: int, rule_count: int, generator: random.Random) -> list:
+    paragraph = "Your order has shipped and is on its way. " * 20 + "\n\n"
+    return [
+        EmailMessage(
+            from_email=f"alerts@shop{generator.randrange(rule_count * 2)}.example.com",
+            to_email="me@example.com",
+            subject=f"Order{generator.randrange(rule_count * 2)} has shipped",
+            body=paragraph * generator.choice([1, 10, 100])
+            + f"invoice{generator.randrange(rule_count * 2)}",
+        )
+        for _ in range(count)
+    ]
+
+
+def rate(route, messages: list) -> float:
+    start = time.perf_counter()
+    for message in messages:
+        route(message)
+    return len(messages) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option(
+    "--rules", "rule_counts", multiple=True, type=int, default=[100, 1000, 5000]
+)
+@click.option("--messages", "count", default=200)
+@click.option("--seed", default=1)
+def main(rule_counts, count, seed):
+    generator = random.Random(seed)
+    for rule_count in rule_counts:
+        rules = make_rules(rule_count, generator)
+        messages = make_messages(count, rule_count, generator)
+
+        started = time.perf_counter()
+        rule_set = RuleSet(rules)
+        compile_seconds = time.perf_counter() - started
+
+        linear = rate(lambda message: linear_route(rules, message), messages)
+        compiled = rate(rule_set.route, messages)
+        print(
+            f"{rule_count:>6} rules: linear {linear:10.1f} messages/s, "
+            f"RuleSet {compiled:10.1f} messages/s "
+            f"(compiled in {compile_seconds * 1000:.0f}ms)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,64 @@
-# read version from installed package
-from importlib.metadata import version
-from .send_imessage import SendImessage
-from .get_email_message import EmailMessage, GetEmailMessage
+import importlib
 from .imessage_email_alert import iMessageEmailAlert
 import click
+import shlex
 from pathlib import Path
 
-__version__ = version("imessage_email_alert")
+# The rest of the package is imported when it is first used, so the command line
+# doesn't wait for the google client libraries or asyncio before it can even
+# parse its arguments
+_LAZY_IMPORTS = {
+    "PersistentSender": "send_imessage",
+    "SendImessage": "send_imessage",
+    "EmailMessage": "email_message",
+    "GetEmailMessage": "get_email_message",
+    "AsyncPipeline": "async_pipeline",
+    "MultiAccountAlert": "multi_account",
+    "load_accounts": "multi_account",
+    "RuleSet": "routing",
+    "AlertMetrics": "metrics",
+    "MetricsFileWriter": "metrics",
+    "MetricsServer": "metrics",
+}
+
+# The options that still apply with --config, the rest are set per account in the
+# config file
+_CONFIG_OPTIONS = {
+    "buddy",
+    "config_file",
+    "log_dir",
+    "debug",
+    "log_format",
+    "urgent_slo",
+    "persistent_sender",
+    "sender_command",
+    "send_timeout",
+    "send_rate",
+    "send_burst",
+    "metrics_port",
+    "metrics_file",
+    "metrics_interval",
+}
+
+
+def __getattr__(name: str):
+    if name == "__version__":
+        # read version from installed package
+        from importlib.metadata import version
+
+        value = version("imessage_email_alert")
+    elif name in _LAZY_IMPORTS:
+        module = importlib.import_module(f".{_LAZY_IMPORTS[name]}", __name__)
+        value = getattr(module, name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_LAZY_IMPORTS) | {"__version__"})
+
 
 """
 Send an iMessage alert every time a message comes in to gmail.
@@ -22,20 +74,28 @@ config_directory: Path = Path.home() / ".config" / "imessage_email_alert"
 
 
 @click.command()
-@click.argument("buddy")
+@click.argument("buddy", required=False)
+@click.option(
+    "--config",
+    "config_file",
+    required=False,
+    type=click.Path(exists=True, dir_okay=False),
+    help="TOML file of several gmail accounts and their recipients, "
+    "instead of BUDDY and one account",
+)
 @click.option(
     "--credentials-file",
     required=False,
     type=click.Path(exists=True),
-    default=config_directory / ".credentials.json",
-    help="The location of the credentials file",
+    help="The location of the credentials file "
+    "[default: ~/.config/imessage_email_alert/.credentials.json]",
 )
 @click.option(
     "--token-file",
     required=False,
     type=click.Path(exists=True),
-    default=config_directory / ".token.json",
-    help="The location to save the token file file",
+    help="The location to save the token file file "
+    "[default: ~/.config/imessage_email_alert/.token.json]",
 )
 @click.option(
     "--log-dir",
@@ -46,13 +106,19 @@ config_directory: Path = Path.home() / ".config" / "imessage_email_alert"
 @click.option(
     "--debug/--no-debug", default=False, help="Enable debugging to the console"
 )
+@click.option(
+    "--log-format",
+    type=click.Choice(["json", "text"]),
+    default="json",
+    help="Write the log file as JSON lines or as text",
+)
 @click.option(
     "--save-messages",
     required=False,
     type=click.Path(
         exists=True,
     ),
-    help="Directory to save original email messages to",
+    help="Directory of the archive to save original email messages to",
 )
 @click.option(
     "--test-messages",
@@ -60,14 +126,305 @@ config_directory: Path = Path.home() / ".config" / "imessage_email_alert"
     type=click.Path(exists=True),
     help="Directory containing previously saved messages to test",
 )
+@click.option(
+    "--test-since",
+    required=False,
+    type=click.DateTime(),
+    help="Only test the archived messages saved at this time or later",
+)
+@click.option(
+    "--test-until",
+    required=False,
+    type=click.DateTime(),
+    help="Only test the archived messages saved before this time",
+)
+@click.option(
+    "--compress-saved/--no-compress-saved",
+    default=True,
+    help="Compress the messages saved with --save-messages",
+)
+@click.option(
+    "--dry-run/--no-dry-run",
+    default=True,
+    help="Don't send the --test-messages, only time rendering them",
+)
+@click.option(
+    "--replay-processes",
+    required=False,
+    type=click.IntRange(min=1),
+    help="Processes to render the --test-messages on, one per CPU by default",
+)
+@click.option(
+    "--incremental-sync/--full-sync",
+    default=False,
+    help="Only ask gmail for the messages added since the last poll",
+)
+@click.option(
+    "--drain",
+    "drain_size",
+    required=False,
+    type=click.IntRange(min=1),
+    help="Handle up to this many messages per poll, in batches",
+)
+@click.option(
+    "--lazy-body/--full-body",
+    default=False,
+    help="Get the message structure first, then only the body part that is used",
+)
+@click.option(
+    "--poll-interval",
+    default=2,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Seconds between polls while mail is coming in",
+)
+@click.option(
+    "--idle-interval",
+    default=30,
+    type=click.FloatRange(min=0, min_open=True),
+    help="The longest time between polls while there is no mail",
+)
+@click.option(
+    "--outbox",
+    required=False,
+    type=click.Path(dir_okay=False),
+    help="SQLite file recording which messages were sent, so none are sent twice",
+)
+@click.option(
+    "--digest-window",
+    required=False,
+    type=click.FloatRange(min=0),
+    help="Send the emails that come in within this many seconds of each other "
+    "as one digest iMessage (sync engine only)",
+)
+@click.option(
+    "--digest-count",
+    default=20,
+    type=click.IntRange(min=1),
+    help="Send the digest as soon as this many emails are waiting",
+)
+@click.option(
+    "--digest-length",
+    default=2000,
+    type=click.IntRange(min=100),
+    help="The longest digest iMessage, more emails go in another digest",
+)
+@click.option(
+    "--rules",
+    "rules_file",
+    required=False,
+    type=click.Path(exists=True, dir_okay=False),
+    help="TOML file of routing rules that pick the recipient and priority of each "
+    "email, or drop it",
+)
+@click.option(
+    "--urgent-priority",
+    required=False,
+    type=int,
+    help="Emails the --rules give at least this priority are urgent: sent right "
+    "away, ahead of other alerts and without waiting for a digest or the send rate",
+)
+@click.option(
+    "--urgent-slo",
+    default=60.0,
+    type=click.FloatRange(min=0),
+    help="Seconds an urgent alert should take to be sent, for the metrics",
+)
+@click.option(
+    "--worker-id",
+    required=False,
+    help="Share the mailbox with other instances, each with its own id, by "
+    "claiming messages with a lease label (sync engine only)",
+)
+@click.option(
+    "--lease-seconds",
+    default=300.0,
+    type=click.FloatRange(min=10),
+    help="How long a claim on a message lasts if its worker stops",
+)
+@click.option(
+    "--quota-units",
+    default=200.0,
+    type=click.FloatRange(min=0),
+    help="Gmail quota units per second to spend at most, a margin under the "
+    "250 gmail allows, waiting instead of being rate limited, 0 for no limit",
+)
+@click.option(
+    "--dedup-window",
+    required=False,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Send one alert for the copies of an email that come in within this "
+    "many seconds, deleting the others",
+)
+@click.option(
+    "--dedup-size",
+    default=10000,
+    type=click.IntRange(min=1),
+    help="The most emails to remember for --dedup-window",
+)
+@click.option(
+    "--dedup-file",
+    required=False,
+    type=click.Path(dir_okay=False),
+    help="SQLite file to remember the emails in across restarts",
+)
+@click.option(
+    "--watch-topic",
+    required=False,
+    help="Have gmail publish mailbox changes to this Pub/Sub topic, like "
+    "projects/PROJECT/topics/TOPIC, and poll as soon as one comes in "
+    "(sync engine only)",
+)
+@click.option(
+    "--subscription",
+    required=False,
+    help="The Pub/Sub subscription to --watch-topic to pull changes from, like "
+    "projects/PROJECT/subscriptions/SUBSCRIPTION",
+)
+@click.option(
+    "--safety-interval",
+    default=300.0,
+    type=click.FloatRange(min=1),
+    help="The longest time between polls with --watch-topic, in case a change "
+    "is missed",
+)
+@click.option(
+    "--persistent-sender/--one-shot-sender",
+    default=False,
+    help="Send through one long running osascript, instead of one per message",
+)
+@click.option(
+    "--sender-command",
+    required=False,
+    help="The command for the persistent sender helper, for example a stub for "
+    "testing (implies --persistent-sender)",
+)
+@click.option(
+    "--send-timeout",
+    default=30,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Seconds to wait for a message to be sent",
+)
+@click.option(
+    "--send-rate",
+    default=1,
+    type=click.FloatRange(min=0, min_open=True),
+    help="The average number of messages the persistent sender sends per second",
+)
+@click.option(
+    "--send-burst",
+    default=10,
+    type=click.IntRange(min=1),
+    help="The number of messages the persistent sender can send at once",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["sync", "async"]),
+    default="sync",
+    help="Process messages one at a time, or in concurrent pipeline stages",
+)
+@click.option(
+    "--stage-workers",
+    multiple=True,
+    metavar="STAGE=N",
+    help="Concurrent workers for a stage of the async engine "
+    "(fetch, render, send or delete), can be repeated",
+)
+@click.option(
+    "--queue-size",
+    default=10,
+    type=click.IntRange(min=1),
+    help="The size of the queue in front of each stage of the async engine",
+)
+@click.option(
+    "--metrics-port",
+    required=False,
+    type=click.IntRange(min=0, max=65535),
+    help="Serve Prometheus metrics on this port of localhost",
+)
+@click.option(
+    "--metrics-file",
+    required=False,
+    type=click.Path(dir_okay=False),
+    help="Write Prometheus metrics to this file every --metrics-interval seconds",
+)
+@click.option(
+    "--metrics-interval",
+    default=60.0,
+    type=click.FloatRange(min=1),
+    help="Seconds between writes of the --metrics-file",
+)
 def imessage_email_alert(
-    buddy, credentials_file, token_file, log_dir, debug, save_messages, test_messages
+    buddy,
+    config_file,
+    credentials_file,
+    token_file,
+    log_dir,
+    debug,
+    log_format,
+    save_messages,
+    test_messages,
+    test_since,
+    test_until,
+    compress_saved,
+    dry_run,
+    replay_processes,
+    incremental_sync,
+    drain_size,
+    lazy_body,
+    poll_interval,
+    idle_interval,
+    outbox,
+    digest_window,
+    digest_count,
+    digest_length,
+    rules_file,
+    urgent_priority,
+    urgent_slo,
+    worker_id,
+    lease_seconds,
+    quota_units,
+    dedup_window,
+    dedup_size,
+    dedup_file,
+    watch_topic,
+    subscription,
+    safety_interval,
+    persistent_sender,
+    sender_command,
+    send_timeout,
+    send_rate,
+    send_burst,
+    engine,
+    stage_workers,
+    queue_size,
+    metrics_port,
+    metrics_file,
+    metrics_interval,
 ):
     """Sends an iMessage alert to BUDDY (phone number or email) whenever you get an
     email"""
+    from .metrics import AlertMetrics, MetricsFileWriter, MetricsServer
+    from .send_imessage import PersistentSender, SendImessage
+
     if log_dir is not None:
         log_dir = Path(log_dir)
 
+    if (buddy is None) == (config_file is None):
+        print("Give either BUDDY or --config")
+        exit(1)
+
+    context = click.get_current_context()
+    if config_file is not None:
+        given = [
+            param.opts[0]
+            for param in context.command.params
+            if param.name not in _CONFIG_OPTIONS
+            and context.get_parameter_source(param.name)
+            is not click.core.ParameterSource.DEFAULT
+        ]
+        if given:
+            raise click.UsageError(f"{', '.join(given)} can't be used with --config")
+
     if save_messages is not None:
         save_messages = Path(save_messages)
         save_messages.mkdir(parents=True, exist_ok=True)
@@ -81,19 +438,172 @@ def imessage_email_alert(
             print(f"'{test_messages}' is not a directory")
             exit(1)
 
-    imessage = iMessageEmailAlert(
-        buddy,
-        credentials_file=credentials_file,
-        token_file=token_file,
-        log_dir=log_dir,
-        debug=debug,
-        save_messages=save_messages,
-        test_messages=test_messages,
-    )
-    if test_messages is not None:
-        imessage.test_messages()
-    else:
-        imessage.process_messages()
+    if engine == "async":
+        sync_only = {
+            "--digest-window": digest_window,
+            "--worker-id": worker_id,
+            "--watch-topic": watch_topic,
+        }
+        given = [name for name, value in sync_only.items() if value is not None]
+        if given:
+            print(f"{', '.join(given)} only work with the sync engine")
+            exit(1)
+
+    def make_sender(recipient: str):
+        if persistent_sender or sender_command is not None:
+            return PersistentSender(
+                recipient,
+                command=None if sender_command is None else shlex.split(sender_command),
+                timeout=send_timeout,
+                rate=send_rate,
+                burst=send_burst,
+            )
+        return SendImessage(recipient, timeout=send_timeout)
+
+    metrics = AlertMetrics(lane_slos={**AlertMetrics.LANE_SLOS, "urgent": urgent_slo})
+    exporters = []
+    if metrics_port is not None:
+        exporters.append(MetricsServer(metrics.registry, metrics_port).start())
+    if metrics_file is not None:
+        exporters.append(
+            MetricsFileWriter(
+                metrics.registry, Path(metrics_file), metrics_interval
+            ).start()
+        )
+
+    for exporter in exporters:
+        context.call_on_close(exporter.stop)
+
+    if config_file is not None:
+        from .multi_account import MultiAccountAlert, load_accounts
+
+        try:
+            accounts, config = load_accounts(Path(config_file))
+        except ValueError as error:
+            print(error)
+            exit(1)
+        multi_account = MultiAccountAlert(
+            accounts,
+            make_sender,
+            workers=config.get("workers", 4),
+            log_dir=log_dir,
+            debug=debug,
+            metrics=metrics,
+            json_logs=log_format == "json",
+        )
+        try:
+            multi_account.run()
+        finally:
+            for sender in multi_account.senders.values():
+                if isinstance(sender, PersistentSender):
+                    sender.close()
+        return
+
+    # The defaults are only checked here, as the accounts in a config file have
+    # their own
+    if credentials_file is None:
+        credentials_file = config_directory / ".credentials.json"
+    if token_file is None:
+        token_file = config_directory / ".token.json"
+    for path in (credentials_file, token_file):
+        if not Path(path).exists():
+            print(f"'{path}' does not exist")
+            exit(1)
+
+    sender = make_sender(buddy)
+    rules = None
+    if rules_file is not None:
+        from .routing import RuleSet
+
+        try:
+            rules = RuleSet.from_file(Path(rules_file))
+        except ValueError as error:
+            print(error)
+            exit(1)
+
+    subscriber = None
+    if (watch_topic is None) != (subscription is None):
+        print("Give both --watch-topic and --subscription, or neither")
+        exit(1)
+    if subscription is not None:
+        from .push import PubSubSubscriber
+
+        subscriber = PubSubSubscriber(subscription)
+
+    try:
+        imessage = iMessageEmailAlert(
+            buddy,
+            credentials_file=credentials_file,
+            token_file=token_file,
+            log_dir=log_dir,
+            debug=debug,
+            save_messages=save_messages,
+            test_messages=test_messages,
+            compress_saved=compress_saved,
+            incremental_sync=incremental_sync,
+            drain_size=drain_size,
+            outbox=None if outbox is None else Path(outbox),
+            poll_interval=poll_interval,
+            idle_interval=idle_interval,
+            lazy_body=lazy_body,
+            digest_window=digest_window,
+            digest_count=digest_count,
+            digest_length=digest_length,
+            sender=sender,
+            rules=rules,
+            make_sender=make_sender,
+            metrics=metrics,
+            json_logs=log_format == "json",
+            worker_id=worker_id,
+            lease_seconds=lease_seconds,
+            quota_units=quota_units,
+            dedup_window=dedup_window,
+            dedup_size=dedup_size,
+            dedup_file=None if dedup_file is None else Path(dedup_file),
+            subscriber=subscriber,
+            watch_topic=watch_topic,
+            safety_interval=safety_interval,
+            urgent_priority=urgent_priority,
+        )
+    except ValueError as error:
+        print(error)
+        exit(1)
+    try:
+        if test_messages is not None:
+            imessage.test_messages(
+                dry_run=dry_run,
+                processes=replay_processes,
+                since=test_since,
+                until=test_until,
+            )
+        elif engine == "async":
+            from .async_pipeline import AsyncPipeline
+
+            workers = {}
+            for stage_worker in stage_workers:
+                stage, _, count = stage_worker.partition("=")
+                if (
+                    stage not in AsyncPipeline.STAGES
+                    or not count.isdigit()
+                    or int(count) < 1
+                ):
+                    print(f"'{stage_worker}' is not a valid STAGE=N, with N >= 1")
+                    exit(1)
+                workers[stage] = int(count)
+
+            pipeline = AsyncPipeline(
+                imessage,
+                workers=workers,
+                queue_size=queue_size,
+                batch_size=drain_size or 10,
+            )
+            pipeline.run()
+        else:
+            imessage.process_messages()
+    finally:
+        for routed_sender in imessage._senders.values():
+            if isinstance(routed_sender, PersistentSender):
+                routed_sender.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+import bisect
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from dataclasses import asdict
+from pathlib import Path
+from typing import Iterator
+
+from .email_message import EmailMessage
+
+# Each record is its length, its flags and the CRC of the payload, then the
+# payload: the EmailMessage as JSON, compressed if the flag says so
+_RECORD_HEADER = struct.Struct("<IBI")
+_COMPRESSED = 1
+
+# Each index entry is the time the message was saved, the offset of its record in
+# the segment, and its message_id
+_INDEX_ENTRY = struct.Struct("<dQ32s")
+
+
+class ArchiveError(Exception):
+    """The archive is damaged"""
+
+
+class MessageArchive:
+    """
+    An append-only archive of saved email messages. Messages are appended as
+    length-prefixed records to segment files of up to segment_size bytes, and
+    every segment has an index of the time each message was saved, its
+    message_id and the offset of its record, so a time range can be found without
+    reading the messages before it. Records are read back through mmap.
+
+    A record that was only partly written when the program died is dropped the
+    next time the archive is opened for appending.
+    """
+
+    SEGMENT_SUFFIX = ".log"
+    INDEX_SUFFIX = ".idx"
+
+    def __init__(
+        self, directory: Path, compress: bool = True, segment_size: int = 64 << 20
+    ):
+        """
+        :param directory: Where the segments are kept, created if it doesn't exist
+        :param compress: Compress the messages that are appended
+        :param segment_size: Start a new segment once the current one is this big
+        """
+        self.directory = Path(directory)
+        self.compress = compress
+        self.segment_size = segment_size
+
+        self._lock = threading.Lock()
+        self._segment = None
+        self._index = None
+        self._last_timestamp = 0.0
+
+    @classmethod
+    def exists(cls, directory: Path) -> bool:
+        return any(Path(directory).glob(f"*{cls.INDEX_SUFFIX}"))
+
+    def segments(self) -> list:
+        """
+        The segment files, oldest first
+        """
+        return sorted(self.directory.glob(f"*{self.SEGMENT_SUFFIX}"))
+
+    def append(self, message: EmailMessage, timestamp: float = None):
+        """
+        Save the message, as saved at timestamp, now by default. The timestamps in
+        the archive never go backwards, so a time range can be found by bisecting.
+        """
+        payload = json.dumps(asdict(message)).encode("utf-8")
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload)
+            flags |= _COMPRESSED
+        record = _RECORD_HEADER.pack(len(payload), flags, zlib.crc32(payload)) + payload
+
+        with self._lock:
+            if self._segment is None or self._segment.tell() >= self.segment_size:
+                self._open_segment()
+            timestamp = max(
+                time.time() if timestamp is None else timestamp, self._last_timestamp
+            )
+            self._last_timestamp = timestamp
+
+            offset = self._segment.tell()
+            self._segment.write(record)
+            self._segment.flush()
+            # The index entry is written after the record, so an index entry
+            # always points at a whole record
+            self._index.write(
+                _INDEX_ENTRY.pack(
+                    timestamp, offset, message.message_id.encode("utf-8")[:32]
+                )
+            )
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            for file in (self._segment, self._index):
+                if file is not None:
+                    file.close()
+            self._segment = None
+            self._index = None
+
+    def _open_segment(self):
+        """
+        Open the last segment for appending, or start a new one if it is full
+        """
+        for file in (self._segment, self._index):
+            if file is not None:
+                file.close()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = self.segments()
+        if segments and segments[-1].stat().st_size < self.segment_size:
+            segment = segments[-1]
+        else:
+            segment = self.directory / f"{len(segments) + 1:08d}{self.SEGMENT_SUFFIX}"
+        index = segment.with_suffix(self.INDEX_SUFFIX)
+
+        entries = _read_index(index)
+        self._recover(segment, index, entries)
+        if entries:
+            self._last_timestamp = max(self._last_timestamp, entries[-1][0])
+
+        self._segment = open(segment, "ab")
+        self._index = open(index, "ab")
+
+    @staticmethod
+    def _recover(segment: Path, index: Path, entries: list):
+        """
+        Cut off a record or an index entry that was only partly written
+        """
+        if index.exists():
+            os.truncate(index, len(entries) * _INDEX_ENTRY.size)
+        if not segment.exists():
+            return
+        end = 0
+        if entries:
+            with open(segment, "rb") as file:
+                file.seek(entries[-1][1])
+                header = file.read(_RECORD_HEADER.size)
+            if len(header) == _RECORD_HEADER.size:
+                length, _, _ = _RECORD_HEADER.unpack(header)
+                end = entries[-1][1] + _RECORD_HEADER.size + length
+        if segment.stat().st_size > end:
+            os.truncate(segment, end)
+
+    def locate(self, start: float = None, end: float = None) -> Iterator[tuple]:
+        """
+        Find the messages saved from start up to end, oldest first, without
+        reading them. Yields (segment, offset, timestamp, message_id).
+        """
+        for segment in self.segments():
+            entries = _read_index(segment.with_suffix(self.INDEX_SUFFIX))
+            if not entries:
+                continue
+            if end is not None and entries[0][0] >= end:
+                break
+            if start is not None and entries[-1][0] < start:
+                continue
+
+            first = 0
+            if start is not None:
+                first = bisect.bisect_left(entries, start, key=lambda e: e[0])
+            for timestamp, offset, message_id in entries[first:]:
+                if end is not None and timestamp >= end:
+                    return
+                yield segment, offset, timestamp, message_id
+
+    def read(self, start: float = None, end: float = None) -> Iterator[tuple]:
+        """
+        The messages saved from start up to end, oldest first, as (timestamp,
+        EmailMessage)
+        """
+        reader = SegmentReader()
+        try:
+            for segment, offset, timestamp, _ in self.locate(start, end):
+                yield timestamp, reader.read(segment, offset)
+        finally:
+            reader.close()
+
+    def __iter__(self) -> Iterator[EmailMessage]:
+        for _, message in self.read():
+            yield message
+
+
+class SegmentReader:
+    """
+    Read records out of archive segments through mmap, keeping the segments that
+    were read mapped
+    """
+
+    def __init__(self):
+        self._maps: dict = {}
+
+    def read(self, segment: Path, offset: int) -> EmailMessage:
+        segment_map = self._maps.get(segment)
+        if segment_map is None or offset + _RECORD_HEADER.size > len(segment_map):
+            segment_map = self._map(segment)
+        length, flags, crc = _RECORD_HEADER.unpack_from(segment_map, offset)
+        start = offset + _RECORD_HEADER.size
+        if start + length > len(segment_map):
+            # The segment has grown since it was mapped
+            segment_map = self._map(segment)
+
+        payload = segment_map[start : start + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise ArchiveError(f"Damaged record at {segment}:{offset}")
+        if flags & _COMPRESSED:
+            payload = zlib.decompress(payload)
+        return EmailMessage(**json.loads(payload))
+
+    def close(self):
+        for segment in list(self._maps):
+            self._unmap(segment)
+
+    def _map(self, segment: Path) -> mmap.mmap:
+        self._unmap(segment)
+        with open(segment, "rb") as file:
+            segment_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[segment] = segment_map
+        return segment_map
+
+    def _unmap(self, segment: Path):
+        segment_map = self._maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+
+
+def _read_index(index: Path) -> list:
+    """
+    The whole entries of the index, as (timestamp, offset, message_id)
+    """
+    if not index.exists():
+        return []
+    data = index.read_bytes()
+    whole = len(data) - len(data) % _INDEX_ENTRY.size
+    return [
+        (timestamp, offset, message_id.rstrip(b"\0").decode("utf-8"))
+        for timestamp, offset, message_id in _INDEX_ENTRY.iter_unpack(data[:whole])
+    ]
+
+
+def load_saved_messages(directory: Path) -> Iterator[EmailMessage]:
+    """
+    The messages saved in the directory, whether it is a MessageArchive or holds
+    one pickle per message, like --save-messages used to save them
+    """
+    directory = Path(directory)
+    if MessageArchive.exists(directory):
+        yield from MessageArchive(directory)
+        return
+    for file in sorted(directory.iterdir()):
+        if file.is_file():
+            yield pickle.loads(file.read_bytes())
@@ -0,0 +1,354 @@
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from .email_message import EmailMessage
+from .imessage_email_alert import iMessageEmailAlert
+from .outbox import Outbox
+from .routing import Route
+from .send_imessage import send
+
+
+class AsyncPipeline:
+    """
+    Run the fetch, render, send and delete steps of iMessageEmailAlert as
+    separate stages connected by bounded queues, so a slow step only holds up the
+    messages behind it. The queues are ordered by the priority the routing rules
+    give each message, so urgent mail overtakes the mail already waiting. The
+    blocking gmail and osascript calls run in thread pools, and a full queue makes
+    the stage in front of it wait. Polling follows the PollScheduler of the
+    iMessageEmailAlert.
+    """
+
+    STAGES = ("fetch", "render", "send", "delete")
+
+    def __init__(
+        self,
+        alert: iMessageEmailAlert,
+        workers: dict = None,
+        queue_size: int = 10,
+        batch_size: int = 10,
+        report_interval: float = 60,
+    ):
+        """
+        :param alert: The iMessageEmailAlert whose gmail connection, sender and
+        rendering are used
+        :param workers: The number of concurrent workers for each stage, by stage
+        name. Stages that are left out get one worker.
+        :param queue_size: The size of the queue in front of each stage
+        :param batch_size: The number of message ids to list per poll
+        :param report_interval: Seconds between logging the queue depths
+        """
+        self.alert = alert
+        self.workers = {stage: 1 for stage in self.STAGES}
+        if workers:
+            unknown = set(workers) - set(self.STAGES)
+            if unknown:
+                raise ValueError(f"Unknown pipeline stages: {', '.join(unknown)}")
+            idle = [stage for stage, count in workers.items() if count < 1]
+            if idle:
+                raise ValueError(
+                    f"Pipeline stages need at least one worker: {', '.join(idle)}"
+                )
+            self.workers.update(workers)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+
+        self.queues: dict = {}
+        self._order = itertools.count()
+        self._in_flight: set = set()
+        self._released: Optional[asyncio.Event] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._gmail_executor: Optional[ThreadPoolExecutor] = None
+        self._send_executor: Optional[ThreadPoolExecutor] = None
+
+    def run(self):
+        """
+        Connect to gmail and run the pipeline until stop() is called
+        """
+        self.alert._connect_gmail()
+        self.alert._resume_outbox()
+        asyncio.run(self.run_async())
+
+    def stop(self):
+        """
+        Stop fetching new mail, finish the messages already in the pipeline, and
+        return from run(). Can be called from any thread.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    def queue_depths(self) -> dict:
+        """
+        The number of messages waiting in front of each stage
+        """
+        return {stage: queue.qsize() for stage, queue in self.queues.items()}
+
+    async def run_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._released = asyncio.Event()
+        self.queues = {
+            stage: asyncio.PriorityQueue(maxsize=self.queue_size)
+            for stage in self.STAGES[1:]
+        }
+
+        # Gmail and osascript get their own threads, so a hung send can't use up
+        # the threads that gmail needs, and the other way around
+        self._gmail_executor = ThreadPoolExecutor(
+            max_workers=self.workers["fetch"] + self.workers["delete"],
+            thread_name_prefix="gmail",
+        )
+        self._send_executor = ThreadPoolExecutor(
+            max_workers=self.workers["render"] + self.workers["send"],
+            thread_name_prefix="send",
+        )
+
+        stage_functions = {
+            "render": self._render,
+            "send": self._send,
+            "delete": self._delete,
+        }
+        workers = [
+            asyncio.create_task(self._worker(stage, stage_function))
+            for stage, stage_function in stage_functions.items()
+            for _ in range(self.workers[stage])
+        ]
+        fetchers = [
+            asyncio.create_task(self._fetch()) for _ in range(self.workers["fetch"])
+        ]
+        reporter = asyncio.create_task(self._report())
+
+        try:
+            await self._stop_event.wait()
+        finally:
+            # Let the messages that were already fetched go all the way through
+            for task in fetchers:
+                task.cancel()
+            await asyncio.gather(*fetchers, return_exceptions=True)
+            for stage in self.STAGES[1:]:
+                await self.queues[stage].join()
+            for task in workers + [reporter]:
+                task.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            self._gmail_executor.shutdown()
+            self._send_executor.shutdown()
+
+    async def _in_gmail_thread(self, function, *args):
+        return await self._loop.run_in_executor(self._gmail_executor, function, *args)
+
+    async def _in_send_thread(self, function, *args):
+        return await self._loop.run_in_executor(self._send_executor, function, *args)
+
+    def _timed(self, stage: str, function, *args):
+        """
+        Call the function, recording how long it took as the stage
+        """
+        with self.alert.metrics.stage(stage):
+            return function(*args)
+
+    async def _fetch(self):
+        """
+        Poll gmail for messages that are not already in the pipeline, and queue them
+        for rendering
+        """
+        scheduler = self.alert.scheduler
+        gmail_breaker = scheduler.breakers["gmail"]
+        sender_breaker = scheduler.breakers["sender"]
+        error_count = 0
+        while True:
+            if not gmail_breaker.allow() or not sender_breaker.allow():
+                await asyncio.sleep(scheduler.next_delay())
+                continue
+
+            try:
+                message_ids = await self._in_gmail_thread(
+                    self._timed,
+                    "list",
+                    self.alert.gmail.list_message_ids,
+                    self.batch_size,
+                )
+            except Exception as error:
+                error_count = self._fetch_error(error_count, error)
+                await asyncio.sleep(scheduler.next_delay())
+                continue
+            gmail_breaker.record_success()
+
+            new_ids = [i for i in message_ids if i not in self._in_flight]
+            self._in_flight.update(new_ids)
+            self.alert.metrics.count("listed", len(new_ids))
+            try:
+                already_sent = self.alert._already_sent(new_ids)
+            except Exception as error:
+                for message_id in new_ids:
+                    self._release(message_id)
+                error_count = self._fetch_error(error_count, error)
+                await asyncio.sleep(scheduler.next_delay())
+                continue
+            for message_id in new_ids:
+                if message_id in already_sent:
+                    # Sent before, but not deleted, so only delete it
+                    message = EmailMessage(message_id=message_id)
+                    await self._put("delete", 0, message)
+                    continue
+                try:
+                    message = await self._in_gmail_thread(
+                        self._timed, "get", self.alert.gmail.get_message, message_id
+                    )
+                except Exception as error:
+                    self.alert.metrics.count("fetch_failed")
+                    self._release(message_id)
+                    error_count = self.alert._get_error(error_count, error)
+                    continue
+
+                if message is None:
+                    self._release(message_id)
+                    continue
+                self.alert.metrics.count("fetched")
+                try:
+                    self.alert._outbox_mark([message_id], Outbox.FETCHED)
+                    self.alert._save_message(message)
+                    route = self.alert._route(message)
+                except Exception as error:
+                    self._release(message_id)
+                    error_count = self._fetch_error(error_count, error)
+                    continue
+                await self._put("render", route.priority, message, route)
+
+            more = len(message_ids) >= self.batch_size
+            scheduler.record_poll(len(new_ids), more=more and bool(new_ids))
+            if more and not new_ids:
+                # Everything listed is already in the pipeline, so wait for something
+                # to leave it before listing again
+                self._released.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._released.wait(), scheduler.next_delay()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(scheduler.next_delay())
+
+    def _fetch_error(self, error_count: int, error: Exception) -> int:
+        """
+        Count an error fetching mail against gmail, the way poll() does, and back
+        off. Returns the new error count.
+        """
+        self.alert.metrics.error("gmail")
+        self.alert.scheduler.breakers["gmail"].record_failure()
+        self.alert.scheduler.record_error()
+        return self.alert._get_error(error_count, error)
+
+    async def _put(self, stage: str, priority: int, *item):
+        """
+        Queue the item for the stage, ahead of the ones with a lower priority
+        """
+        await self.queues[stage].put((-priority, next(self._order), item))
+
+    def _release(self, message_id: str):
+        """
+        The message has left the pipeline, one way or another
+        """
+        self._in_flight.discard(message_id)
+        self._released.set()
+
+    async def _worker(self, stage: str, stage_function):
+        queue = self.queues[stage]
+        while True:
+            _, _, item = await queue.get()
+            try:
+                await stage_function(*item)
+            except Exception as error:
+                # Keep the worker alive, or nothing would drain the queue and stop()
+                # would wait on it forever
+                message = item[0]
+                self.alert.metrics.error(stage)
+                self._release(message.message_id)
+                self.alert.logger.error(
+                    f"An error occurred in the {stage} stage for message "
+                    f"{message.message_id}:{error}"
+                )
+            finally:
+                queue.task_done()
+
+    async def _render(self, message: EmailMessage, route: Route):
+        try:
+            if route.drop:
+                self.alert._outbox_mark([message.message_id], Outbox.SENT)
+                self.alert.metrics.count("dropped")
+                await self._put("delete", 0, message)
+                return
+            if self.alert._duplicate(message):
+                self.alert._outbox_mark([message.message_id], Outbox.SENT)
+                await self._put("delete", 0, message)
+                return
+            message_text = await self._in_send_thread(
+                self._timed, "render", self.alert._render_message, message
+            )
+        except Exception as error:
+            self._release(message.message_id)
+            self.alert.logger.error(
+                f"An error occurred trying to render message:{error}"
+            )
+            return
+        await self._put("send", route.priority, message, message_text, route)
+
+    async def _send(self, message: EmailMessage, message_text: str, route: Route):
+        sender = self.alert._sender_for(route.recipient)
+        lane = self.alert._lane(route)
+        try:
+            await self._in_send_thread(
+                self._timed, "send", send, sender, message_text, lane == "urgent"
+            )
+        except Exception as error:
+            # Leave it in the mailbox, it will be picked up again by the next poll
+            self.alert.metrics.error("send")
+            self.alert._not_sent([message])
+            self.alert.scheduler.breakers["sender"].record_failure()
+            self._release(message.message_id)
+            self.alert.logger.error(f"An error occurred trying to send message:{error}")
+            return
+        self.alert.scheduler.breakers["sender"].record_success()
+        self.alert._outbox_mark([message.message_id], Outbox.SENT)
+        self.alert.metrics.delivered([message], lane)
+        self.alert.logger.info(
+            f"Message sent to {message.to_email}: " f"{message.subject}"
+        )
+        await self._put("delete", 0, message)
+
+    async def _delete(self, message: EmailMessage):
+        try:
+            await self._in_gmail_thread(
+                self._timed,
+                "delete",
+                self.alert.gmail.delete_message,
+                message.message_id,
+            )
+            self.alert._outbox_mark([message.message_id], Outbox.DELETED)
+            self.alert.metrics.count("deleted")
+        except Exception as error:
+            self.alert.metrics.error("delete")
+            error_string = f"An error occurred trying to delete message:{error}"
+            self.alert.logger.error(error_string)
+            try:
+                await self._in_send_thread(
+                    self.alert.imessage.send_message, error_string
+                )
+            except Exception as send_error:
+                self.alert.logger.error(
+                    f"An error occurred trying to send the delete error:{send_error}"
+                )
+        finally:
+            self._release(message.message_id)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            depths = ", ".join(f"{k}={v}" for k, v in self.queue_depths().items())
+            self.alert.logger.info(
+                f"Pipeline queue depths: {depths}, in flight: {len(self._in_flight)}"
+            )
@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+
+class CredentialManager:
+    """
+    Keep the access token of the gmail credentials fresh. A background thread
+    refreshes it refresh_margin seconds before it expires, so requests don't
+    wait for a refresh, and a refresh that fails is retried every
+    retry_interval seconds while the old token still works. Threads that find
+    the token expired anyway share one refresh. The token file is replaced in
+    one step, and only when the credentials changed.
+    """
+
+    def __init__(
+        self,
+        credentials: Credentials,
+        token_file: Path = None,
+        refresh_margin: float = 10 * 60,
+        retry_interval: float = 30,
+        request_factory: Callable[[], object] = Request,
+    ):
+        """
+        :param credentials: The credentials to keep fresh. They are refreshed in
+        place, so everything using them sees the new token.
+        :param token_file: Where to save the credentials after a refresh
+        :param refresh_margin: Seconds before the token expires to refresh it.
+        Has to be more than the few minutes before expiry that google-auth
+        already treats the token as expired.
+        :param retry_interval: Seconds between attempts after a refresh failed,
+        and the shortest time between background refreshes
+        :param request_factory: Makes the transport the token endpoint is called
+        with
+        """
+        self.credentials = credentials
+        self.token_file = None if token_file is None else Path(token_file)
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.request_factory = request_factory
+        self.refreshes = 0
+        self.logger = logging.getLogger("iMessageEmailAlert.credentials")
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._saved: Optional[str] = None
+        if self.token_file is not None and self.token_file.exists():
+            self._saved = self.token_file.read_text()
+
+    def can_refresh(self) -> bool:
+        return bool(self.credentials.refresh_token)
+
+    def ensure_valid(self) -> Credentials:
+        """
+        The credentials, refreshed first if the token has expired, which only
+        happens if the background refresh failed or isn't running
+        """
+        if not self.credentials.valid and self.can_refresh():
+            self.refresh()
+        return self.credentials
+
+    def refresh(self):
+        """
+        Get a new access token. If another thread is already getting one, wait
+        for it and use that one instead.
+        """
+        token = self.credentials.token
+        with self._lock:
+            if self.credentials.token != token and self.credentials.valid:
+                return
+            self.credentials.refresh(self.request_factory())
+            self.refreshes += 1
+            self.save()
+
+    def save(self):
+        """
+        Write the credentials to the token file if they changed since it was
+        last written, so a reader never sees half a file
+        """
+        if self.token_file is None:
+            return
+        data = self.credentials.to_json()
+        if data == self._saved:
+            return
+        temporary = self.token_file.with_name(f".{self.token_file.name}.tmp")
+        # The token file holds the refresh token, so only the user can read it
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.token_file)
+        self._saved = data
+
+    def start(self) -> "CredentialManager":
+        """
+        Start refreshing in the background, if the credentials can be refreshed
+        """
+        if self._thread is None and self.can_refresh():
+            self._thread = threading.Thread(
+                target=self._run, name="credentials", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        delay = self._time_to_refresh()
+        while not self._stop_event.wait(delay):
+            try:
+                self.refresh()
+            except Exception as error:
+                self.logger.error(
+                    f"An error occurred refreshing the gmail token:{error}"
+                )
+                delay = self.retry_interval
+                continue
+            delay = self._time_to_refresh()
+
+    def _time_to_refresh(self) -> Optional[float]:
+        """
+        Seconds until the token should be refreshed, None if it never expires
+        """
+        expiry = self.credentials.expiry
+        if expiry is None:
+            return None
+        # google-auth keeps the expiry as a naive UTC time
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        remaining = (expiry - now).total_seconds()
+        return max(remaining - self.refresh_margin, self.retry_interval)
@@ -0,0 +1,151 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+from .email_message import EmailMessage
+from .normalize_text import normalize_text
+
+# What forwarding and replying put in front of a subject
+_SUBJECT_PREFIX = re.compile(r"^(\s*(re|fwd?|aw|wg)\s*:)+\s*", re.IGNORECASE)
+_ADDRESS = re.compile(r"<([^<>]+)>")
+_SPACE = re.compile(r"\s+")
+
+
+class DuplicateCache:
+    """
+    Remember the emails that were alerted about in the last window seconds, so
+    copies of the same email, from several forwarding rules or a sender's
+    retries, only get one alert. An email is known by a fingerprint of its
+    sender address, its subject without Re: and Fwd:, and the start of its body
+    as it is rendered. The cache keeps at most max_entries fingerprints, dropping
+    the least recently seen first, and can be kept in a SQLite file so it
+    survives a restart.
+    """
+
+    def __init__(
+        self,
+        window: float = 10 * 60,
+        max_entries: int = 10000,
+        path: Path = None,
+        body_prefix: int = 200,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param window: Seconds a copy of an email counts as a duplicate
+        :param max_entries: The most fingerprints to keep
+        :param path: The SQLite file to keep the fingerprints in, created if it
+        doesn't exist. Only in memory by default.
+        :param body_prefix: Characters of the rendered body that go in the
+        fingerprint
+        :param clock: Returns the time in seconds since the epoch
+        """
+        self.window = window
+        self.max_entries = max_entries
+        self.path = path
+        self.body_prefix = body_prefix
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+        # Fingerprint to when it was last seen, least recently seen first
+        self._seen: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        if path is not None:
+            self._open(path)
+
+    def fingerprint(self, message: EmailMessage) -> str:
+        sender = message.from_email or ""
+        match = _ADDRESS.search(sender)
+        if match is not None:
+            sender = match.group(1)
+        subject = _SUBJECT_PREFIX.sub("", message.subject or "")
+        body, _ = normalize_text(message.body or "", self.body_prefix)
+        key = "\0".join(
+            _SPACE.sub(" ", part).strip().lower() for part in (sender, subject, body)
+        )
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+    def check(self, message: EmailMessage) -> bool:
+        """
+        Whether a copy of the email was seen in the last window seconds. Either
+        way it is remembered as seen now, until discard is called.
+        """
+        fingerprint = self.fingerprint(message)
+        now = self.clock()
+        with self._lock:
+            seen = self._seen.get(fingerprint)
+            if seen is not None and now - seen < self.window:
+                self.hits += 1
+                self._remember(fingerprint, now)
+                return True
+            self.misses += 1
+            self._remember(fingerprint, now)
+            return False
+
+    def discard(self, message: EmailMessage):
+        """
+        Forget the email, because its alert could not be sent after all
+        """
+        fingerprint = self.fingerprint(message)
+        with self._lock:
+            if self._seen.pop(fingerprint, None) is not None and self._connection:
+                self._connection.execute(
+                    "DELETE FROM seen WHERE fingerprint = ?", (fingerprint,)
+                )
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _remember(self, fingerprint: str, now: float):
+        self._seen[fingerprint] = now
+        self._seen.move_to_end(fingerprint)
+        evicted = []
+        while len(self._seen) > self.max_entries:
+            evicted.append(self._seen.popitem(last=False)[0])
+        if self._connection is None:
+            return
+        self._connection.execute(
+            "INSERT OR REPLACE INTO seen (fingerprint, seen) VALUES (?, ?)",
+            (fingerprint, now),
+        )
+        if evicted:
+            self._connection.executemany(
+                "DELETE FROM seen WHERE fingerprint = ?", [(f,) for f in evicted]
+            )
+
+    def _open(self, path: Path):
+        """
+        Open the SQLite file, drop what ran out while we weren't running, and
+        load the rest
+        """
+        self._connection = sqlite3.connect(
+            str(path), isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            " fingerprint TEXT PRIMARY KEY,"
+            " seen REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._connection.execute(
+            "DELETE FROM seen WHERE seen <= ?", (self.clock() - self.window,)
+        )
+        rows = self._connection.execute(
+            "SELECT fingerprint, seen FROM seen ORDER BY seen DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for fingerprint, seen in reversed(rows):
+            self._seen[fingerprint] = seen
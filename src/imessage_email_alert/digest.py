@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from .email_message import EmailMessage
+from .normalize_text import normalize_text
+
+# Room left in each digest for the "N new emails (n of N)" header
+_HEADER_ROOM = 40
+
+
+class AlertCoalescer:
+    """
+    Hold on to the messages that come in close together, so a burst of email
+    turns into one digest iMessage instead of one iMessage per email. The messages
+    are due to be sent once window seconds have passed since the first one came
+    in, or as soon as max_count of them are waiting.
+    """
+
+    def __init__(
+        self,
+        window: float = 60,
+        max_count: int = 20,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param window: The longest time, in seconds, to hold on to a message
+        :param max_count: Send as soon as this many messages are waiting
+        :param clock: Returns the current time in seconds
+        """
+        self.window = window
+        self.max_count = max_count
+        self.clock = clock
+
+        self._pending: OrderedDict = OrderedDict()
+        self._first_at = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._pending
+
+    def add(self, message: EmailMessage):
+        if not self._pending:
+            self._first_at = self.clock()
+        self._pending[message.message_id] = message
+
+    def due(self) -> bool:
+        """
+        Whether the waiting messages should be sent now
+        """
+        if not self._pending:
+            return False
+        return len(self._pending) >= self.max_count or self.time_left() == 0
+
+    def time_left(self) -> float:
+        """
+        Seconds until the waiting messages are due, None if nothing is waiting
+        """
+        if not self._pending:
+            return None
+        return max(self._first_at + self.window - self.clock(), 0)
+
+    def take(self) -> list:
+        """
+        Return the waiting messages, oldest first, and start a new window
+        """
+        messages = list(self._pending.values())
+        self._pending.clear()
+        self._first_at = None
+        return messages
+
+
+def render_digests(
+    messages: list, digest_length: int, summary_length: int = 200
+) -> list:
+    """
+    Summarize the messages, the To, the Subject and the start of the body of each,
+    in as few digests of at most digest_length characters as they fit in. Returns
+    a list of (digest text, messages in the digest).
+    """
+    summaries = []
+    for message in messages:
+        body, truncated = normalize_text(message.body, summary_length)
+        if truncated or message.truncated:
+            body = f"{body}..."
+        summary = f"To: {message.to_email}\nSubject: {message.subject}"
+        if body:
+            summary = f"{summary}\n{body}"
+        summaries.append(summary)
+
+    # Split into digests that fit
+    groups = []
+    group = []
+    length = 0
+    for message, summary in zip(messages, summaries):
+        # A summary that doesn't fit in a digest by itself is cut short
+        summary = summary[: digest_length - _HEADER_ROOM]
+        if group and length + len(summary) + 2 > digest_length - _HEADER_ROOM:
+            groups.append(group)
+            group = []
+            length = 0
+        group.append((message, summary))
+        length += len(summary) + 2
+    if group:
+        groups.append(group)
+
+    digests = []
+    for number, group in enumerate(groups, start=1):
+        header = f"{len(group)} new emails"
+        if len(groups) > 1:
+            header = f"{header} ({number} of {len(groups)})"
+        text = "\n\n".join([header] + [summary for _, summary in group])
+        digests.append((text, [message for message, _ in group]))
+    return digests
@@ -0,0 +1,19 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class EmailMessage:
+    """Data class to represent an email message"""
+
+    from_email: str = field(default_factory=str)
+    to_email: str = field(default_factory=str)
+    subject: str = field(default_factory=str)
+    body: str = field(default_factory=str)
+    message_id: str = field(default_factory=str)
+    # When gmail received the message, in seconds since the epoch
+    received: Optional[float] = None
+    # The ids of the gmail labels the message had when it was retrieved
+    label_ids: Optional[list] = None
+    # Whether only the start of the body was retrieved
+    truncated: bool = False
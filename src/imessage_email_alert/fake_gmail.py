@@ -0,0 +1,715 @@
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from email.parser import Parser
+from http import HTTPStatus
+from pathlib import Path
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+
+from .archive import load_saved_messages
+from .email_message import EmailMessage
+from .quota import method_cost
+
+
+class FakeGmail:
+    """
+    A local, in-memory stand-in for the parts of the gmail API this package uses.
+    It speaks HTTP at the httplib2 level, so the real googleapiclient service
+    object can be pointed at it by passing fake_gmail.http as the transport
+    factory of GetEmailMessage.
+
+    For load testing, every HTTP round trip can be made to take latency seconds,
+    and a fraction error_rate of the requests can fail with a 503. Like gmail, it
+    can limit the quota units spent per second, failing the requests over the
+    limit with a 429. It is safe to use from several threads, and to add messages
+    while it is being polled.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        error_rate: float = 0,
+        seed: int = None,
+        quota_units: float = None,
+        retry_after: float = 1,
+    ):
+        """
+        :param latency: Seconds each HTTP round trip takes
+        :param error_rate: The fraction of requests that fail with a 503
+        :param seed: Seed for the random errors, so a run can be repeated
+        :param quota_units: The quota units that can be spent per second, no limit
+        by default
+        :param retry_after: The Retry-After of a request over the quota
+        """
+        self.messages: OrderedDict = OrderedDict()
+        self.attachments: dict = {}
+        self.calls: Counter = Counter()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.quota_units = quota_units
+        self.retry_after = retry_after
+        self._spent: deque = deque()
+        self._next_id = 1
+        self._fail_next: list = []
+        self.labels: dict = {
+            label_id: {"id": label_id, "name": label_id, "type": "system"}
+            for label_id in SYSTEM_LABELS
+        }
+        self._next_label_id = 1
+        # Pub/Sub topics by name, and the watch on the mailbox
+        self.topics: dict = {}
+        self.watch: Optional[dict] = None
+
+        # Every change to the mailbox gets a new historyId, history records older
+        # than _oldest_history_id have expired
+        self.history_id = 1000
+        self.history: list = []
+        self._oldest_history_id = self.history_id
+
+    def add_message(
+        self,
+        from_email: str = "sender@example.com",
+        to_email: str = "me@example.com",
+        subject: str = "Subject",
+        body: str = "Body",
+        mime_type: str = "text/plain",
+        payload: dict = None,
+        label_ids: list = None,
+    ) -> str:
+        """
+        Add a message to the mailbox and return its id. Messages are listed newest
+        first, like gmail does. The body is a single part of mime_type, unless a
+        payload built with mime_part is given. The message is in the INBOX, with
+        label_ids if they are given.
+        """
+        with self.lock:
+            return self._add_message(
+                from_email, to_email, subject, body, mime_type, payload, label_ids
+            )
+
+    def _add_message(
+        self,
+        from_email: str,
+        to_email: str,
+        subject: str,
+        body: str,
+        mime_type: str,
+        payload: Optional[dict],
+        label_ids: Optional[list] = None,
+    ) -> str:
+        message_id = f"{self._next_id:016x}"
+        self._next_id += 1
+
+        if payload is None:
+            payload = mime_part(mime_type, body)
+        payload = self._store_payload(message_id, payload, part_id="")
+        payload["headers"] = [
+            {"name": "From", "value": from_email},
+            {"name": "To", "value": to_email},
+            {"name": "Subject", "value": subject},
+        ] + payload.get("headers", [])
+
+        history_id = self._record_history("messagesAdded", message_id)
+        self.messages[message_id] = {
+            "id": message_id,
+            "threadId": message_id,
+            "labelIds": ["INBOX"] if label_ids is None else list(label_ids),
+            "historyId": str(history_id),
+            "internalDate": str(int(time.time() * 1000)),
+            "payload": payload,
+        }
+        self.messages.move_to_end(message_id, last=False)
+        self._notify(self.messages[message_id])
+        return message_id
+
+    def add_topic(self, name: str, subscriber):
+        """
+        Publish the notifications of a watch on the topic to the subscriber, a
+        LocalSubscriber
+        """
+        self.topics[name] = subscriber
+
+    def _notify(self, message: dict):
+        if self.watch is None or self.watch["topicName"] not in self.topics:
+            return
+        label_ids = self.watch.get("labelIds")
+        if label_ids and not set(label_ids) & set(message["labelIds"]):
+            return
+        self.topics[self.watch["topicName"]].publish(
+            {"emailAddress": "me@example.com", "historyId": self.history_id}
+        )
+
+    def add_email_message(self, message: EmailMessage) -> str:
+        """
+        Add a copy of an EmailMessage, like the ones saved with --save-messages,
+        and return its new id. HTML bodies are sent as text/html.
+        """
+        is_html = "<html" in message.body[:1000].lower()
+        return self.add_message(
+            from_email=message.from_email,
+            to_email=message.to_email,
+            subject=message.subject,
+            body=message.body,
+            mime_type="text/html" if is_html else "text/plain",
+        )
+
+    def add_saved_messages(self, directory: Path) -> list:
+        """
+        Add every EmailMessage saved in the directory with --save-messages,
+        returning their ids
+        """
+        return [
+            self.add_email_message(message)
+            for message in load_saved_messages(directory)
+        ]
+
+    def _store_payload(self, message_id: str, part: dict, part_id: str) -> dict:
+        """
+        Number the parts like gmail does, and keep attachments apart from the
+        message
+        """
+        part = dict(part, partId=part_id)
+        if part.pop("attachment", False):
+            attachment_id = f"{message_id}-{part_id or '0'}"
+            self.attachments[attachment_id] = part["body"]
+            part["body"] = {
+                "size": part["body"]["size"],
+                "attachmentId": attachment_id,
+            }
+        if "parts" in part:
+            prefix = f"{part_id}." if part_id else ""
+            part["parts"] = [
+                self._store_payload(message_id, sub_part, f"{prefix}{i}")
+                for i, sub_part in enumerate(part["parts"])
+            ]
+        return part
+
+    def expire_history(self):
+        """
+        Forget all history, like gmail does after a while, so a sync from an old
+        historyId fails with a 404
+        """
+        self.history.clear()
+        self._oldest_history_id = self.history_id
+
+    def _record_history(self, history_type: str, message_id: str) -> int:
+        self.history_id += 1
+        self.history.append(
+            {
+                "id": str(self.history_id),
+                history_type: [{"message": {"id": message_id, "threadId": message_id}}],
+            }
+        )
+        return self.history_id
+
+    def fail_next_request(self, error: Exception):
+        """
+        Make the next request fail in the transport with the given exception
+        """
+        self._fail_next.append(error)
+
+    def http(self) -> "FakeGmailHttp":
+        """
+        Create a new transport talking to this mailbox
+        """
+        return FakeGmailHttp(self)
+
+    def handle(self, method: str, uri: str, body: Optional[bytes]) -> (int, object):
+        """
+        Dispatch a single request, returning the status and the decoded response
+        """
+        with self.lock:
+            if self._fail_next:
+                raise self._fail_next.pop(0)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.calls["errors"] += 1
+                return 503, _error(503, "The service is currently unavailable.")
+            if self.quota_units is not None and not self._spend(method, uri):
+                self.calls["rateLimitExceeded"] += 1
+                return 429, _error(429, "User-rate limit exceeded.")
+            return self._handle(method, uri, body)
+
+    def _spend(self, method: str, uri: str) -> bool:
+        """
+        Spend the quota units of a request, False if there aren't enough left in
+        the last second
+        """
+        now = time.monotonic()
+        while self._spent and self._spent[0][0] <= now - 1:
+            self._spent.popleft()
+        units, _ = method_cost(_method_id(method, uri))
+        if sum(spent for _, spent in self._spent) + units > self.quota_units:
+            return False
+        self._spent.append((now, units))
+        return True
+
+    def _handle(self, method: str, uri: str, body: Optional[bytes]) -> (int, object):
+        url = urlparse(uri)
+        parameters = parse_qs(url.query)
+        query = {key: values[-1] for key, values in parameters.items()}
+        query["labelIds"] = parameters.get("labelIds", [])
+        path = url.path.split("/gmail/v1/users/me/", 1)[-1].split("/")
+
+        match (method, path):
+            case ("GET", ["messages"]):
+                self.calls["messages.list"] += 1
+                return 200, self._list_messages(query)
+
+            case ("GET", ["messages", message_id]):
+                self.calls["messages.get"] += 1
+                if message_id not in self.messages:
+                    return 404, _error(404, "Requested entity was not found.")
+                return 200, _apply_fields(self.messages[message_id], query)
+
+            case ("GET", ["messages", message_id, "attachments", attachment_id]):
+                self.calls["attachments.get"] += 1
+                if attachment_id not in self.attachments:
+                    return 404, _error(404, "Requested entity was not found.")
+                return 200, _apply_fields(self.attachments[attachment_id], query)
+
+            case ("DELETE", ["messages", message_id]):
+                self.calls["messages.delete"] += 1
+                if self.messages.pop(message_id, None) is None:
+                    return 404, _error(404, "Requested entity was not found.")
+                self._record_history("messagesDeleted", message_id)
+                return 204, None
+
+            case ("POST", ["messages", "batchDelete"]):
+                self.calls["messages.batchDelete"] += 1
+                for message_id in json.loads(body)["ids"]:
+                    # gmail silently ignores ids that don't exist
+                    if self.messages.pop(message_id, None) is not None:
+                        self._record_history("messagesDeleted", message_id)
+                return 204, None
+
+            case ("POST", ["messages", "batchModify"]):
+                self.calls["messages.batchModify"] += 1
+                return self._modify_messages(json.loads(body))
+
+            case ("GET", ["labels"]):
+                self.calls["labels.list"] += 1
+                return 200, {"labels": list(self.labels.values())}
+
+            case ("POST", ["labels"]):
+                self.calls["labels.create"] += 1
+                return self._create_label(json.loads(body))
+
+            case ("DELETE", ["labels", label_id]):
+                self.calls["labels.delete"] += 1
+                label = self.labels.get(label_id)
+                if label is None or label["type"] == "system":
+                    return 404, _error(404, "Requested entity was not found.")
+                del self.labels[label_id]
+                # Deleting a label takes it off every message
+                for message in self.messages.values():
+                    if label_id in message["labelIds"]:
+                        message["labelIds"].remove(label_id)
+                return 204, None
+
+            case ("POST", ["watch"]):
+                self.calls["watch"] += 1
+                request = json.loads(body)
+                if request["topicName"] not in self.topics:
+                    return 404, _error(404, f"Unknown topic {request['topicName']}")
+                self.watch = request
+                # gmail watches for a week
+                expiration = int((time.time() + 7 * 24 * 60 * 60) * 1000)
+                return 200, {
+                    "historyId": str(self.history_id),
+                    "expiration": str(expiration),
+                }
+
+            case ("GET", ["profile"]):
+                self.calls["getProfile"] += 1
+                return 200, {
+                    "emailAddress": "me@example.com",
+                    "messagesTotal": len(self.messages),
+                    "historyId": str(self.history_id),
+                }
+
+            case ("GET", ["history"]):
+                self.calls["history.list"] += 1
+                return self._list_history(query)
+
+        return 404, _error(404, f"Unknown endpoint {method} {url.path}")
+
+    def _list_messages(self, query: dict) -> dict:
+        max_results = int(query.get("maxResults", 100))
+        start = int(query.get("pageToken", 0))
+        search = _parse_search(query["q"]) if query.get("q") else None
+        matching = [
+            message_id
+            for message_id, message in self.messages.items()
+            if set(query["labelIds"]) <= set(message["labelIds"])
+            and (search is None or search(message))
+        ]
+        ids = matching[start : start + max_results]
+        result = {"resultSizeEstimate": len(matching)}
+        if ids:
+            result["messages"] = [{"id": i, "threadId": i} for i in ids]
+        if start + max_results < len(matching):
+            result["nextPageToken"] = str(start + max_results)
+        return result
+
+    def _create_label(self, label: dict) -> (int, dict):
+        if any(
+            existing["name"].lower() == label["name"].lower()
+            for existing in self.labels.values()
+        ):
+            return 409, _error(409, "Label name exists or conflicts")
+        label_id = f"Label_{self._next_label_id}"
+        self._next_label_id += 1
+        self.labels[label_id] = dict(label, id=label_id, type="user")
+        return 200, self.labels[label_id]
+
+    def _modify_messages(self, request: dict) -> (int, Optional[dict]):
+        add = request.get("addLabelIds", [])
+        remove = request.get("removeLabelIds", [])
+        for label_id in add + remove:
+            if label_id not in self.labels:
+                return 400, _error(400, f"Invalid label: {label_id}")
+        for message_id in request["ids"]:
+            # Like batchDelete, ids that don't exist are ignored
+            message = self.messages.get(message_id)
+            if message is None:
+                continue
+            labels = [i for i in message["labelIds"] if i not in remove]
+            labels.extend(i for i in add if i not in labels)
+            message["labelIds"] = labels
+        return 204, None
+
+    def _list_history(self, query: dict) -> (int, dict):
+        start_history_id = int(query["startHistoryId"])
+        if start_history_id < self._oldest_history_id:
+            return 404, _error(404, "Requested entity was not found.")
+
+        # historyTypes=messageAdded selects the records with messagesAdded
+        history_type = query.get("historyTypes")
+        if history_type is not None:
+            history_type = history_type.replace("message", "messages", 1)
+        max_results = int(query.get("maxResults", 100))
+        start = int(query.get("pageToken", 0))
+
+        records = [
+            record
+            for record in self.history
+            if int(record["id"]) > start_history_id
+            and (history_type is None or history_type in record)
+        ]
+        result = {"historyId": str(self.history_id)}
+        if records[start : start + max_results]:
+            result["history"] = records[start : start + max_results]
+        if start + max_results < len(records):
+            result["nextPageToken"] = str(start + max_results)
+        return 200, result
+
+
+class FakeGmailHttp:
+    """
+    The httplib2.Http look-alike handed to googleapiclient. It pretends to keep
+    one keep-alive connection per host so connection reuse can be counted.
+    """
+
+    def __init__(self, gmail: FakeGmail):
+        self.gmail = gmail
+        self.connections: dict = {}
+        self.timeout = None
+        self.follow_redirects = True
+        self.redirect_codes = httplib2.REDIRECT_CODES
+
+    def request(
+        self,
+        uri,
+        method="GET",
+        body=None,
+        headers=None,
+        redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+        connection_type=None,
+    ):
+        key = f"{urlparse(uri).scheme}:{urlparse(uri).netloc}"
+        if key not in self.connections:
+            self.connections[key] = object()
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if self.gmail.latency:
+            time.sleep(self.gmail.latency)
+
+        try:
+            if urlparse(uri).path.startswith("/batch"):
+                return self._batch_request(body, headers or {})
+            status, response = self.gmail.handle(method, uri, body)
+        except Exception:
+            # A broken transport loses its connection
+            self.connections.pop(key, None)
+            raise
+
+        content = b"" if response is None else _encode(response)
+        headers = {"status": str(status), "content-type": _TYPE_JSON}
+        if status == 429:
+            headers["retry-after"] = str(self.gmail.retry_after)
+        return httplib2.Response(headers), content
+
+    def _batch_request(self, body: bytes, headers: dict):
+        """
+        Split a multipart/mixed batch into its requests, handle each one and
+        answer with a multipart/mixed response
+        """
+        self.gmail.calls["batch"] += 1
+
+        content_type = headers["content-type"]
+        request = Parser().parsestr(
+            f"content-type: {content_type}\r\n\r\n{body.decode('utf-8')}"
+        )
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in request.get_payload():
+            http_request = part.get_payload()
+            request_line, _, rest = http_request.partition("\n")
+            method, path, _ = request_line.strip().split(" ")
+            _, _, sub_body = rest.replace("\r\n", "\n").partition("\n\n")
+
+            status, response = self.gmail.handle(
+                method,
+                f"https://gmail.googleapis.com{path}",
+                sub_body.encode("utf-8") or None,
+            )
+            content = "" if response is None else _encode(response).decode("utf-8")
+            headers = f"Content-Type: {_TYPE_JSON}\r\n"
+            if status == 429:
+                headers += f"Retry-After: {self.gmail.retry_after}\r\n"
+            parts.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"{headers}\r\n"
+                f"{content}\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+
+        return (
+            httplib2.Response(
+                {
+                    "status": "200",
+                    "content-type": f"multipart/mixed; boundary={boundary}",
+                }
+            ),
+            "".join(parts).encode("utf-8"),
+        )
+
+    def close(self):
+        self.connections.clear()
+
+
+_TYPE_JSON = "application/json; charset=UTF-8"
+
+SYSTEM_LABELS = ("INBOX", "UNREAD", "IMPORTANT", "SENT", "TRASH", "SPAM")
+
+
+def mime_part(
+    mime_type: str,
+    content: str = None,
+    parts: list = None,
+    filename: str = None,
+    attachment: bool = None,
+) -> dict:
+    """
+    Build a message payload, or a part of one, for FakeGmail.add_message. A
+    multipart part has parts, other parts have content. Attachments, which are
+    parts with a filename unless attachment says otherwise, are only referred to
+    by an attachmentId, like gmail does for attachments and big parts.
+    """
+    part = {"mimeType": mime_type, "headers": []}
+    if parts is not None:
+        part["body"] = {"size": 0}
+        part["parts"] = parts
+    else:
+        data = content.encode("utf-8")
+        part["body"] = {
+            "size": len(data),
+            "data": base64.urlsafe_b64encode(data).decode("ascii"),
+        }
+    if filename is not None:
+        part["filename"] = filename
+    part["attachment"] = filename is not None if attachment is None else attachment
+    return part
+
+
+def _method_id(method: str, uri: str) -> str:
+    """
+    The id of the gmail method a request calls, like gmail.users.messages.get
+    """
+    path = urlparse(uri).path.split("/gmail/v1/users/me/", 1)[-1].split("/")
+    match (method, path):
+        case ("GET", ["profile"]):
+            return "gmail.users.getProfile"
+        case ("POST", ["watch"]):
+            return "gmail.users.watch"
+        case ("GET", ["messages"]):
+            return "gmail.users.messages.list"
+        case ("GET", ["messages", _]):
+            return "gmail.users.messages.get"
+        case ("GET", ["messages", _, "attachments", _]):
+            return "gmail.users.messages.attachments.get"
+        case ("DELETE", ["messages", _]):
+            return "gmail.users.messages.delete"
+        case ("POST", ["messages", action]):
+            return f"gmail.users.messages.{action}"
+        case ("GET", ["labels"]):
+            return "gmail.users.labels.list"
+        case ("POST", ["labels"]):
+            return "gmail.users.labels.create"
+        case ("DELETE", ["labels", _]):
+            return "gmail.users.labels.delete"
+        case ("GET", ["history"]):
+            return "gmail.users.history.list"
+    return f"{method} {'/'.join(path)}"
+
+
+def _apply_fields(resource: dict, query: dict):
+    """
+    Only keep what the fields parameter of the request asks for
+    """
+    if "fields" not in query:
+        return resource
+    return _select(resource, _parse_fields(query["fields"]))
+
+
+def _parse_fields(fields: str) -> dict:
+    """
+    Parse a fields mask like "id,payload(headers,parts/body/size)" into a tree
+    of dicts, where None means everything
+    """
+    tree = {}
+    position = 0
+
+    def parse_list(into: dict) -> None:
+        nonlocal position
+        while position < len(fields):
+            start = position
+            while position < len(fields) and fields[position] not in ",()":
+                position += 1
+            path = fields[start:position].split("/")
+
+            node = into
+            for name in path[:-1]:
+                if node.get(name) is None:
+                    node[name] = {}
+                node = node[name]
+            if position < len(fields) and fields[position] == "(":
+                position += 1
+                parse_list(node.setdefault(path[-1], {}))
+            else:
+                node[path[-1]] = None
+
+            if position < len(fields) and fields[position] == ")":
+                position += 1
+                return
+            position += 1  # skip the comma
+
+    parse_list(tree)
+    return tree
+
+
+def _select(value, tree: Optional[dict]):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [_select(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: _select(value[key], sub_tree)
+            for key, sub_tree in tree.items()
+            if key in value
+        }
+    return value
+
+
+def _parse_search(search: str) -> Callable[[dict], bool]:
+    """
+    Compile the part of the gmail search syntax the tests use: from:, subject:
+    and plain words, grouped with parentheses, ANDed by putting them side by side
+    and ORed with OR or braces. Matching is by substring, ignoring case.
+    """
+    tokens = re.findall(r'\(|\)|\{|\}|"[^"]*"|[^\s(){}]+', search)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_and(field: Optional[str], end: Optional[str]):
+        nonlocal position
+        terms = []
+        while peek() is not None and peek() != end:
+            terms.append(parse_or(field))
+        position += 1  # skip the end
+        return lambda message: all(term(message) for term in terms)
+
+    def parse_or(field: Optional[str]):
+        nonlocal position
+        terms = [parse_term(field)]
+        while peek() == "OR":
+            position += 1
+            terms.append(parse_term(field))
+        return lambda message: any(term(message) for term in terms)
+
+    def parse_term(field: Optional[str]):
+        nonlocal position
+        token = tokens[position]
+        position += 1
+        if token == "(":
+            return parse_and(field, ")")
+        if token == "{":
+            terms = []
+            while peek() not in ("}", None):
+                terms.append(parse_term(field))
+            position += 1
+            return lambda message: any(term(message) for term in terms)
+        name, colon, value = token.partition(":")
+        if colon and name in ("from", "subject"):
+            if not value:
+                return parse_term(name)
+            field, token = name, value
+        word = token.strip('"').lower()
+        return lambda message: word in _search_text(message, field)
+
+    return parse_and(None, None)
+
+
+def _search_text(message: dict, field: Optional[str]) -> str:
+    headers = {
+        header["name"].lower(): header["value"]
+        for header in message["payload"]["headers"]
+    }
+    if field is not None:
+        return headers.get(field, "").lower()
+    parts = [message["payload"]]
+    text = [headers.get("from", ""), headers.get("subject", "")]
+    while parts:
+        part = parts.pop()
+        parts.extend(part.get("parts", []))
+        if "data" in part["body"]:
+            text.append(base64.urlsafe_b64decode(part["body"]["data"]).decode())
+    return " ".join(text).lower()
+
+
+def _encode(response) -> bytes:
+    if isinstance(response, bytes):
+        return response
+    return json.dumps(response).encode("utf-8")
+
+
+def _error(code: int, message: str) -> dict:
+    return {"error": {"code": code, "message": message, "errors": []}}
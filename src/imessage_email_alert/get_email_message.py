@@ -1,26 +1,44 @@
 import base64
+import codecs
 import os
-from dataclasses import dataclass, field
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 import google.auth.exceptions
-from bs4 import BeautifulSoup
-from google.auth.transport.requests import Request
+import httplib2
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 
+from .credentials import CredentialManager
 
-@dataclass
-class EmailMessage:
-    """Data class to represent an email message"""
+# EmailMessage used to live here, and messages pickled by --save-messages refer
+# to it by this module
+from .email_message import EmailMessage
+from .html_text import HtmlTextExtractor, extract_text
+from .metrics import AlertMetrics
+from .quota import QuotaBudget, method_cost, rate_limit_delay
+
+# The body of a message without a part we can read, which isn't cut short
+_UNREADABLE = ("Unreadable message", False)
+
+# The gmail discovery document ships with googleapiclient, so read it once per
+# process instead of fetching and parsing it for every service object
+_gmail_discovery_document: Optional[str] = None
 
-    from_email: str = field(default_factory=str)
-    to_email: str = field(default_factory=str)
-    subject: str = field(default_factory=str)
-    body: str = field(default_factory=str)
-    message_id: str = field(default_factory=str)
+
+def _get_gmail_discovery_document() -> str:
+    global _gmail_discovery_document
+    if _gmail_discovery_document is None:
+        _gmail_discovery_document = get_static_doc("gmail", "v1")
+    return _gmail_discovery_document
 
 
 class DeleteError(Exception):
@@ -35,6 +53,72 @@ class DeleteError(Exception):
         super().__init__(self.message)
 
 
+@dataclass
+class ClientStats:
+    """Counters for how often the gmail service and its connections were built"""
+
+    clients_built: int = 0
+    connections_built: int = 0
+    requests: int = 0
+    bytes_transferred: int = 0
+    bytes_decoded: int = 0
+
+
+class _CountingHttp:
+    """
+    Wrap an httplib2.Http (or anything that looks like one) and count the requests
+    and new connections that go through it. httplib2 keeps one keep-alive
+    connection per host in its connections dict, so a new entry there means a new
+    connection was opened.
+    """
+
+    def __init__(self, http, stats: ClientStats):
+        self.http = http
+        self.stats = stats
+
+    def request(self, *args, **kwargs):
+        before = {id(conn) for conn in self.http.connections.values()}
+        try:
+            response, content = self.http.request(*args, **kwargs)
+            self.stats.bytes_transferred += len(content)
+            return response, content
+        finally:
+            self.stats.requests += 1
+            self.stats.connections_built += sum(
+                1 for conn in self.http.connections.values() if id(conn) not in before
+            )
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+def _structure_fields(depth: int) -> str:
+    """
+    A fields mask for everything about a message except the body data, following
+    parts nested up to depth levels
+    """
+    part_fields = "partId,mimeType,filename,body(size,attachmentId)"
+    parts = part_fields
+    for _ in range(depth - 1):
+        parts = f"{part_fields},parts({parts})"
+    return (
+        "id,internalDate,labelIds,"
+        f"payload(partId,mimeType,headers,body(size,attachmentId),parts({parts}))"
+    )
+
+
+def _part_data_fields(depth: int) -> str:
+    """
+    A fields mask for the body data of the parts depth levels down
+    """
+    if depth == 0:
+        return "payload/body/data"
+    parts = "partId,body/data"
+    for _ in range(depth - 1):
+        parts = f"partId,parts({parts})"
+    return f"payload(parts({parts}))"
+
+
 class GetEmailMessage:
     """
     Retrieve email message from gmail
@@ -47,11 +131,59 @@ class GetEmailMessage:
     SCOPES: list = ["https://mail.google.com/"]
     config_directory: Path = Path.home() / ".config" / "imessage_email_alert"
 
-    def __init__(self, credential_file: Path = None, token_file: Path = None):
+    # gmail allows 100 requests in a batch, but recommends no more than 50, and
+    # batchDelete takes up to 1000 ids
+    BATCH_SIZE = 50
+    BATCH_DELETE_SIZE = 1000
+
+    # Get the structure of the message first, and then only the body part we need
+    STRUCTURE_FIELDS = _structure_fields(depth=6)
+    # The body parts we can use, best first
+    BODY_MIME_TYPES = ("text/plain", "text/html", "text")
+    # Base64 characters to decode at a time when streaming HTML, a multiple of 4
+    DECODE_CHUNK = 16384
+
+    # Errors from the transport that mean the pooled connection can't be trusted
+    TRANSPORT_ERRORS = (httplib2.HttpLib2Error, OSError)
+
+    def __init__(
+        self,
+        credential_file: Path = None,
+        token_file: Path = None,
+        credentials: Credentials = None,
+        transport_factory: Callable[[], httplib2.Http] = None,
+        incremental: bool = False,
+        lazy_body: bool = False,
+        body_limit: int = None,
+        query: str = None,
+        label_ids: list = None,
+        metrics: AlertMetrics = None,
+        quota: QuotaBudget = None,
+    ):
         """
         Optionally pass in paths to the credentials file and the token file.
         By default, they live in ~/.config/imessage_email_alert as
         .credentials.json and .token.json
+
+        :param credentials: Already authorized credentials, skips the
+        authorization flow. They are refreshed when they expire, but not in the
+        background.
+        :param transport_factory: Creates the underlying http transport, by
+        default a keep-alive httplib2.Http
+        :param incremental: Keep a local copy of the message list and only ask
+        gmail for the messages added since the last historyId
+        :param lazy_body: Get the headers and MIME structure of the message first,
+        and then only the one body part that is used
+        :param body_limit: Decode no more than this many characters of a plain
+        text body, and stop extracting the text of an HTML body once it has this
+        many characters
+        :param query: Only list the messages that match this gmail search. The
+        messages added since the last incremental sync can't be searched, so they
+        are all listed.
+        :param label_ids: Only list the messages with all of these labels
+        :param metrics: Where to record how long decoding takes
+        :param quota: Spend the gmail quota through this budget, waiting instead
+        of going over it
         """
         if credential_file is None:
             self.credential_file = self.config_directory / ".credentials.json"
@@ -63,81 +195,481 @@ class GetEmailMessage:
         else:
             self.token_file = token_file
 
-        self.credentials = self._authorize()
+        if transport_factory is None:
+            self.transport_factory = lambda: httplib2.Http(timeout=60)
+        else:
+            self.transport_factory = transport_factory
+
+        # httplib2 is not thread safe, so every thread gets its own service object
+        self.client_stats = ClientStats()
+        self._local = threading.local()
+
+        # Incremental sync state: the last historyId we synced to, and the ids of
+        # the messages that are in the mailbox as far as we know, newest first
+        self.incremental = incremental
+        self.history_id: Optional[str] = None
+        self._known_ids: OrderedDict = OrderedDict()
+        self._known_ids_lock = threading.RLock()
+
+        self.lazy_body = lazy_body
+        self.body_limit = body_limit
+        self.query = query
+        self.label_ids = label_ids
+        self.metrics = metrics
+        self.quota = quota
+
+        if credentials is None:
+            self.credential_manager = self._authorize().start()
+        else:
+            self.credential_manager = CredentialManager(credentials)
+        self.credentials = self.credential_manager.credentials
+
+    def _get_service(self):
+        """
+        Return the long-lived gmail service object, building it the first time and
+        again only after the credentials were refreshed or the transport failed
+        """
+        # The credentials are refreshed in place, so the service keeps working
+        self.credential_manager.ensure_valid()
+
+        service = getattr(self._local, "service", None)
+        if service is None:
+            http = AuthorizedHttp(
+                self.credentials,
+                http=_CountingHttp(self.transport_factory(), self.client_stats),
+            )
+            service = build_from_document(_get_gmail_discovery_document(), http=http)
+            self._local.service = service
+            self.client_stats.clients_built += 1
+        return service
+
+    def reset_service(self):
+        """
+        Drop this thread's service object and its connections, the next call
+        builds new ones
+        """
+        service = getattr(self._local, "service", None)
+        if service is not None:
+            try:
+                service._http.close()
+            except Exception:
+                pass
+        self._local.service = None
+
+    def _execute(self, request, cost: tuple = None):
+        """
+        Execute a request, throwing away the connection pool if the transport
+        failed so the next call starts with a fresh connection
+
+        :param cost: The quota units and priority of the request, worked out from
+        its method if not given
+        """
+        if self.quota is None:
+            spending = nullcontext()
+        else:
+            spending = self.quota.spend(*(cost or method_cost(request.methodId)))
+        try:
+            with spending:
+                return request.execute()
+        except self.TRANSPORT_ERRORS:
+            self.reset_service()
+            raise
+        except HttpError as error:
+            self._check_rate_limit(error)
+            raise
+
+    def _check_rate_limit(self, error: Exception):
+        """
+        If gmail says we went over the quota, spend nothing until it lets us
+        """
+        delay = rate_limit_delay(error)
+        if delay is None:
+            return
+        if self.metrics is not None:
+            self.metrics.error("quota")
+        if self.quota is not None:
+            self.quota.pause(delay)
 
     def get_next_message(self) -> Optional[EmailMessage]:
         """
         Retrieve the next email message
         """
-        # create a gmail service object
-        service = build("gmail", "v1", credentials=self.credentials)
+        for message_id in self.list_message_ids(max_results=1):
+            return self.get_message(message_id)
 
-        # Get the list of messages
-        results = service.users().messages().list(userId="me").execute()
-        messages = results.get("messages", [])
+    def list_message_ids(self, max_results: int = 100) -> list:
+        """
+        Return the ids of up to max_results messages in the mailbox, newest first
+        """
+        if self.incremental:
+            with self._known_ids_lock:
+                self._sync()
+                return list(self._known_ids)[:max_results]
 
-        if not messages:
-            # If there are no messages available, just return
-            return
+        service = self._get_service()
+        results = self._execute(
+            service.users()
+            .messages()
+            .list(
+                userId="me",
+                maxResults=max_results,
+                q=self.query,
+                labelIds=self.label_ids,
+            )
+        )
+        return [message["id"] for message in results.get("messages", [])]
+
+    def _sync(self):
+        """
+        Bring the local message list up to date, using the history since the last
+        sync, or a full listing if we have never synced or the history expired
+        """
+        if self.history_id is not None:
+            try:
+                self._sync_history()
+                return
+            except HttpError as error:
+                # gmail only keeps history for a limited time, and answers 404
+                # for a historyId that is too old
+                if error.resp.status != 404:
+                    raise
+        self._sync_full()
+
+    def _sync_full(self):
+        service = self._get_service()
+
+        # Get the historyId before listing, so nothing added while listing is
+        # missed. Something added in between just shows up twice, which is fine.
+        profile = self._execute(service.users().getProfile(userId="me"))
+        history_id = profile["historyId"]
+
+        known_ids = OrderedDict()
+        page_token = None
+        while True:
+            results = self._execute(
+                service.users()
+                .messages()
+                .list(
+                    userId="me",
+                    maxResults=500,
+                    pageToken=page_token,
+                    q=self.query,
+                    labelIds=self.label_ids,
+                )
+            )
+            for message in results.get("messages", []):
+                known_ids[message["id"]] = None
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+        self._known_ids = known_ids
+        self.history_id = history_id
+
+    def _sync_history(self):
+        service = self._get_service()
+
+        page_token = None
+        while True:
+            results = self._execute(
+                service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=self.history_id,
+                    historyTypes="messageAdded",
+                    # history can only be filtered by one label
+                    labelId=self.label_ids[0] if self.label_ids else None,
+                    pageToken=page_token,
+                )
+            )
+            for history in results.get("history", []):
+                for added in history.get("messagesAdded", []):
+                    message_id = added["message"]["id"]
+                    self._known_ids[message_id] = None
+                    self._known_ids.move_to_end(message_id, last=False)
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+        self.history_id = results.get("historyId", self.history_id)
+
+    def get_message(self, message_id: str) -> Optional[EmailMessage]:
+        """
+        Retrieve a single email message, None if it no longer exists
+        """
+        service = self._get_service()
+        try:
+            if self.lazy_body:
+                return self._get_message_lazily(message_id)
+            message = self._execute(
+                service.users()
+                .messages()
+                .get(userId="me", id=message_id, format="full")
+            )
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            self._forget(message_id)
+            return None
 
-        message_id = messages[0]["id"]
+        return self._parse_message(message)
 
-        result = EmailMessage(message_id=message_id)
-        message = (
+    def _get_message_lazily(self, message_id: str) -> EmailMessage:
+        """
+        Get the headers and MIME structure, pick the best body part, and only get
+        and decode that part
+        """
+        service = self._get_service()
+        message = self._execute(
             service.users()
             .messages()
-            .get(userId="me", id=message_id, format="full")
-            .execute()
+            .get(
+                userId="me",
+                id=message_id,
+                format="full",
+                fields=self.STRUCTURE_FIELDS,
+            )
         )
-        message_id: str = message["id"]
+        result = self._parse_headers(message)
+
+        found = self._find_body_part(message["payload"])
+        if found is None:
+            result.body = "Unreadable message"
+            return result
+        part, depth = found
+
+        if part["body"].get("attachmentId"):
+            # Big parts are kept apart from the message, like attachments
+            data = self._execute(
+                service.users()
+                .messages()
+                .attachments()
+                .get(userId="me", messageId=message_id, id=part["body"]["attachmentId"])
+            ).get("data")
+        else:
+            data_message = self._execute(
+                service.users()
+                .messages()
+                .get(
+                    userId="me",
+                    id=message_id,
+                    format="full",
+                    fields=_part_data_fields(depth),
+                )
+            )
+            data = self._find_part_data(data_message["payload"], part.get("partId"))
+
+        if data is None:
+            result.body = "Unreadable message"
+        else:
+            result.body, result.truncated = self._decode_text(data, part["mimeType"])
+        return result
+
+    def _find_body_part(self, payload: dict) -> Optional[tuple]:
+        """
+        Find the best body part, and how many levels of parts down it is
+        """
+        candidates = {}
+
+        def walk(part: dict, part_depth: int):
+            if part.get("parts"):
+                for sub_part in part["parts"]:
+                    walk(sub_part, part_depth + 1)
+            elif part.get("mimeType") in self.BODY_MIME_TYPES and not part.get(
+                "filename"
+            ):
+                candidates.setdefault(part["mimeType"], (part, part_depth))
+
+        walk(payload, 0)
+        for mime_type in self.BODY_MIME_TYPES:
+            if mime_type in candidates:
+                return candidates[mime_type]
+        return None
+
+    @staticmethod
+    def _find_part_data(payload: dict, part_id: Optional[str]) -> Optional[str]:
+        if not part_id:
+            return payload.get("body", {}).get("data")
+        for part in payload.get("parts", []):
+            if part.get("partId") == part_id:
+                return part.get("body", {}).get("data")
+            if part_id.startswith(f"{part.get('partId')}."):
+                return GetEmailMessage._find_part_data(part, part_id)
+        return None
+
+    def _decode_text(self, data: str, mime_type: str) -> (str, bool):
+        """
+        Decode a body part to text, only decoding as much as body_limit needs.
+        Returns the text, and whether it was cut short.
+        """
+        if mime_type == "text/html":
+            return self._decode_html(data)
+
+        text, truncated = self._decode(data, self.body_limit)
+        if mime_type == "text" and text.startswith("<!DOCTYPE"):
+            return self._decode_html(data)
+        return text, truncated
+
+    def _timer(self, stage: str):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.stage(stage)
+
+    def _decode_html(self, data: str) -> (str, bool):
+        """
+        Decode an HTML body part and extract its text a chunk at a time, stopping
+        as soon as there is body_limit characters of text. Returns the text, and
+        whether it was cut short.
+        """
+        with self._timer("html"):
+            return self._decode_html_chunks(data)
+
+    def _decode_html_chunks(self, data: str) -> (str, bool):
+        extractor = HtmlTextExtractor(self.body_limit)
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for start in range(0, len(data), self.DECODE_CHUNK):
+            decoded = base64.urlsafe_b64decode(data[start : start + self.DECODE_CHUNK])
+            self.client_stats.bytes_decoded += len(decoded)
+            extractor.feed(decoder.decode(decoded))
+            if extractor.done:
+                break
+        extractor.close()
+        return extractor.text, extractor.truncated
+
+    def _decode(self, data: str, max_chars: int = None) -> (str, bool):
+        """
+        Decode base64url body data. With max_chars, only the start of the data that
+        can hold that many characters is decoded. Returns the text, and whether it
+        was cut short.
+        """
+        truncated = False
+        if max_chars is not None:
+            # A character is at most 4 bytes of utf-8, and every 3 bytes are 4
+            # characters of base64
+            needed = -(-max_chars * 4 // 3) * 4
+            if needed < len(data):
+                data = data[:needed]
+                truncated = True
+
+        with self._timer("decode"):
+            decoded = base64.urlsafe_b64decode(data)
+            self.client_stats.bytes_decoded += len(decoded)
+
+            if truncated:
+                # The last character may have been cut in half
+                return decoded.decode("utf-8", errors="ignore")[:max_chars], True
+            return decoded.decode("utf-8"), False
+
+    def _html_to_text(self, html: str) -> (str, bool):
+        with self._timer("html"):
+            return extract_text(html, limit=self.body_limit)
+
+    def get_messages(self, message_ids: list) -> (list, dict):
+        """
+        Retrieve several email messages using batch requests, many gets in one
+        round trip. Returns the messages that were retrieved, and a dict of the
+        errors for the ones that were not, by message id. Messages that no longer
+        exist are left out of both.
+        """
+        service = self._get_service()
+        messages = {}
+        errors = {}
+
+        def callback(request_id: str, response: dict, exception: Exception):
+            if exception is None:
+                try:
+                    messages[request_id] = self._parse_message(response)
+                except Exception as error:
+                    errors[request_id] = error
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                self._forget(request_id)
+            else:
+                self._check_rate_limit(exception)
+                errors[request_id] = exception
+
+        for start in range(0, len(message_ids), self.BATCH_SIZE):
+            chunk = message_ids[start : start + self.BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in chunk:
+                batch.add(
+                    service.users()
+                    .messages()
+                    .get(userId="me", id=message_id, format="full"),
+                    request_id=message_id,
+                )
+            # Every request in the batch uses its own quota
+            self._execute(batch, method_cost("gmail.users.messages.get", len(chunk)))
+
+        return [messages[i] for i in message_ids if i in messages], errors
+
+    def _parse_message(self, message: dict) -> EmailMessage:
+        """
+        Turn a gmail message resource into an EmailMessage
+        """
+        result = self._parse_headers(message)
         payload: dict = message["payload"]
-        header_list: list = payload["headers"]
         mime_type = payload["mimeType"]
 
-        headers = self._convert_name_value_list(header_list)
-        result.from_email = headers.get("From")
-        result.to_email = headers.get("To")
-        result.subject = headers.get("Subject")
-
         # This next section is responsible for decoding the message, be it plain
         # text, or html.
 
         message_main_type = mime_type.split("/")[0]
 
-        text = "Unreadable message"
-        html_text = "Unreadable message"
+        # The text, and whether it was cut short
+        text = _UNREADABLE
+        html_text = _UNREADABLE
 
         parts = payload.get("parts")
         if parts:
             text, html_text = self._parse_parts(parts)
         else:
-            decoded_data = base64.urlsafe_b64decode(payload["body"]["data"]).decode(
-                "utf-8"
-            )
             mime_type = payload["mimeType"]
             match mime_type:
                 case "text/plain":
-                    text = decoded_data
+                    text = self._decode(payload["body"]["data"], self.body_limit)
 
                 case "text/html":
-                    soup = BeautifulSoup(decoded_data, "html.parser")
-                    html_text = soup.get_text()
+                    decoded_data, _ = self._decode(payload["body"]["data"])
+                    html_text = self._html_to_text(decoded_data)
 
                 case "text":
-                    text = decoded_data
+                    decoded_data, _ = self._decode(payload["body"]["data"])
+                    text = decoded_data, False
                     if decoded_data.startswith("<!DOCTYPE"):
-                        soup = BeautifulSoup(decoded_data, "html.parser")
-                        text = soup.get_text()
+                        text = self._html_to_text(decoded_data)
             pass
-        if text == "Unreadable message" and html_text != "Unreadable message":
+        if text == _UNREADABLE and html_text != _UNREADABLE:
             text = html_text
 
-        result.body = text
+        result.body, result.truncated = text
+        return result
+
+    def _parse_headers(self, message: dict) -> EmailMessage:
+        """
+        Start an EmailMessage from the headers of a gmail message resource
+        """
+        message_id: str = message["id"]
+        result = EmailMessage(message_id=message_id)
+        if message.get("internalDate"):
+            result.received = int(message["internalDate"]) / 1000
+        if "labelIds" in message:
+            result.label_ids = message["labelIds"]
+        header_list: list = message["payload"]["headers"]
+
+        headers = self._convert_name_value_list(header_list)
+        result.from_email = headers.get("From")
+        result.to_email = headers.get("To")
+        result.subject = headers.get("Subject")
         return result
 
-    def _parse_parts(self, parts: list) -> (str, str):
-        text = "Unreadable message"
-        html_text = "Unreadable message"
+    def _parse_parts(self, parts: list) -> (tuple, tuple):
+        """
+        The plain and the HTML text of the parts, each with whether it was cut
+        short
+        """
+        text = _UNREADABLE
+        html_text = _UNREADABLE
 
         for part in parts:  # type: dict
             sub_part = part.get("parts")
@@ -149,39 +681,118 @@ class GetEmailMessage:
                 match part_mime_type:
                     case "text/plain":
                         if part["body"].get("data") is not None:
-                            decoded_data = base64.urlsafe_b64decode(
-                                part["body"]["data"]
-                            ).decode("utf-8")
-                            text = decoded_data
+                            text = self._decode(part["body"]["data"], self.body_limit)
 
                     case "text/html":
                         if part["body"].get("data") is not None:
-                            decoded_data = base64.urlsafe_b64decode(
-                                part["body"]["data"]
-                            ).decode("utf-8")
-                            soup = BeautifulSoup(decoded_data, "html.parser")
-                            html_text = soup.get_text()
+                            decoded_data, _ = self._decode(part["body"]["data"])
+                            html_text = self._html_to_text(decoded_data)
 
                     case "text":
                         if part["body"].get("data") is not None:
-                            decoded_data = base64.urlsafe_b64decode(
-                                part["body"]["data"]
-                            ).decode("utf-8")
-                            text = decoded_data
+                            decoded_data, _ = self._decode(part["body"]["data"])
+                            text = decoded_data, False
                             if decoded_data.startswith("<!DOCTYPE"):
-                                soup = BeautifulSoup(decoded_data, "html.parser")
-                                text = soup.get_text()
+                                text = self._html_to_text(decoded_data)
                 pass
         return text, html_text
 
     def delete_message(self, message_id: str):
-        service = build("gmail", "v1", credentials=self.credentials)
+        service = self._get_service()
 
-        results = (
-            service.users().messages().delete(userId="me", id=message_id).execute()
+        results = self._execute(
+            service.users().messages().delete(userId="me", id=message_id)
         )
         if results != "":
             raise DeleteError(message_id, f"Message could not be deleted: {results}")
+        self._forget(message_id)
+
+    def delete_messages(self, message_ids: list):
+        """
+        Delete several messages with batchDelete, one call per 1000 messages
+        """
+        service = self._get_service()
+
+        for start in range(0, len(message_ids), self.BATCH_DELETE_SIZE):
+            chunk = message_ids[start : start + self.BATCH_DELETE_SIZE]
+            results = self._execute(
+                service.users().messages().batchDelete(userId="me", body={"ids": chunk})
+            )
+            if results != "":
+                raise DeleteError(
+                    ", ".join(chunk), f"Messages could not be deleted: {results}"
+                )
+            for message_id in chunk:
+                self._forget(message_id)
+
+    def watch(self, topic: str, label_ids: list = None) -> dict:
+        """
+        Ask gmail to publish a notification to the Pub/Sub topic whenever
+        messages with the labels change, for the next week. Returns the
+        historyId it watches from and the expiration.
+        """
+        service = self._get_service()
+        body = {"topicName": topic}
+        if label_ids:
+            body["labelIds"] = label_ids
+            body["labelFilterBehavior"] = "include"
+        return self._execute(service.users().watch(userId="me", body=body))
+
+    def list_labels(self) -> list:
+        """
+        Return the labels of the mailbox, as dicts with an id and a name
+        """
+        service = self._get_service()
+        results = self._execute(service.users().labels().list(userId="me"))
+        return results.get("labels", [])
+
+    def create_label(self, name: str) -> dict:
+        """
+        Create a label that is hidden from the label list and the message list
+        """
+        service = self._get_service()
+        return self._execute(
+            service.users()
+            .labels()
+            .create(
+                userId="me",
+                body={
+                    "name": name,
+                    "labelListVisibility": "labelHide",
+                    "messageListVisibility": "hide",
+                },
+            )
+        )
+
+    def delete_label(self, label_id: str):
+        """
+        Delete a label, which also takes it off every message that has it
+        """
+        service = self._get_service()
+        self._execute(service.users().labels().delete(userId="me", id=label_id))
+
+    def modify_labels(self, message_ids: list, add: list = None, remove: list = None):
+        """
+        Add and remove labels on several messages with batchModify, one call per
+        1000 messages
+        """
+        service = self._get_service()
+        body = {"addLabelIds": add or [], "removeLabelIds": remove or []}
+
+        for start in range(0, len(message_ids), self.BATCH_DELETE_SIZE):
+            chunk = message_ids[start : start + self.BATCH_DELETE_SIZE]
+            self._execute(
+                service.users()
+                .messages()
+                .batchModify(userId="me", body=dict(body, ids=chunk))
+            )
+
+    def _forget(self, message_id: str):
+        """
+        Remove a message that is gone from the local copy of the message list
+        """
+        with self._known_ids_lock:
+            self._known_ids.pop(message_id, None)
 
     @staticmethod
     def _convert_name_value_list(name_value_list: list) -> dict:
@@ -192,37 +803,37 @@ class GetEmailMessage:
             result[name] = value
         return result
 
-    def _authorize(self) -> Credentials:
+    def _authorize(self) -> CredentialManager:
         """
         Authorize Google Account, taken from
         https://stackoverflow.com/questions/74487595/read-full-message-in-email-with-gmail-api
         """
 
-        credentials = None
+        manager = None
         # The file token.json stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
         # time.
         if os.path.exists(self.token_file):
-            try:
-                credentials = Credentials.from_authorized_user_file(
+            manager = CredentialManager(
+                Credentials.from_authorized_user_file(
                     str(self.token_file), self.SCOPES
-                )
-                credentials.refresh(Request())
+                ),
+                self.token_file,
+            )
+            try:
+                # A token that is still good is used as it is
+                manager.ensure_valid()
             except google.auth.exceptions.RefreshError as error:
                 # if refresh token fails, reset creds to none.
-                credentials = None
+                manager = None
                 print(f"An refresh authorization error occurred: {error}")
         # If there are no (valid) credentials available, let the user log in.
-        if not credentials or not credentials.valid:
-            if credentials and credentials.expired and credentials.refresh_token:
-                credentials.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    str(self.credential_file), self.SCOPES
-                )
-                credentials = flow.run_local_server(port=0)
+        if manager is None or not manager.credentials.valid:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                str(self.credential_file), self.SCOPES
+            )
+            manager = CredentialManager(flow.run_local_server(port=0), self.token_file)
             # Save the credentials for the next run
-            with open(self.token_file, "w") as token:
-                token.write(credentials.to_json())
+            manager.save()
 
-        return credentials
+        return manager
@@ -0,0 +1,107 @@
+import re
+from html.parser import HTMLParser
+from typing import Optional
+
+_SPACE = re.compile(r"\s+")
+
+
+class _EnoughText(Exception):
+    """Raised inside the parser to stop it once it has enough text"""
+
+
+class HtmlTextExtractor(HTMLParser):
+    """
+    Pull the visible text out of HTML as it is fed in, without building a tree.
+    The text of script, style and template elements and comments is left out, and
+    once limit characters of text have been collected the rest of the HTML is
+    ignored. Whitespace doesn't count towards the limit, as the indentation of
+    the HTML is dropped when the text is rendered.
+    """
+
+    SKIPPED_TAGS = frozenset(["script", "style", "template"])
+
+    def __init__(self, limit: Optional[int] = None):
+        """
+        :param limit: Stop after this many characters of text that aren't
+        whitespace
+        """
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.done = False
+        # Whether the text was cut short at the limit
+        self.truncated = False
+        self._chunks: list = []
+        self._length = 0
+        self._skipping = 0
+
+    def feed(self, data: str):
+        if self.done:
+            return
+        try:
+            super().feed(data)
+        except _EnoughText:
+            self.done = True
+            self.truncated = True
+
+    def close(self):
+        if not self.done:
+            try:
+                super().close()
+            except _EnoughText:
+                self.truncated = True
+        self.done = True
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+
+    def handle_endtag(self, tag: str):
+        if tag in self.SKIPPED_TAGS and self._skipping:
+            self._skipping -= 1
+
+    def handle_data(self, data: str):
+        if self._skipping:
+            return
+        if self.limit is not None:
+            needed = self.limit - self._length
+            visible = len(_SPACE.sub("", data))
+            if visible > needed:
+                # Keep the data up to the character that reaches the limit
+                end = 0
+                while needed > 0:
+                    if not data[end].isspace():
+                        needed -= 1
+                    end += 1
+                self._chunks.append(data[:end])
+                raise _EnoughText()
+            self._length += visible
+        self._chunks.append(data)
+
+
+def extract_text(
+    html: str, limit: Optional[int] = None, chunk_size: int = 8192
+) -> (str, bool):
+    """
+    The visible text of the HTML, stopping after limit characters that aren't
+    whitespace, and whether it was cut short there. The HTML is parsed a chunk at
+    a time, so whatever comes after the text we need is never looked at.
+    """
+    extractor = HtmlTextExtractor(limit)
+    for start in range(0, len(html), chunk_size):
+        extractor.feed(html[start : start + chunk_size])
+        if extractor.done:
+            break
+    extractor.close()
+    return extractor.text, extractor.truncated
+
+
+def html_to_text(html: str, limit: Optional[int] = None, chunk_size: int = 8192):
+    """
+    The visible text of the HTML, stopping after limit characters that aren't
+    whitespace
+    """
+    return extract_text(html, limit, chunk_size)[0]
@@ -1,16 +1,30 @@
 import logging
-import pickle
-import re
 import sys
-import time
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Optional
-
-from icecream import ic
-
-from .get_email_message import GetEmailMessage, EmailMessage
-from .send_imessage import SendImessage
+from typing import TYPE_CHECKING, Callable, Optional
+
+from .archive import MessageArchive
+from .dedup import DuplicateCache
+from .digest import AlertCoalescer, render_digests
+from .email_message import EmailMessage
+from .leases import LabelLeases
+from .logs import attach_log_writer
+from .metrics import AlertMetrics
+from .normalize_text import normalize_text
+from .outbox import Outbox
+from .push import MailboxWatcher, Subscriber
+from .quota import QuotaBudget, rate_limit_delay
+from .replay import DryRunSender, replay_messages
+from .routing import Route, RuleSet
+from .scheduler import PollScheduler
+from .send_imessage import SendImessage, send
+
+if TYPE_CHECKING:
+    # The google client libraries take a while to import, so they are only
+    # imported once gmail is connected to
+    from .get_email_message import GetEmailMessage
 
 
 class iMessageEmailAlert:
@@ -26,6 +40,7 @@ class iMessageEmailAlert:
 
     # The max lengh of the iMessage
     message_length = 800  # The maximum message length to send
+    digest_summary_length = 200  # The body length of each email in a digest
 
     def __init__(
         self,
@@ -36,6 +51,32 @@ class iMessageEmailAlert:
         debug: bool = False,
         save_messages: Path = None,
         test_messages: Path = None,
+        compress_saved: bool = True,
+        incremental_sync: bool = False,
+        drain_size: int = None,
+        outbox: Path = None,
+        poll_interval: float = 2,
+        idle_interval: float = 30,
+        lazy_body: bool = False,
+        digest_window: float = None,
+        digest_count: int = 20,
+        digest_length: int = 2000,
+        sender=None,
+        rules: RuleSet = None,
+        make_sender: Callable[[str], object] = None,
+        metrics: AlertMetrics = None,
+        json_logs: bool = True,
+        worker_id: str = None,
+        lease_seconds: float = 5 * 60,
+        quota_units: float = None,
+        account: str = "default",
+        dedup_window: float = None,
+        dedup_size: int = 10000,
+        dedup_file: Path = None,
+        subscriber: Subscriber = None,
+        watch_topic: str = None,
+        safety_interval: float = 5 * 60,
+        urgent_priority: int = None,
     ):
         """
         :param phone_number: The phone number or email address of the iMessage
@@ -44,6 +85,59 @@ class iMessageEmailAlert:
         :param token_file: The location to save the gmail token file
         :param log_dir: The location to store the logs
         :param debug: Debug mode
+        :param save_messages: Directory of the MessageArchive to save every email
+        message in
+        :param test_messages: Directory of saved messages to replay
+        :param compress_saved: Compress the saved messages
+        :param incremental_sync: Poll gmail for the changes since the last poll
+        instead of listing the mailbox every time
+        :param drain_size: Handle up to this many messages per poll, fetching them
+        in one batch and deleting the delivered ones in one call
+        :param outbox: SQLite file recording which messages were sent, so a
+        message that was sent but not deleted is never sent twice
+        :param poll_interval: Seconds between polls while mail is coming in
+        :param idle_interval: The longest time between polls while there is no mail
+        :param lazy_body: Get only the one body part that is used, and decode only
+        as much of it as the message needs
+        :param digest_window: Collect the emails that come in within this many
+        seconds of each other and send them as one digest iMessage. Implies
+        draining, digest_count messages at a time by default.
+        :param digest_count: Send the digest as soon as this many emails are waiting
+        :param digest_length: The longest digest to send, more emails than fit go
+        in another digest
+        :param sender: Sends the iMessages, with a send_message(text) method. A
+        SendImessage for phone_number by default.
+        :param rules: Routing rules, which pick the recipient and priority of each
+        message or drop it, and narrow down what is listed from gmail. Digests
+        always go to phone_number.
+        :param make_sender: Makes the sender for a recipient picked by a rule, a
+        SendImessage by default
+        :param metrics: Where to record how long each step takes and what
+        happened to the messages
+        :param json_logs: Write the log file as JSON lines instead of text
+        :param worker_id: Share the mailbox with other instances, claiming the
+        messages this one handles with a lease labelled with this id. Implies
+        draining, 10 messages at a time by default.
+        :param lease_seconds: How long a lease lasts, more than twice the
+        digest_window
+        :param quota_units: Spend no more than this many gmail quota units per
+        second, waiting instead, with getting new mail going before deleting
+        :param account: Names the gmail account in the metrics
+        :param dedup_window: Send one alert for the copies of an email that come
+        in within this many seconds, deleting the others
+        :param dedup_size: The most emails to remember for dedup_window
+        :param dedup_file: SQLite file to remember the emails in across restarts
+        :param subscriber: Where to pull the notifications gmail publishes to
+        watch_topic from, to poll as soon as mail comes in
+        :param watch_topic: The Pub/Sub topic gmail publishes changes to the
+        mailbox to
+        :param safety_interval: The longest time between polls while mail comes
+        in through the subscriber, in case a notification is lost. Takes the
+        place of idle_interval.
+        :param urgent_priority: Messages the routing rules give at least this
+        priority are urgent. They are sent right away instead of waiting for a
+        digest, go ahead of the messages waiting to be sent, don't wait for the
+        send rate limit, and have their own delivery SLO in the metrics.
         """
         self.phone_number = phone_number
         self.credential_files = credentials_file
@@ -51,51 +145,69 @@ class iMessageEmailAlert:
         self.log_dir = log_dir
         self.debug = debug
         self.save_message_dir = save_messages
+        self.archive = None
+        if save_messages is not None:
+            self.archive = MessageArchive(save_messages, compress=compress_saved)
         self.test_message_dir = test_messages
-
-        # The URLs in email messages have a lot of extraneous tracking stuff. For the
-        # iMessage, I don't really care about those, so just shorten it to the main
-        # part of the URL
-        self.http_match = re.compile("(.*)(http[s]*://[^?]*)\?[\S]*(.*)$")
-
-        self.gmail: Optional[GetEmailMessage] = None
-        self.imessage = SendImessage(self.phone_number)
+        self.incremental_sync = incremental_sync
+        self.drain_size = drain_size
+        self.outbox = None if outbox is None else Outbox(outbox)
+        self.subscriber = subscriber
+        self.watch_topic = watch_topic
+        if subscriber is not None:
+            idle_interval = safety_interval
+        self.scheduler = PollScheduler(poll_interval, idle_interval)
+        self.lazy_body = lazy_body
+        self.digest_length = digest_length
+        self.coalescer = None
+        if digest_window is not None:
+            self.coalescer = AlertCoalescer(digest_window, digest_count)
+            if self.drain_size is None:
+                self.drain_size = digest_count
+        self.leases = None
+        if worker_id is not None:
+            self.leases = LabelLeases(worker_id, lease_seconds)
+            if self.drain_size is None:
+                self.drain_size = 10
+            if digest_window is not None and digest_window * 2 >= lease_seconds:
+                raise ValueError(
+                    "The lease has to last more than twice the digest window, or "
+                    "emails waiting for a digest could be claimed by another worker"
+                )
+
+        self.gmail: Optional["GetEmailMessage"] = None
+        self._error_count = 0
+        self.imessage = SendImessage(self.phone_number) if sender is None else sender
+        self.rules = rules
+        self.urgent_priority = urgent_priority
+        self.make_sender = SendImessage if make_sender is None else make_sender
+        self._senders = {self.phone_number: self.imessage}
+        self.metrics = AlertMetrics() if metrics is None else metrics
+        self.account = account
+        self.dedup = None
+        if dedup_window:
+            self.dedup = DuplicateCache(dedup_window, dedup_size, dedup_file)
+        self.quota = None
+        if quota_units:
+            self.quota = QuotaBudget(quota_units)
+            self.metrics.quota_remaining.set_function(self.quota.remaining, (account,))
 
         app_name = "iMessageEmailAlert"
-        log_format: str = "%(asctime)s [%(process)d] <%(name)s> %(message)s"
-        date_format: str = "%Y-%m-%d %I:%M:%S %p"
 
-        # Configure the ic output
-        ic.configureOutput(
-            includeContext=True,
-            prefix=f'imessage_email_alert - {datetime.now().strftime("%Y-%m-%d %I:%M:%S %p")}',
-        )
-
-        # Set up logging
+        # Set up logging. The records are written from a background thread, and
+        # several instances, one per account, share the writer.
         self.logger = logging.getLogger(app_name)
         self.logger.setLevel(logging.INFO)
-        logging.Formatter(log_format, datefmt=date_format)
 
         if self.log_dir is None:
             self.log_dir = Path.home() / "logs"
+        log_file = (self.log_dir / f"{app_name}.log").absolute()
         try:
             self.log_dir.mkdir(parents=True, exist_ok=True)
-            file_handler = logging.FileHandler(
-                f"{self.log_dir / app_name}.log", mode="a"
-            )
-            file_handler.setFormatter(
-                logging.Formatter(log_format, datefmt=date_format)
-            )
-            self.logger.addHandler(file_handler)
         except Exception as exp:
-            ic(f"Error setting up logfile: {exp}")
-
-        if self.debug:
-            stdout_handler = logging.StreamHandler(sys.stdout)
-            stdout_handler.setFormatter(
-                logging.Formatter(log_format, datefmt=date_format)
-            )
-            self.logger.addHandler(stdout_handler)
+            print(f"Error setting up logfile: {exp}", file=sys.stderr)
+            log_file = None
+        attach_log_writer(self.logger, log_file, debug=debug, json_format=json_logs)
 
         self.logger.info("Starting Email Alert Service")
 
@@ -105,123 +217,539 @@ class iMessageEmailAlert:
         a time
         """
         # First connect to gmail, and create the GetEmailMessage instance
-        while True:
+        self._connect_gmail()
+        self._resume_outbox()
+        watcher = self._start_watcher()
+
+        # Once I have the gmail connection successfully, start grabbing messages and
+        # processing them.
+        try:
+            while not self.scheduler.stopped:
+                self.scheduler.wait(max_delay=self.poll())
+        finally:
+            if watcher is not None:
+                watcher.stop()
+        self.finish()
+
+    def _start_watcher(self) -> Optional[MailboxWatcher]:
+        """
+        Start waking up the poll loop for every notification from the subscriber
+        """
+        if self.subscriber is None or self.gmail is None:
+            return None
+        return MailboxWatcher(
+            self.gmail,
+            self.subscriber,
+            self.watch_topic,
+            self.scheduler.wake,
+            label_ids=None if self.rules is None else self.rules.label_ids,
+        ).start()
+
+    def poll(self) -> Optional[float]:
+        """
+        Check for new messages once, and process them. Returns the longest time to
+        wait before the next poll, if it has to be shorter than what the
+        scheduler says, or None.
+        """
+        gmail_breaker = self.scheduler.breakers["gmail"]
+        sender_breaker = self.scheduler.breakers["sender"]
+        if not gmail_breaker.allow() or not sender_breaker.allow():
+            # Wait for the circuit breaker to let us try again
+            return None
+
+        try:
+            if self.drain_size is not None:
+                taken, send_errors, sent = self._drain_messages()
+                more = taken >= self.drain_size
+            else:
+                taken, send_errors, sent = self._next_message()
+                more = False
+        except Exception as error:
+            delay = rate_limit_delay(error)
+            if delay is not None:
+                # Not a failure of gmail, it only wants us to slow down, and the
+                # quota budget already waits for it to let us
+                self.logger.warning(f"Gmail asked us to wait {delay}s:{error}")
+                return delay
+            self.metrics.error("gmail")
+            self._error_count = self._get_error(self._error_count, error)
+            gmail_breaker.record_failure()
+            self.scheduler.record_error()
+            return None
+        gmail_breaker.record_success()
+
+        if send_errors and not sent:
+            # Nothing could be sent, so back off until the sender works again
+            sender_breaker.record_failure()
+            self.scheduler.record_error()
+        else:
+            if sent:
+                sender_breaker.record_success()
+            self.scheduler.record_poll(taken, more=more)
+        # Wake up in time to send a digest that is waiting
+        return None if self.coalescer is None else self.coalescer.time_left()
+
+    def finish(self):
+        """
+        Send the emails still waiting for a digest, instead of leaving them for the
+        next start
+        """
+        if self.coalescer is not None and len(self.coalescer):
             try:
-                # Get the next gmail message
-                self.gmail = GetEmailMessage(self.credential_files, self.token_file)
+                _, _, delivered = self._send_digests()
+                self._delete_delivered(delivered)
+            except Exception as error:
+                self.logger.error(f"An error occurred sending the last digest:{error}")
+
+    def stop(self):
+        """
+        Stop the main loop after the current poll
+        """
+        self.scheduler.stop()
+
+    def _next_message(self) -> (int, int, int):
+        """
+        Get the next message, send it and delete it. Returns the number of messages
+        found, the number that failed to send, and the number sent.
+        """
+        with self.metrics.stage("list"):
+            message_ids = self.gmail.list_message_ids(max_results=1)
+        if not message_ids:
+            return 0, 0, 0
+        self.metrics.count("listed")
+        with self.metrics.stage("get"):
+            message = self.gmail.get_message(message_ids[0])
+        if not message:
+            return 0, 0, 0
+        self.metrics.count("fetched")
+
+        self._save_message(message)
+
+        sent = 0
+        try:
+            if not self._already_sent([message.message_id]):
+                self._outbox_mark([message.message_id], Outbox.FETCHED)
+                self._process_message(message)
+                self._outbox_mark([message.message_id], Outbox.SENT)
+                sent = 1
+        except Exception as error:
+            # If an error occurs, back off to see if it clears up
+            error_string = f"An error occurred trying to send message:{error}"
+
+            # self.imessage.send_message(error_string)
+            self.logger.error(error_string)
+            return 1, 1, 0
+
+        try:
+            # After we've successfully gotten and (hopefully) sent the
+            # message, delete it
+            with self.metrics.stage("delete"):
+                self.gmail.delete_message(message.message_id)
+            self._outbox_mark([message.message_id], Outbox.DELETED)
+            self.metrics.count("deleted")
+        except Exception as error:
+            self.metrics.error("delete")
+            error_string = f"An error occurred trying to delete message:{error}"
+
+            self.imessage.send_message(error_string)
+            self.logger.error(error_string)
+
+        return 1, 0, sent
+
+    def _connect_gmail(self):
+        """
+        Connect to gmail and create the GetEmailMessage instance, retrying until it
+        works. A GetEmailMessage that was already set, like one talking to a
+        FakeGmail, is kept.
+        """
+        while self.gmail is None and not self.scheduler.stopped:
+            try:
+                self._open_gmail()
                 break
             except Exception as error:
                 # When an error occurs, sleep for a while and try again
                 error_string = f"An error occurred with authorization:" f" {error}"
                 self.imessage.send_message(error_string)
                 self.logger.error(error_string)
-                ic(error_string)
-                time.sleep(60 * 10)  # 10 minutes so I don't flood the texts overnight
+                # 10 minutes so I don't flood the texts overnight
+                self.scheduler.sleep(60 * 10)
 
-        # Once I have the gmail connection successfully, start grabbing messages and
-        # processing them.
+    def _open_gmail(self):
+        """
+        Try once to connect to gmail and create the GetEmailMessage instance,
+        raising the error if it fails. One that was already set is kept.
+        """
+        from .get_email_message import GetEmailMessage
+
+        if self.gmail is None:
+            self.gmail = GetEmailMessage(
+                self.credential_files,
+                self.token_file,
+                incremental=self.incremental_sync,
+                lazy_body=self.lazy_body,
+                # Blank lines and URL parameters are dropped when the message
+                # is rendered, so decode more than message_length
+                body_limit=self.message_length * 4,
+                query=None if self.rules is None else self.rules.gmail_query(),
+                label_ids=None if self.rules is None else self.rules.label_ids,
+                metrics=self.metrics,
+                quota=self.quota,
+            )
 
-        error_count = 0
-        while True:
+    def _get_error(self, error_count: int, error: Exception) -> int:
+        """
+        Count an error getting mail, alerting every 20 errors. Returns the new
+        error count.
+        """
+        error_count += 1
+        if error_count > 20:
+            # If an error occurs, wait a while and try again
+            error_string = f"{error_count} errors occurred trying to get mail: {error}"
+            self.imessage.send_message(error_string)
+            self.logger.error(error_string)
+            error_count = 0
+        return error_count
+
+    def _drain_messages(self) -> (int, int, int):
+        """
+        Get up to drain_size messages in one batch, send them, and delete the ones
+        that were sent with a single batchDelete. A message that fails to be
+        fetched or sent is left in the mailbox to be tried again, without holding
+        up the others. Returns the number of new messages taken in, the number
+        that failed to send, and the number sent.
+        """
+        max_results = self.drain_size
+        if self.leases is not None:
+            self.leases.renew(self.gmail)
+            # List enough for every worker to get its share
+            max_results = min(self.drain_size * len(self.leases.workers()), 500)
+        with self.metrics.stage("list"):
+            message_ids = self.gmail.list_message_ids(max_results=max_results)
+        if self.coalescer is not None:
+            # The emails waiting for the digest are still in the mailbox
+            message_ids = [i for i in message_ids if i not in self.coalescer]
+        if self.leases is not None:
+            message_ids = self.leases.choose(message_ids, self.drain_size)
+        # Only new messages for this worker mean there may be more waiting, not the
+        # ones held for the digest or left for the other workers
+        taken = len(message_ids)
+        if not message_ids and not (self.coalescer and self.coalescer.due()):
+            return taken, 0, 0
+
+        # Messages that were sent before, but not deleted, only need deleting
+        already_sent = self._already_sent(message_ids)
+        delivered = [i for i in message_ids if i in already_sent]
+        to_get = [i for i in message_ids if i not in already_sent]
+
+        if self.leases is not None:
+            self.leases.claim(self.gmail, to_get)
+        with self.metrics.stage("get"):
+            messages, errors = self.gmail.get_messages(to_get)
+        if self.leases is not None:
+            won = self.leases.keep_won(self.gmail, messages)
+            self.metrics.count("lease_lost", len(messages) - len(won))
+            messages = won
+        self.metrics.count("listed", len(message_ids))
+        self.metrics.count("fetched", len(messages))
+        self.metrics.count("fetch_failed", len(errors))
+        for message_id, error in errors.items():
+            self.logger.error(
+                f"An error occurred trying to get message {message_id}:{error}"
+            )
+        self._outbox_mark([message.message_id for message in messages], Outbox.FETCHED)
+
+        sent = 0
+        send_errors = 0
+        if self.coalescer is not None:
+            for message in messages:
+                self._save_message(message)
+                route = self._route(message)
+                if route.drop:
+                    self._outbox_mark([message.message_id], Outbox.SENT)
+                    self.metrics.count("dropped")
+                    delivered.append(message.message_id)
+                elif self._lane(route) == "urgent":
+                    # Urgent mail doesn't wait for the digest
+                    try:
+                        self._process_message(message, route)
+                    except Exception as error:
+                        send_errors += 1
+                        self.logger.error(
+                            f"An error occurred trying to send message:{error}"
+                        )
+                        continue
+                    self._outbox_mark([message.message_id], Outbox.SENT)
+                    sent += 1
+                    delivered.append(message.message_id)
+                elif self._duplicate(message):
+                    self._outbox_mark([message.message_id], Outbox.SENT)
+                    delivered.append(message.message_id)
+                else:
+                    self.coalescer.add(message)
+            if self.coalescer.due():
+                digest_sent, digest_errors, digested = self._send_digests()
+                sent += digest_sent
+                send_errors += digest_errors
+                delivered.extend(digested)
+            self._delete_delivered(delivered)
+            return taken, send_errors, sent
+
+        # The most urgent ones go first
+        routes = {message.message_id: self._route(message) for message in messages}
+        messages.sort(key=lambda message: -routes[message.message_id].priority)
+        for message in messages:
+            self._save_message(message)
             try:
-                message = self.gmail.get_next_message()
+                self._process_message(message, routes[message.message_id])
+                self._outbox_mark([message.message_id], Outbox.SENT)
             except Exception as error:
-                error_count += 1
-                if error_count > 20:
-                    # If an error occurs, wait a while and try again
-                    error_string = (
-                        f"{error_count} errors occurred trying to get mail: {error}"
-                    )
-                    self.imessage.send_message(error_string)
-                    self.logger.error(error_string)
-                    ic(error_string)
-                    error_count = 0
+                send_errors += 1
+                error_string = f"An error occurred trying to send message:{error}"
+                self.logger.error(error_string)
                 continue
+            sent += 1
+            delivered.append(message.message_id)
 
-            if message:
-                if self.save_message_dir is not None:
-                    filename = (
-                        self.save_message_dir
-                        / f"{str(datetime.now().strftime('%Y%m%d%H%M%S'))}"
-                    )
-                    filename.write_bytes(pickle.dumps(message))
-
-                try:
-                    self._process_message(message)
-                except Exception as error:
-                    # If an error occurs, sleep for bit to see if it clears up,
-                    # but don't bother trying to resend it
-                    error_string = f"An error occurred trying to send message:{error}"
-
-                    # self.imessage.send_message(error_string)
-                    self.logger.error(error_string)
-                    ic(error_string)
-                    time.sleep(
-                        60 * 10
-                    )  # 10 minutes so I don't flood the texts overnight
-                    continue
-
-                try:
-                    # After we've successfully gotten and (hopefully) sent the
-                    # message, delete it
-                    self.gmail.delete_message(message.message_id)
-                except Exception as error:
-                    error_string = f"An error occurred trying to delete message:{error}"
-
-                    self.imessage.send_message(error_string)
-                    self.logger.error(error_string)
-                    ic(error_string)
-
-            time.sleep(10)
-
-    def test_messages(self):
-        files = [i for i in self.test_message_dir.iterdir() if i.is_file()]
-        for file in files:
-            message_bytes = file.read_bytes()
-            message: EmailMessage = pickle.loads(message_bytes)
-            self._process_message(message)
-
-    def _remove_unwanted_characters(self, text: str) -> str:
-        for unicode_char in ["\u200c", "&#847;", "&zwnj;", "&nbsp;"]:
-            text = text.replace(unicode_char, "")
-        return text
-
-    def _shorten_url(self, line: str) -> str:
-        # Do the URL shortening
-        match_result = self.http_match.match(line)
-        if match_result is not None:
-            results = []
-            if match_result.group(1) != "":
-                results.append(match_result.group(1))
-            results.append(match_result.group(2))
-            if match_result.group(3) != "":
-                results.append(match_result.group(3))
-            line = "".join(results)
-        return line
-
-    def _process_message(self, message: EmailMessage) -> EmailMessage:
-        # Massage message to the format I want
-        text = message.body
-        text = text.replace("\r\n", "\n")
-        text = self._remove_unwanted_characters(text)
-        new_text = []
-        for line in text.split("\n"):
-            line = line.strip()
-            if line != "":
-                line = self._shorten_url(line)
-                new_text.append(line)
-
-        text = "\n\n".join(new_text)
-
-        # Messages can be longer than I want on an iMessage, so shorten
-        # it to an appropriate length
-        if len(text) > self.message_length:  # Shorten the message to fit into a text
-            text = f"{text[:self.message_length]}\n\n........"
-
-        message_text = (
-            f"To: {message.to_email}\nSubject: " f"{message.subject}\n\n{text}"
+        self._delete_delivered(delivered)
+        self._release_undelivered(messages, delivered)
+        return taken, send_errors, sent
+
+    def _send_digests(self) -> (int, int, list):
+        """
+        Send the emails waiting in the coalescer as digests, or as a normal alert
+        if there is only one. Returns the number of emails sent, the number that
+        failed to send, and the ids of the ones sent.
+        """
+        messages = self.coalescer.take()
+        with self.metrics.stage("render"):
+            if len(messages) == 1:
+                digests = [(self._render_message(messages[0]), messages)]
+            else:
+                digests = render_digests(
+                    messages, self.digest_length, self.digest_summary_length
+                )
+
+        sent = 0
+        send_errors = 0
+        delivered = []
+        for digest, digested in digests:
+            message_ids = [message.message_id for message in digested]
+            try:
+                with self.metrics.stage("send"):
+                    self.imessage.send_message(digest)
+            except Exception as error:
+                # They stay in the mailbox and go in the next digest
+                self._not_sent(digested)
+                send_errors += len(digested)
+                self.metrics.error("send")
+                error_string = f"An error occurred trying to send digest:{error}"
+                self.logger.error(error_string)
+                continue
+            self._outbox_mark(message_ids, Outbox.SENT)
+            self.metrics.delivered(digested)
+            self.logger.info(f"Digest of {len(digested)} messages sent")
+            sent += len(digested)
+            delivered.extend(message_ids)
+        return sent, send_errors, delivered
+
+    def _delete_delivered(self, delivered: list):
+        """
+        Delete the messages that were sent, in one batchDelete
+        """
+        if not delivered:
+            return
+        try:
+            with self.metrics.stage("delete"):
+                self.gmail.delete_messages(delivered)
+            self._outbox_mark(delivered, Outbox.DELETED)
+            self.metrics.count("deleted", len(delivered))
+        except Exception as error:
+            if rate_limit_delay(error) is not None:
+                # They are deleted when they are listed again
+                self.logger.warning(f"Gmail asked us to wait with deleting:{error}")
+                return
+            self.metrics.error("delete")
+            error_string = f"An error occurred trying to delete messages:{error}"
+
+            self.imessage.send_message(error_string)
+            self.logger.error(error_string)
+
+    def _release_undelivered(self, messages: list, delivered: list):
+        """
+        Give up the lease on the messages that failed to send, so any worker can
+        try them again
+        """
+        if self.leases is None:
+            return
+        delivered = set(delivered)
+        undelivered = [
+            message.message_id
+            for message in messages
+            if message.message_id not in delivered
+        ]
+        try:
+            self.leases.release(self.gmail, undelivered)
+        except Exception as error:
+            # The lease runs out by itself
+            self.logger.error(f"An error occurred releasing messages:{error}")
+
+    def _already_sent(self, message_ids: list) -> set:
+        """
+        The ones of message_ids that the outbox says were already sent
+        """
+        if self.outbox is None:
+            return set()
+        return self.outbox.sent(message_ids)
+
+    def _outbox_mark(self, message_ids: list, state: str):
+        if self.outbox is not None:
+            self.outbox.mark(message_ids, state)
+
+    def _resume_outbox(self):
+        """
+        Delete the messages that were sent before the last restart, but never
+        deleted
+        """
+        if self.outbox is None:
+            return
+
+        # Don't let the outbox grow forever
+        self.outbox.prune(older_than=60 * 60 * 24 * 30)
+
+        message_ids = self.outbox.sent_not_deleted()
+        if not message_ids:
+            return
+        try:
+            self.gmail.delete_messages(message_ids)
+            self._outbox_mark(message_ids, Outbox.DELETED)
+            self.logger.info(f"Deleted {len(message_ids)} messages sent before restart")
+        except Exception as error:
+            # They will be deleted when they are listed again
+            self.logger.error(f"An error occurred trying to delete messages:{error}")
+
+    def _save_message(self, message: EmailMessage):
+        if self.archive is not None:
+            self.archive.append(message)
+
+    def test_messages(
+        self,
+        dry_run: bool = True,
+        processes: int = None,
+        since: datetime = None,
+        until: datetime = None,
+    ) -> dict:
+        """
+        Replay the messages saved in the test messages directory, rendering them
+        on a pool of processes, and print how long each stage took for each
+        message and in total. With dry_run they are not sent. From an archive,
+        only the messages saved from since up to until are replayed.
+        """
+        return replay_messages(
+            self.test_message_dir,
+            partial(render_message, message_length=self.message_length),
+            DryRunSender() if dry_run else self.imessage,
+            processes=processes,
+            start=None if since is None else since.timestamp(),
+            end=None if until is None else until.timestamp(),
         )
 
+    def _process_message(self, message: EmailMessage, route: Route = None):
+        if route is None:
+            route = self._route(message)
+        if route.drop:
+            self.metrics.count("dropped")
+            self.logger.info(
+                f"Message dropped by {route.rule or 'no rule'}: {message.subject}"
+            )
+            return
+        if self._duplicate(message):
+            return
+
+        with self.metrics.stage("render"):
+            message_text = self._render_message(message)
+
         # send the message
-        self.imessage.send_message(message_text)
+        lane = self._lane(route)
+        try:
+            with self.metrics.stage("send"):
+                send(
+                    self._sender_for(route.recipient),
+                    message_text,
+                    urgent=lane == "urgent",
+                )
+        except Exception:
+            self.metrics.error("send")
+            self._not_sent([message])
+            raise
+        self.metrics.delivered([message], lane)
         self.logger.info(f"Message sent to {message.to_email}: " f"{message.subject}")
+
+    def _duplicate(self, message: EmailMessage) -> bool:
+        """
+        Whether an alert was already sent for a copy of the email. If not, the
+        email counts as sent from now on, unless _not_sent says otherwise.
+        """
+        if self.dedup is None:
+            return False
+        duplicate = self.dedup.check(message)
+        self.metrics.dedup.inc(1, ("hit" if duplicate else "miss",))
+        if duplicate:
+            self.metrics.count("duplicate")
+            self.logger.info(f"Duplicate message not sent: {message.subject}")
+        return duplicate
+
+    def _not_sent(self, messages: list):
+        """
+        The alerts for the emails failed, so copies of them aren't duplicates
+        """
+        if self.dedup is not None:
+            for message in messages:
+                self.dedup.discard(message)
+
+    def _route(self, message: EmailMessage) -> Route:
+        """
+        Where the routing rules say the message goes
+        """
+        if self.rules is None:
+            return Route()
+        return self.rules.route(message)
+
+    def _lane(self, route: Route) -> str:
+        """
+        The priority lane of a message with the route, "urgent" or "normal"
+        """
+        if self.urgent_priority is not None and route.priority >= self.urgent_priority:
+            return "urgent"
+        return "normal"
+
+    def _sender_for(self, recipient: Optional[str]):
+        """
+        The sender for the recipient, the default one for None
+        """
+        if recipient is None:
+            return self.imessage
+        if recipient not in self._senders:
+            self._senders[recipient] = self.make_sender(recipient)
+        return self._senders[recipient]
+
+    def _render_message(self, message: EmailMessage) -> str:
+        """
+        Turn the email message into the text of the iMessage
+        """
+        return render_message(message, self.message_length)
+
+
+def render_message(message: EmailMessage, message_length: int) -> str:
+    """
+    Turn the email message into the text of an iMessage of about message_length
+    characters
+    """
+    # Massage message to the format I want. Messages can be longer than I want
+    # on an iMessage, so shorten it to an appropriate length, which also means
+    # the rest of the message doesn't need to be looked at.
+    text, truncated = normalize_text(message.body, message_length)
+    # Only the start of the body may have been retrieved, if it was that long
+    if truncated or message.truncated:
+        text = f"{text}\n\n........"
+
+    return f"To: {message.to_email}\nSubject: " f"{message.subject}\n\n{text}"
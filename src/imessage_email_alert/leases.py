@@ -0,0 +1,211 @@
+import hashlib
+import logging
+import re
+import time
+from typing import Callable, Optional
+
+
+class LabelLeases:
+    """
+    Let several instances share one mailbox without sending an alert twice. Each
+    worker claims the messages it is about to handle by putting its lease label
+    on them, a hidden gmail label named after the worker and the time the lease
+    runs out, like imessage-email-alert-lease/laptop-1234/1760000000.
+
+    The listed messages are split between the live workers, the ones with a
+    lease label that hasn't run out, by rendezvous hashing, so workers mostly
+    claim different messages. A worker that finds another live lease on a message
+    after claiming it backs off, which guarantees that two workers never both
+    keep a message, whatever order their claims and reads happen in. Leases that
+    ran out are deleted by whichever worker notices first, which takes them off
+    their messages, so the messages of a worker that died are picked up by the
+    others. The hosts' clocks should be within a few seconds of each other.
+    """
+
+    PREFIX = "imessage-email-alert-lease"
+    LABEL_PATTERN = re.compile(rf"^{PREFIX}/(?P<worker>[^/]+)/(?P<expires>\d+)$")
+
+    def __init__(
+        self,
+        worker_id: str,
+        lease_seconds: float = 5 * 60,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param worker_id: Names this worker, unique among the instances sharing the
+        mailbox
+        :param lease_seconds: How long a lease lasts. A worker takes a new lease
+        when half of it is left, so a claimed message is held for at least half
+        of this.
+        :param clock: Returns the time in seconds since the epoch, the same on every
+        host
+        """
+        if not worker_id or "/" in worker_id:
+            raise ValueError(f"Worker id {worker_id!r} can't be empty or contain /")
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self.logger = logging.getLogger("iMessageEmailAlert.leases")
+
+        # Every label of the mailbox by id, and the lease labels as (worker,
+        # expires) by id
+        self._labels: dict = {}
+        self._leases: dict = {}
+        self._label_id: Optional[str] = None
+        self._expires = 0
+        self._stale = True
+
+    @classmethod
+    def parse_label(cls, name: str) -> Optional[tuple]:
+        """
+        The worker and expiry time of a lease label, None for other labels
+        """
+        match = cls.LABEL_PATTERN.match(name)
+        if match is None:
+            return None
+        return match["worker"], int(match["expires"])
+
+    def workers(self) -> list:
+        """
+        The workers with a live lease, this one included
+        """
+        now = self.clock()
+        workers = {worker for worker, expires in self._leases.values() if expires > now}
+        workers.add(self.worker_id)
+        return sorted(workers)
+
+    def renew(self, gmail):
+        """
+        Take a new lease when half of the current one has run out, and delete the
+        leases that ran out. Only reads the labels when something changed.
+        """
+        now = self.clock()
+        if not self._stale and self._expires - now > self.lease_seconds / 2:
+            return
+        self._refresh(gmail)
+
+        if self._expires - now <= self.lease_seconds / 2:
+            expires = int(now + self.lease_seconds)
+            name = f"{self.PREFIX}/{self.worker_id}/{expires}"
+            try:
+                label = gmail.create_label(name)
+            except Exception:
+                # Another call of ours may have created it already
+                self._refresh(gmail)
+                label = next(
+                    (label for label in self._labels.values() if label["name"] == name),
+                    None,
+                )
+                if label is None:
+                    raise
+            self._add_label(label)
+            self._label_id = label["id"]
+            self._expires = expires
+
+        for label_id, (worker, expires) in list(self._leases.items()):
+            if expires <= now:
+                self._delete_label(gmail, label_id, worker)
+
+    def choose(self, message_ids: list, count: int) -> list:
+        """
+        The first count of the listed messages that fall to this worker
+        """
+        workers = self.workers()
+        return [
+            message_id
+            for message_id in message_ids
+            if _owner(workers, message_id) == self.worker_id
+        ][:count]
+
+    def claim(self, gmail, message_ids: list):
+        """
+        Put this worker's lease label on the messages
+        """
+        if message_ids:
+            gmail.modify_labels(message_ids, add=[self._label_id])
+
+    def keep_won(self, gmail, messages: list) -> list:
+        """
+        The claimed messages, as retrieved after claiming them, that this worker
+        holds alone. The lease on the others is given up.
+        """
+        if any(
+            label_id not in self._labels
+            for message in messages
+            for label_id in message.label_ids or []
+        ):
+            # A label we don't know about, most likely the lease of a new worker
+            self._refresh(gmail)
+
+        now = self.clock()
+        won = []
+        lost = []
+        for message in messages:
+            label_ids = message.label_ids or []
+            others = [
+                self._leases[label_id][0]
+                for label_id in label_ids
+                if label_id in self._leases
+                and self._leases[label_id][0] != self.worker_id
+                and self._leases[label_id][1] > now
+            ]
+            if others or self._label_id not in label_ids:
+                lost.append(message.message_id)
+                self.logger.debug(
+                    f"Message {message.message_id} is also claimed by "
+                    f"{', '.join(others) or 'nobody'}"
+                )
+            else:
+                won.append(message)
+        if lost:
+            # Read the labels again before the next poll, so we agree with the
+            # other workers on who is live
+            self._stale = True
+            self.release(gmail, lost)
+        return won
+
+    def release(self, gmail, message_ids: list):
+        """
+        Give up the lease on messages this worker won't handle now
+        """
+        if message_ids:
+            gmail.modify_labels(message_ids, remove=[self._label_id])
+
+    def _refresh(self, gmail):
+        self._labels = {}
+        self._leases = {}
+        for label in gmail.list_labels():
+            self._add_label(label)
+        self._stale = False
+
+    def _add_label(self, label: dict):
+        self._labels[label["id"]] = label
+        lease = self.parse_label(label["name"])
+        if lease is not None:
+            self._leases[label["id"]] = lease
+
+    def _delete_label(self, gmail, label_id: str, worker: str):
+        """
+        Delete a lease that ran out, which takes it off its messages
+        """
+        try:
+            gmail.delete_label(label_id)
+            self.logger.info(f"Deleted the expired lease of {worker}")
+        except Exception as error:
+            # Most likely another worker deleted it first
+            self.logger.debug(f"Could not delete the lease of {worker}:{error}")
+        self._labels.pop(label_id, None)
+        self._leases.pop(label_id, None)
+
+
+def _owner(workers: list, message_id: str) -> str:
+    """
+    The worker a message falls to, the same for every worker that knows the same
+    workers, and only moving the messages of a worker that comes or goes
+    """
+    return max(
+        workers,
+        key=lambda worker: hashlib.blake2b(
+            f"{worker}/{message_id}".encode(), digest_size=8
+        ).digest(),
+    )
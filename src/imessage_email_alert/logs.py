@@ -0,0 +1,206 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Callable, Optional
+
+LOG_FORMAT = "%(asctime)s [%(process)d] <%(name)s> %(message)s"
+DATE_FORMAT = "%Y-%m-%d %I:%M:%S %p"
+
+# The attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format each record as one line of JSON, with the fields passed with extra=
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created)
+            .astimezone()
+            .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The text format of the log file, saying how many repeats were dropped
+    """
+
+    def __init__(self):
+        super().__init__(LOG_FORMAT, datefmt=DATE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        if getattr(record, "repeated", 0):
+            text = f"{text} ({record.repeated} repeats dropped)"
+        return text
+
+
+class DuplicateFilter(logging.Filter):
+    """
+    Let the same message through at most once every window seconds. The copies
+    in between are dropped and counted, and the next one let through has the
+    count as its repeated attribute. Only records of level or above are
+    filtered, and up to max_messages different messages are remembered.
+    """
+
+    def __init__(
+        self,
+        window: float = 60,
+        level: int = logging.WARNING,
+        max_messages: int = 1000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__()
+        self.window = window
+        self.level = level
+        self.max_messages = max_messages
+        self.clock = clock
+        # The time each message was last let through and the copies dropped
+        # since, least recently let through first
+        self._seen: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        now = self.clock()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.window:
+                seen[1] += 1
+                return False
+            self._seen[key] = [now, 0]
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_messages:
+                self._seen.popitem(last=False)
+        if seen is not None and seen[1]:
+            record.repeated = seen[1]
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Put records on a bounded queue without ever waiting, dropping them if the
+    writer has fallen that far behind
+    """
+
+    def __init__(self, log_queue: queue.Queue, log_file: Optional[Path]):
+        super().__init__(log_queue)
+        self.log_file = log_file
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record stays in this process, so only the message is made now, in
+        # case its arguments change. Formatting is left to the writer thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AsyncLogWriter:
+    """
+    Write the records of a logger from a background thread, so a slow disk never
+    holds up the code that logs. Records wait in a bounded queue, and are
+    dropped rather than waited for if it fills up. The log file is JSON lines,
+    or text, and is rotated once it reaches max_bytes. Repeated warnings and
+    errors are let through once a minute.
+    """
+
+    def __init__(
+        self,
+        log_file: Optional[Path],
+        debug: bool = False,
+        json_format: bool = True,
+        max_bytes: int = 10 << 20,
+        backup_count: int = 5,
+        queue_size: int = 10000,
+        dedup_window: float = 60,
+    ):
+        """
+        :param log_file: The file to write, None for only the console
+        :param debug: Write the records to stdout too
+        :param json_format: Write the log file as JSON lines instead of text
+        :param max_bytes: Rotate the log file once it is this big
+        :param backup_count: The number of rotated log files to keep
+        :param queue_size: The number of records that can wait to be written
+        :param dedup_window: Seconds to drop repeats of the same warning or
+        error for
+        """
+        handlers = []
+        text_formatter = TextFormatter()
+        if log_file is not None:
+            file_handler = RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count
+            )
+            file_handler.setFormatter(
+                JsonFormatter() if json_format else text_formatter
+            )
+            handlers.append(file_handler)
+        if debug:
+            stdout_handler = logging.StreamHandler(sys.stdout)
+            stdout_handler.setFormatter(text_formatter)
+            handlers.append(stdout_handler)
+
+        self.handler = _DroppingQueueHandler(queue.Queue(queue_size), log_file)
+        self.handler.addFilter(DuplicateFilter(dedup_window))
+        self._listener = QueueListener(self.handler.queue, *handlers)
+        self._handlers = handlers
+        self._stopped = False
+
+    def start(self) -> "AsyncLogWriter":
+        self._listener.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """
+        Write the records that are waiting, and close the log file
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._listener.stop()
+        for handler in self._handlers:
+            handler.close()
+
+
+def attach_log_writer(logger: logging.Logger, log_file: Optional[Path], **kwargs):
+    """
+    Send the records of the logger to an AsyncLogWriter for the log file,
+    starting one unless the logger already has one. Several alerts in one
+    process share the logger, and so the writer.
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, _DroppingQueueHandler) and handler.log_file == log_file:
+            return
+    writer = AsyncLogWriter(log_file, **kwargs).start()
+    logger.addHandler(writer.handler)
@@ -0,0 +1,68 @@
+// Keeps running and sends every message it is given to one buddy, so that
+// osascript is started once instead of for every message.
+//
+// Run with: osascript -l JavaScript messageSender.js <buddy>
+//
+// Each message comes in on stdin as its length in bytes on a line, followed by
+// the UTF-8 bytes of the message. Each one is answered on stdout with a line of
+// "ok" or "error <reason>".
+
+ObjC.import("Foundation");
+
+function run(argv) {
+    const messages = Application("Messages");
+    const service = messages.services.whose({ serviceType: "iMessage" })[0];
+    const buddy = service.buddies.byName(argv[0]);
+
+    const input = $.NSFileHandle.fileHandleWithStandardInput;
+    const output = $.NSFileHandle.fileHandleWithStandardOutput;
+    const pending = $.NSMutableData.alloc.init;
+    const newline = $("\n").dataUsingEncoding($.NSUTF8StringEncoding);
+
+    // Read more of stdin, false once it is closed
+    function fill() {
+        const data = input.availableData;
+        if (data.length === 0) {
+            return false;
+        }
+        pending.appendData(data);
+        return true;
+    }
+
+    // Remove the first length bytes of what was read, and return them
+    function take(length) {
+        const data = pending.subdataWithRange($.NSMakeRange(0, length));
+        pending.replaceBytesInRangeWithBytesLength($.NSMakeRange(0, length), null, 0);
+        return ObjC.unwrap(
+            $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding)
+        );
+    }
+
+    function reply(line) {
+        output.writeData($(line + "\n").dataUsingEncoding($.NSUTF8StringEncoding));
+    }
+
+    while (true) {
+        let found = pending.rangeOfDataOptionsRange(newline, 0, $.NSMakeRange(0, pending.length));
+        while (found.location === $.NSNotFound) {
+            if (!fill()) {
+                return;
+            }
+            found = pending.rangeOfDataOptionsRange(newline, 0, $.NSMakeRange(0, pending.length));
+        }
+        const length = parseInt(take(found.location + 1), 10);
+        while (pending.length < length) {
+            if (!fill()) {
+                return;
+            }
+        }
+        const message = take(length);
+
+        try {
+            messages.send(message, { to: buddy });
+            reply("ok");
+        } catch (error) {
+            reply("error " + String(error).replace(/\n/g, " "));
+        }
+    }
+}
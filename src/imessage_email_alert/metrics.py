@@ -0,0 +1,415 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+# Seconds, from a fast gmail round trip to a slow osascript send
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Seconds from an email arriving to its alert, which includes waiting for polls
+# and digests
+DELIVERY_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class _Metric:
+    """
+    A metric family: one value per combination of label values
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def _labels(self, labels: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.label_names, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list:
+        """
+        The lines of the metric in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = {
+                labels: self._copy(value) for labels, value in self._values.items()
+            }
+        for labels, value in sorted(values.items()):
+            lines.extend(self._samples(labels, value))
+        return lines
+
+    def _copy(self, value):
+        return value
+
+    def _samples(self, labels: tuple, value) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A count that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: tuple = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self, labels: tuple, value) -> list:
+        return [f"{self.name}_total{self._labels(labels)} {value}"]
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, either set, or read from a function when the
+    metrics are rendered
+    """
+
+    kind = "gauge"
+
+    def set(self, value: float, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function: Callable[[], float], labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = function
+
+    def value(self, labels: tuple = ()) -> float:
+        with self._lock:
+            return self._copy(self._values.get(labels, 0))
+
+    def _copy(self, value):
+        return value() if callable(value) else value
+
+    def _samples(self, labels: tuple, value) -> list:
+        return [f"{self.name}{self._labels(labels)} {value}"]
+
+
+class Histogram(_Metric):
+    """
+    Counts of observations in fixed buckets, and their sum, which is all
+    Prometheus needs for percentiles. An observation is one bisect and three
+    additions, so it is cheap enough to time everything.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple = (),
+        buckets: tuple = STAGE_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: tuple = ()):
+        # Each value is the count in every bucket but the cumulative +Inf, then
+        # the sum
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, labels: tuple = ()) -> "_Timer":
+        """
+        A context manager that observes how long its block takes
+        """
+        return _Timer(self, labels)
+
+    def count(self, labels: tuple = ()) -> int:
+        counts = self._values.get(labels)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def sum(self, labels: tuple = ()) -> float:
+        counts = self._values.get(labels)
+        return 0 if counts is None else counts[-1]
+
+    def _copy(self, value):
+        return list(value)
+
+    def _samples(self, labels: tuple, value) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), value[:-1]):
+            cumulative += count
+            bucket_labels = self._labels(labels, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(labels)} {value[-1]}")
+        lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+
+
+class MetricsRegistry:
+    """
+    The metrics of a process, by name. Asking for a metric that already exists
+    returns it, so several accounts can share one registry.
+    """
+
+    def __init__(self):
+        self._metrics: dict = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, label_names: tuple = ()) -> Counter:
+        return self._get(Counter, name, help, label_names)
+
+    def gauge(self, name: str, help: str, label_names: tuple = ()) -> Gauge:
+        return self._get(Gauge, name, help, label_names)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple = (),
+        buckets: tuple = STAGE_BUCKETS,
+    ) -> Histogram:
+        return self._get(Histogram, name, help, label_names, buckets=buckets)
+
+    def _get(self, kind, name: str, help: str, label_names: tuple, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = kind(name, help, label_names, **kwargs)
+            elif not isinstance(metric, kind):
+                raise ValueError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def render(self) -> str:
+        """
+        All the metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path):
+        """
+        Write the metrics to a file, replacing it in one step so a reader never
+        sees half of it. The format suits the textfile collector of
+        node_exporter.
+        """
+        path = Path(path)
+        temporary = path.with_name(f".{path.name}.tmp")
+        temporary.write_text(self.render())
+        os.replace(temporary, path)
+
+
+class AlertMetrics:
+    """
+    The metrics of the alert loop: how long each step takes, how long it takes
+    from an email arriving in gmail to its alert being sent, and what happened
+    to the messages. The get step includes the decode and html steps, decoding the
+    message and extracting the text of its HTML.
+    """
+
+    STAGES = ("list", "get", "decode", "html", "render", "send", "delete")
+
+    # The longest each lane's alerts should take to be sent, in seconds after
+    # the email arrived
+    LANE_SLOS = {"urgent": 60, "normal": 15 * 60}
+
+    def __init__(self, registry: MetricsRegistry = None, lane_slos: dict = None):
+        """
+        :param registry: Where the metrics are kept, a new one by default
+        :param lane_slos: The delivery SLO of each lane in seconds, LANE_SLOS by
+        default
+        """
+        self.registry = MetricsRegistry() if registry is None else registry
+        self.lane_slos = dict(self.LANE_SLOS if lane_slos is None else lane_slos)
+        self.stage_seconds = self.registry.histogram(
+            "imessage_email_alert_stage_seconds",
+            "Seconds each step of handling the mail took",
+            ("stage",),
+        )
+        self.delivery_seconds = self.registry.histogram(
+            "imessage_email_alert_delivery_seconds",
+            "Seconds from an email arriving in gmail to its iMessage being sent",
+            buckets=DELIVERY_BUCKETS,
+        )
+        self.lane_delivery_seconds = self.registry.histogram(
+            "imessage_email_alert_lane_delivery_seconds",
+            "Seconds from an email arriving in gmail to its iMessage being sent, by "
+            "priority lane",
+            ("lane",),
+            buckets=DELIVERY_BUCKETS,
+        )
+        self.slo_misses = self.registry.counter(
+            "imessage_email_alert_slo_misses",
+            "Alerts sent later than the delivery SLO of their priority lane",
+            ("lane",),
+        )
+        self.messages = self.registry.counter(
+            "imessage_email_alert_messages",
+            "Messages by what happened to them",
+            ("outcome",),
+        )
+        self.errors = self.registry.counter(
+            "imessage_email_alert_errors",
+            "Errors by the step they happened in",
+            ("stage",),
+        )
+        self.dedup = self.registry.counter(
+            "imessage_email_alert_dedup_lookups",
+            "Lookups in the duplicate cache, a hit is an alert not sent",
+            ("result",),
+        )
+        self.quota_remaining = self.registry.gauge(
+            "imessage_email_alert_quota_remaining_units",
+            "Gmail quota units that can be spent right now",
+            ("account",),
+        )
+
+    def stage(self, stage: str) -> _Timer:
+        """
+        Time a step, one of STAGES
+        """
+        return self.stage_seconds.time((stage,))
+
+    def count(self, outcome: str, amount: int = 1):
+        if amount:
+            self.messages.inc(amount, (outcome,))
+
+    def error(self, stage: str):
+        self.errors.inc(1, (stage,))
+
+    def delivered(self, messages: list, lane: str = "normal"):
+        """
+        The messages were sent, so record how long ago they arrived, and whether
+        that was within the SLO of their priority lane
+        """
+        now = time.time()
+        slo = self.lane_slos.get(lane)
+        for message in messages:
+            if message.received is not None:
+                seconds = max(now - message.received, 0)
+                self.delivery_seconds.observe(seconds)
+                self.lane_delivery_seconds.observe(seconds, (lane,))
+                if slo is not None and seconds > slo:
+                    self.slo_misses.inc(1, (lane,))
+        self.count("sent", len(messages))
+
+
+def _metrics_handler(registry: MetricsRegistry):
+    # http.server pulls in http.client, ssl and email, so it is only imported
+    # when the metrics are served
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood stderr
+            pass
+
+    return MetricsHandler
+
+
+class MetricsServer:
+    """
+    Serve the metrics for Prometheus to scrape at /metrics, from a background
+    thread. Only listens on localhost unless told otherwise.
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "127.0.0.1"):
+        """
+        :param registry: The metrics to serve
+        :param port: The port to listen on, 0 for any free one
+        :param host: The address to listen on
+        """
+        from http.server import ThreadingHTTPServer
+
+        self.registry = registry
+        self._server = ThreadingHTTPServer((host, port), _metrics_handler(registry))
+        self._server.daemon_threads = True
+        self.server_address = self._server.server_address
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        )
+
+    def start(self) -> "MetricsServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class MetricsFileWriter:
+    """
+    Write the metrics to a file every interval seconds, from a background thread
+    """
+
+    def __init__(self, registry: MetricsRegistry, path: Path, interval: float = 60):
+        self.registry = registry
+        self.path = Path(path)
+        self.interval = interval
+        self.logger = logging.getLogger("iMessageEmailAlert.metrics")
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-file", daemon=True
+        )
+
+    def start(self) -> "MetricsFileWriter":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop, writing the metrics one last time
+        """
+        self._stop_event.set()
+        self._thread.join()
+        self._write()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        # A full disk or a missing directory shouldn't stop the metrics for good,
+        # the next write may work
+        try:
+            self.registry.write(self.path)
+        except OSError as error:
+            self.logger.error(f"An error occurred writing the metrics file:{error}")
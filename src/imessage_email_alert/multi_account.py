@@ -0,0 +1,245 @@
+import heapq
+import itertools
+import threading
+import time
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from .imessage_email_alert import iMessageEmailAlert
+from .metrics import AlertMetrics
+from .routing import RuleSet
+from .send_imessage import FanOutSender
+
+# The iMessageEmailAlert settings an account in the config file can have
+ACCOUNT_OPTIONS = {
+    "incremental_sync": bool,
+    "drain_size": int,
+    "lazy_body": bool,
+    "outbox": Path,
+    "poll_interval": float,
+    "idle_interval": float,
+    "digest_window": float,
+    "digest_count": int,
+    "digest_length": int,
+    "save_messages": Path,
+    "worker_id": str,
+    "lease_seconds": float,
+    "quota_units": float,
+    "dedup_window": float,
+    "dedup_size": int,
+    "dedup_file": Path,
+    "urgent_priority": int,
+    "rules": lambda rules_file: RuleSet.from_file(Path(rules_file).expanduser()),
+}
+
+
+@dataclass
+class AccountConfig:
+    """One gmail account, and the recipients of its alerts"""
+
+    name: str
+    credentials_file: Path
+    token_file: Path
+    recipients: list
+    options: dict = field(default_factory=dict)
+
+
+def load_accounts(config_file: Path) -> (list, dict):
+    """
+    Read the accounts from a TOML config file like
+
+        workers = 4
+
+        [[accounts]]
+        name = "personal"
+        credentials_file = "~/.config/imessage_email_alert/personal.json"
+        token_file = "~/.config/imessage_email_alert/personal-token.json"
+        recipients = ["+12125551212", "me@icloud.com"]
+        drain_size = 20
+
+    Returns the accounts, and the other top level settings.
+    """
+    with open(config_file, "rb") as file:
+        config = tomllib.load(file)
+
+    accounts = []
+    for number, account in enumerate(config.pop("accounts", []), start=1):
+        account = dict(account)
+        name = account.pop("name", f"account {number}")
+        try:
+            credentials_file = Path(account.pop("credentials_file")).expanduser()
+            token_file = Path(account.pop("token_file")).expanduser()
+            recipients = account.pop("recipients")
+        except KeyError as error:
+            raise ValueError(f"{config_file}: {name} has no {error.args[0]}")
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        if not recipients:
+            raise ValueError(f"{config_file}: {name} has no recipients")
+
+        unknown = set(account) - set(ACCOUNT_OPTIONS)
+        if unknown:
+            raise ValueError(
+                f"{config_file}: {name} has unknown settings {', '.join(unknown)}"
+            )
+        # The same quota budget as --quota-units gives a single account
+        options = {"quota_units": 200.0}
+        for key, value in account.items():
+            options[key] = ACCOUNT_OPTIONS[key](value)
+            if isinstance(options[key], Path):
+                options[key] = options[key].expanduser()
+        accounts.append(
+            AccountConfig(name, credentials_file, token_file, recipients, options)
+        )
+
+    if not accounts:
+        raise ValueError(f"{config_file}: no accounts")
+    return accounts, config
+
+
+class MultiAccountAlert:
+    """
+    Watch several gmail accounts in one process. Every account gets its own
+    iMessageEmailAlert, with its own gmail connection, poll schedule and circuit
+    breakers, but they share one pool of worker threads, the loggers, and one
+    sender per recipient. The account that has been due the longest is polled
+    first, and an account is never polled by two workers at once, so a busy
+    account can't starve the others.
+    """
+
+    def __init__(
+        self,
+        accounts: list,
+        make_sender: Callable[[str], object],
+        workers: int = 4,
+        log_dir: Path = None,
+        debug: bool = False,
+        clock: Callable[[], float] = time.monotonic,
+        metrics: AlertMetrics = None,
+        json_logs: bool = True,
+    ):
+        """
+        :param accounts: The AccountConfig of each account
+        :param make_sender: Makes the sender for a recipient
+        :param workers: The number of accounts that can be polled at the same time
+        :param log_dir: The location to store the logs
+        :param debug: Debug mode
+        :param clock: Returns the current time in seconds
+        :param metrics: The metrics all the accounts record to
+        :param json_logs: Write the log file as JSON lines instead of text
+        """
+        self.workers = workers
+        self.clock = clock
+        self.metrics = AlertMetrics() if metrics is None else metrics
+
+        senders = {}
+
+        def shared_sender(recipient: str):
+            if recipient not in senders:
+                senders[recipient] = make_sender(recipient)
+            return senders[recipient]
+
+        self.alerts: dict = {}
+        for account in accounts:
+            if len(account.recipients) == 1:
+                sender = shared_sender(account.recipients[0])
+            else:
+                sender = FanOutSender([shared_sender(r) for r in account.recipients])
+            self.alerts[account.name] = iMessageEmailAlert(
+                account.recipients[0],
+                credentials_file=account.credentials_file,
+                token_file=account.token_file,
+                log_dir=log_dir,
+                debug=debug,
+                json_logs=json_logs,
+                sender=sender,
+                make_sender=shared_sender,
+                metrics=self.metrics,
+                account=account.name,
+                **account.options,
+            )
+        # The sender of every recipient, shared by the accounts
+        self.senders = senders
+
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._started: set = set()
+
+    def stop(self):
+        """
+        Stop polling, once the polls that are running are done
+        """
+        self._stop_event.set()
+        self._wake.set()
+        for alert in self.alerts.values():
+            # Wake up an account that is waiting to reconnect
+            alert.stop()
+
+    def run(self):
+        """
+        Poll every account until stop() is called
+        """
+        order = itertools.count()
+        due = [(self.clock(), next(order), name) for name in self.alerts]
+        heapq.heapify(due)
+        running = {}
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="account") as pool:
+            while not self._stop_event.is_set():
+                self._wake.clear()
+
+                for name, future in list(running.items()):
+                    if future.done():
+                        del running[name]
+                        delay = self._next_delay(name, future)
+                        heapq.heappush(due, (self.clock() + delay, next(order), name))
+
+                while due and due[0][0] <= self.clock():
+                    _, _, name = heapq.heappop(due)
+                    future = pool.submit(self._poll, name)
+                    future.add_done_callback(lambda _: self._wake.set())
+                    running[name] = future
+
+                if any(future.done() for future in running.values()):
+                    continue
+                self._wake.wait(max(due[0][0] - self.clock(), 0) if due else None)
+
+        for alert in self.alerts.values():
+            alert.finish()
+
+    def _poll(self, name: str):
+        alert = self.alerts[name]
+        if name not in self._started:
+            try:
+                alert._open_gmail()
+            except Exception as error:
+                # The account backs off through its schedule, instead of holding
+                # the worker while it waits to connect again. It only texts on
+                # the first failure in a row, so the backoff doesn't flood texts.
+                error_string = f"An error occurred with authorization: {error}"
+                alert.logger.error(error_string)
+                first = not alert.scheduler.errors
+                alert.scheduler.record_error()
+                if first:
+                    alert.imessage.send_message(error_string)
+                return None
+            alert._resume_outbox()
+            self._started.add(name)
+        return alert.poll()
+
+    def _next_delay(self, name: str, future) -> float:
+        """
+        How long the account waits before its next poll
+        """
+        alert = self.alerts[name]
+        try:
+            max_delay = future.result()
+        except Exception as error:
+            alert.logger.error(f"An error occurred polling {name}:{error}")
+            alert.scheduler.record_error()
+            max_delay = None
+        delay = alert.scheduler.next_delay()
+        return delay if max_delay is None else min(delay, max_delay)
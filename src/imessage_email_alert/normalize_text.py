@@ -0,0 +1,50 @@
+import re
+
+# Characters and entities that show up in email bodies but mean nothing in an
+# iMessage
+_UNWANTED = ("\u200c", "&#847;", "&zwnj;", "&nbsp;")
+# The URLs in email messages have a lot of extraneous tracking stuff, so shorten
+# every URL to the part before the "?"
+_TRACKING_URL = re.compile(r"(https?://[^\s?]*)\?\S*")
+
+# Characters of text to clean at a time. Big enough that the regular expressions
+# do most of the work, small enough that little is wasted once the limit is hit.
+_BLOCK_SIZE = 4096
+
+
+def _url_base(match: re.Match) -> str:
+    return match.group(1)
+
+
+def normalize_text(text: str, limit: int = None) -> (str, bool):
+    """
+    Remove the unwanted characters, shorten the URLs, strip the lines, drop blank
+    lines and put a blank line between the others, going through the text once,
+    a block of lines at a time. Stops as soon as the result is longer than limit
+    characters. Returns the text, cut to limit characters, and whether it was cut.
+    """
+    lines = []
+    length = -2  # there is no separator before the first line
+    start = 0
+    end = len(text)
+    while start < end:
+        block_end = text.find("\n", start + _BLOCK_SIZE)
+        if block_end == -1:
+            block_end = end
+        block = text[start:block_end]
+        start = block_end + 1
+        for unwanted in _UNWANTED:
+            if unwanted in block:
+                block = block.replace(unwanted, "")
+        if "http" in block:
+            block = _TRACKING_URL.sub(_url_base, block)
+
+        for line in block.split("\n"):
+            line = line.strip()
+            if line:
+                lines.append(line)
+                length += len(line) + 2
+                if limit is not None and length > limit:
+                    return "\n\n".join(lines)[:limit], True
+
+    return "\n\n".join(lines), False
@@ -0,0 +1,129 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Outbox:
+    """
+    A local SQLite record of how far each gmail message got: fetched, sent, or
+    deleted. If the program dies, or the delete fails, after an alert was sent,
+    the outbox remembers that it was sent, so it is deleted and not sent again.
+    """
+
+    FETCHED = "fetched"
+    SENT = "sent"
+    DELETED = "deleted"
+
+    def __init__(self, path: Path):
+        """
+        :param path: The SQLite database file, created if it doesn't exist
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            str(path), isolation_level=None, check_same_thread=False
+        )
+        # WAL lets a write commit with one append to the log, and synchronous=NORMAL
+        # still survives a crash of the program
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        # The primary key is the index for looking up a message, and the state
+        # index finds the unfinished ones on restart
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " message_id TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " updated REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state)"
+        )
+
+    def mark(self, message_ids: list, state: str):
+        """
+        Record the new state of the messages, in one transaction. Fetching a
+        message doesn't undo it having been sent.
+        """
+        if not message_ids:
+            return
+        if state == self.FETCHED:
+            sql = (
+                "INSERT INTO outbox (message_id, state, updated) VALUES (?, ?, ?)"
+                " ON CONFLICT (message_id) DO NOTHING"
+            )
+        else:
+            sql = (
+                "INSERT INTO outbox (message_id, state, updated) VALUES (?, ?, ?)"
+                " ON CONFLICT (message_id) DO UPDATE"
+                " SET state = excluded.state, updated = excluded.updated"
+            )
+        now = time.time()
+        with self._lock:
+            with self._transaction():
+                self._connection.executemany(
+                    sql, [(message_id, state, now) for message_id in message_ids]
+                )
+
+    def state(self, message_id: str):
+        """
+        The state of the message, or None if we have never seen it
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM outbox WHERE message_id = ?", (message_id,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def sent(self, message_ids: list) -> set:
+        """
+        The ones of message_ids that were already sent, whether or not they were
+        deleted since
+        """
+        if not message_ids:
+            return set()
+        placeholders = ", ".join("?" for _ in message_ids)
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT message_id FROM outbox WHERE message_id IN ({placeholders})"
+                " AND state != ?",
+                (*message_ids, self.FETCHED),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def sent_not_deleted(self) -> list:
+        """
+        The messages that were sent but not deleted yet, oldest first
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT message_id FROM outbox WHERE state = ? ORDER BY updated",
+                (self.SENT,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def prune(self, older_than: float):
+        """
+        Forget the messages that were deleted more than older_than seconds ago
+        """
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM outbox WHERE state = ? AND updated < ?",
+                (self.DELETED, time.time() - older_than),
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        self._connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
@@ -0,0 +1,217 @@
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    import httplib2
+
+
+class Subscriber:
+    """
+    Where gmail push notifications come from. Each notification is a dict with
+    the emailAddress of the mailbox that changed and its new historyId.
+    """
+
+    def pull(self, timeout: float) -> list:
+        """
+        Wait up to timeout seconds for notifications, and return them, an empty
+        list if none came in
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalSubscriber(Subscriber):
+    """
+    A stand-in for a Pub/Sub subscription, for tests and benchmarks: whatever is
+    published to it is pulled, in order. FakeGmail publishes to it when a
+    watched mailbox changes.
+    """
+
+    def __init__(self):
+        self.published = 0
+        self._queue: queue.Queue = queue.Queue()
+
+    def publish(self, notification: dict):
+        self.published += 1
+        self._queue.put(notification)
+
+    def pull(self, timeout: float) -> list:
+        try:
+            notifications = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                notifications.append(self._queue.get_nowait())
+            except queue.Empty:
+                return notifications
+
+
+class PubSubSubscriber(Subscriber):
+    """
+    Pull the notifications gmail publishes to a Cloud Pub/Sub topic from a
+    subscription to it, with the Pub/Sub REST API, and acknowledge them
+    """
+
+    SCOPES = ["https://www.googleapis.com/auth/pubsub"]
+
+    def __init__(
+        self,
+        subscription: str,
+        credentials=None,
+        transport_factory: Callable[[], "httplib2.Http"] = None,
+        max_messages: int = 100,
+    ):
+        """
+        :param subscription: The subscription, like
+        projects/my-project/subscriptions/gmail
+        :param credentials: Credentials allowed to pull from the subscription, the
+        application default credentials by default
+        :param transport_factory: Creates the underlying http transport
+        :param max_messages: The most notifications to pull at once
+        """
+        self.subscription = subscription
+        self.credentials = credentials
+        self.transport_factory = transport_factory
+        self.max_messages = max_messages
+        self._service = None
+
+    def _get_service(self):
+        if self._service is None:
+            import google.auth
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.discovery import build_from_document
+            from googleapiclient.discovery_cache import get_static_doc
+
+            if self.credentials is None:
+                self.credentials, _ = google.auth.default(scopes=self.SCOPES)
+            # A pull waits on the server until there are messages
+            http = (
+                httplib2.Http(timeout=120)
+                if self.transport_factory is None
+                else self.transport_factory()
+            )
+            self._service = build_from_document(
+                get_static_doc("pubsub", "v1"),
+                http=AuthorizedHttp(self.credentials, http=http),
+            )
+        return self._service
+
+    def pull(self, timeout: float) -> list:
+        """
+        Pull the notifications waiting on the subscription. Pub/Sub holds the
+        request open until there are some, or it gives up, so timeout is not
+        used.
+        """
+        subscriptions = self._get_service().projects().subscriptions()
+        response = subscriptions.pull(
+            subscription=self.subscription, body={"maxMessages": self.max_messages}
+        ).execute()
+        received = response.get("receivedMessages", [])
+        if not received:
+            return []
+
+        subscriptions.acknowledge(
+            subscription=self.subscription,
+            body={"ackIds": [message["ackId"] for message in received]},
+        ).execute()
+        return [
+            json.loads(base64.b64decode(message["message"]["data"]))
+            for message in received
+        ]
+
+    def close(self):
+        if self._service is not None:
+            self._service._http.close()
+            self._service = None
+
+
+class MailboxWatcher:
+    """
+    Keep a gmail watch on the mailbox, which makes gmail publish a notification
+    to a Pub/Sub topic whenever the mailbox changes, and call on_change as soon
+    as one is pulled from the subscriber. The watch is renewed every
+    renew_interval seconds, as gmail stops watching after a week.
+    """
+
+    def __init__(
+        self,
+        gmail,
+        subscriber: Subscriber,
+        topic: str,
+        on_change: Callable[[], None],
+        label_ids: list = None,
+        renew_interval: float = 24 * 60 * 60,
+        pull_timeout: float = 1,
+        retry_interval: float = 30,
+    ):
+        """
+        :param gmail: The GetEmailMessage of the mailbox
+        :param subscriber: Where the notifications are pulled from
+        :param topic: The Pub/Sub topic gmail publishes to, like
+        projects/my-project/topics/gmail
+        :param on_change: Called from the watcher thread for every batch of
+        notifications
+        :param label_ids: Only notify about changes to messages with these labels,
+        INBOX by default
+        :param renew_interval: Seconds between renewing the watch
+        :param pull_timeout: The longest a pull waits, which is also how long
+        stopping can take
+        :param retry_interval: Seconds to wait after the watch or a pull failed
+        """
+        self.gmail = gmail
+        self.subscriber = subscriber
+        self.topic = topic
+        self.on_change = on_change
+        self.label_ids = ["INBOX"] if label_ids is None else label_ids
+        self.renew_interval = renew_interval
+        self.pull_timeout = pull_timeout
+        self.retry_interval = retry_interval
+        self.notifications = 0
+        self.logger = logging.getLogger("iMessageEmailAlert.push")
+
+        self._renew_at = 0.0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "MailboxWatcher":
+        self._thread = threading.Thread(target=self._run, name="watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            # A pull from Pub/Sub can take longer, and the thread is a daemon
+            self._thread.join(self.pull_timeout)
+            if self._thread.is_alive():
+                return
+            self._thread = None
+        self.subscriber.close()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                if time.monotonic() >= self._renew_at:
+                    response = self.gmail.watch(self.topic, self.label_ids)
+                    self._renew_at = time.monotonic() + self.renew_interval
+                    self.logger.info(
+                        f"Watching the mailbox from historyId {response['historyId']}"
+                    )
+                notifications = self.subscriber.pull(self.pull_timeout)
+            except Exception as error:
+                # The safety net poll finds the mail until this works again
+                self.logger.error(f"An error occurred watching the mailbox:{error}")
+                self._stop_event.wait(self.retry_interval)
+                continue
+            if notifications:
+                self.notifications += len(notifications)
+                self.on_change()
@@ -0,0 +1,207 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# The quota units each gmail method uses, from
+# https://developers.google.com/gmail/api/reference/quota
+METHOD_COSTS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.watch": 100,
+    "gmail.users.history.list": 2,
+    "gmail.users.labels.list": 1,
+    "gmail.users.labels.create": 5,
+    "gmail.users.labels.delete": 5,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.attachments.get": 5,
+    "gmail.users.messages.delete": 10,
+    "gmail.users.messages.batchDelete": 50,
+    "gmail.users.messages.batchModify": 50,
+}
+DEFAULT_COST = 5
+
+# Waiting calls are served highest priority first: getting new mail before
+# cleaning up the mail that was already sent
+FETCH = 1
+CLEANUP = 0
+METHOD_PRIORITIES = {
+    "gmail.users.messages.delete": CLEANUP,
+    "gmail.users.messages.batchDelete": CLEANUP,
+}
+
+
+def method_cost(method_id: str, count: int = 1) -> tuple:
+    """
+    The quota units and the priority of count calls of a gmail method
+    """
+    return (
+        METHOD_COSTS.get(method_id, DEFAULT_COST) * count,
+        METHOD_PRIORITIES.get(method_id, FETCH),
+    )
+
+
+def rate_limit_delay(error: Exception, default: float = 1) -> Optional[float]:
+    """
+    If the error is gmail saying we went over the quota, the seconds it asks us
+    to wait, default if it doesn't say. None for other errors.
+    """
+    response = getattr(error, "resp", None)
+    if response is None:
+        return None
+    status = getattr(response, "status", None)
+    content = getattr(error, "content", b"") or b""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    if status != 429 and not (
+        status == 403 and b"ratelimitexceeded" in content.lower()
+    ):
+        return None
+
+    retry_after = response.get("retry-after")
+    if retry_after is None:
+        return default
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    # Or an HTTP date
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+class QuotaBudget:
+    """
+    Spend the gmail quota of one user evenly, instead of running into its rate
+    limit and backing off. Every call waits until the units it uses fit in the
+    sliding window of the last window seconds, which holds units_per_second *
+    window units. Calls that have to wait are served highest priority first,
+    then in the order they came in. After gmail says the quota was exceeded,
+    nothing is spent until the time it asked us to wait has passed.
+    """
+
+    def __init__(
+        self,
+        units_per_second: float = 250,
+        window: float = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param units_per_second: The units to spend per second at most. Gmail
+        allows each user 250.
+        :param window: Seconds of spending to look back over. A longer window
+        allows bigger bursts.
+        :param clock: Returns the time in seconds
+        """
+        self.units_per_second = units_per_second
+        self.window = window
+        self.capacity = units_per_second * window
+        self.clock = clock
+        self.waited = 0.0
+
+        self._spent: deque = deque()
+        self._used = 0.0
+        self._paused_until = 0.0
+        self._waiting: list = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, units: float, priority: int = FETCH) -> list:
+        """
+        Wait until the units can be spent, and spend them. A call that uses more
+        than the whole window still goes, once nothing else was spent. Returns
+        what was spent, to pass to settle.
+        """
+        started = self.clock()
+        ticket = (-priority, next(self._order))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = self.clock()
+                    self._expire(now)
+                    delay = None
+                    if self._waiting[0] == ticket:
+                        delay = self._time_until_free(units, now)
+                        if delay <= 0:
+                            break
+                    # Woken up early when a call with a higher priority comes in,
+                    # or the one in front of us is done
+                    self._condition.wait(delay)
+                spending = [now, units]
+                self._spent.append(spending)
+                self._used += units
+                self.waited += now - started
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+        return spending
+
+    def settle(self, spending: list):
+        """
+        Count the spending from when the call finished. Gmail counts it somewhere
+        between the call starting and finishing, so this keeps it in our window
+        at least as long as in gmail's.
+        """
+        with self._condition:
+            spending[0] = max(spending[0], self.clock())
+
+    @contextmanager
+    def spend(self, units: float, priority: int = FETCH):
+        """
+        A context manager that spends the units on the call in its block
+        """
+        spending = self.acquire(units, priority)
+        try:
+            yield
+        finally:
+            self.settle(spending)
+
+    def pause(self, seconds: float):
+        """
+        Spend nothing for the next seconds, because gmail asked us to wait
+        """
+        with self._condition:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+            self._condition.notify_all()
+
+    def remaining(self) -> float:
+        """
+        The units that can be spent right now
+        """
+        with self._condition:
+            now = self.clock()
+            if now < self._paused_until:
+                return 0
+            self._expire(now)
+            return max(self.capacity - self._used, 0)
+
+    def _expire(self, now: float):
+        # Settled calls can be newer than the ones after them, which then wait
+        # for them, erring on the side of spending too little
+        while self._spent and self._spent[0][0] <= now - self.window:
+            self._used -= self._spent.popleft()[1]
+
+    def _time_until_free(self, units: float, now: float) -> float:
+        if now < self._paused_until:
+            return self._paused_until - now
+        excess = self._used + min(units, self.capacity) - self.capacity
+        if excess <= 0:
+            return 0
+        # The oldest spending leaves the window first
+        freed = 0
+        latest = now - self.window
+        for spent_at, spent in self._spent:
+            freed += spent
+            latest = max(latest, spent_at)
+            if freed >= excess:
+                break
+        return latest + self.window - now
@@ -0,0 +1,176 @@
+import os
+import pickle
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Iterator
+
+from .archive import MessageArchive, SegmentReader
+from .email_message import EmailMessage
+
+STAGES = ("load", "render", "send")
+
+# The segments each pool process has mapped
+_segment_reader = None
+
+
+class DryRunSender:
+    """
+    A sender that doesn't send anything, for replaying saved messages
+    """
+
+    def __init__(self):
+        self.sends = 0
+
+    def send_message(self, message: str) -> None:
+        self.sends += 1
+
+
+def saved_message_files(directory: Path) -> Iterator[str]:
+    """
+    The files in the directory, as they are found, without listing the whole
+    directory first
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.path
+
+
+def replay_file(path: str, render: Callable[[EmailMessage], str]) -> tuple:
+    """
+    Unpickle and render one message saved in its own file. Returns the name of
+    the message, the text of the iMessage, the seconds each stage took, and the
+    error if there was one.
+    """
+    return _replay(
+        os.path.basename(path), lambda: pickle.loads(Path(path).read_bytes()), render
+    )
+
+
+def replay_record(
+    segment: Path, offset: int, name: str, render: Callable[[EmailMessage], str]
+) -> tuple:
+    """
+    Read one message out of an archive segment and render it, like replay_file
+    """
+    global _segment_reader
+    if _segment_reader is None:
+        _segment_reader = SegmentReader()
+    return _replay(name, lambda: _segment_reader.read(segment, offset), render)
+
+
+def _replay_tasks(directory: Path, start: float, end: float) -> Iterator[tuple]:
+    """
+    The function that replays each saved message, and its arguments
+    """
+    if not MessageArchive.exists(directory):
+        for path in saved_message_files(directory):
+            yield replay_file, path
+        return
+    for segment, offset, _, message_id in MessageArchive(directory).locate(start, end):
+        yield replay_record, segment, offset, message_id or f"{segment.name}:{offset}"
+
+
+def _replay(name: str, load: Callable[[], EmailMessage], render) -> tuple:
+    timings = {}
+    try:
+        start = time.perf_counter()
+        message = load()
+        loaded = time.perf_counter()
+        text = render(message)
+        rendered = time.perf_counter()
+    except Exception as error:
+        return name, None, timings, f"{type(error).__name__}: {error}"
+    timings["load"] = loaded - start
+    timings["render"] = rendered - loaded
+    return name, text, timings, None
+
+
+def replay_messages(
+    directory: Path,
+    render: Callable[[EmailMessage], str],
+    sender,
+    processes: int = None,
+    output: Callable[[str], None] = print,
+    start: float = None,
+    end: float = None,
+) -> dict:
+    """
+    Render every message saved in the directory on a pool of processes, and send
+    them in order. The directory is a MessageArchive, or has one pickled message
+    per file, like --save-messages used to save them. Prints how long each stage
+    took for every message, then the totals. Returns the number of messages, the
+    errors, the seconds it took, and the seconds each stage took for every
+    message.
+
+    :param render: Turns an EmailMessage into the text of the iMessage. It is
+    run in the pool, so it has to be picklable.
+    :param sender: Sends the iMessages, with a send_message(text) method
+    :param processes: The size of the pool, the number of CPUs by default
+    :param output: Where the report goes
+    :param start: Only the messages archived at this timestamp or later
+    :param end: Only the messages archived before this timestamp
+    """
+    processes = processes or os.cpu_count() or 1
+    timings = {stage: [] for stage in STAGES}
+    errors = 0
+    started = time.perf_counter()
+
+    # multiprocessing is only imported when messages are replayed
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(processes) as pool:
+        tasks = _replay_tasks(directory, start, end)
+        # Keep a few messages per process in flight, so a big archive is never
+        # read into memory all at once
+        in_flight = deque()
+        while True:
+            for function, *args in tasks:
+                in_flight.append(pool.submit(function, *args, render))
+                if len(in_flight) >= processes * 4:
+                    break
+            if not in_flight:
+                break
+
+            name, text, message_timings, error = in_flight.popleft().result()
+            if error is not None:
+                errors += 1
+                output(f"{name}: {error}")
+                continue
+
+            send_started = time.perf_counter()
+            try:
+                sender.send_message(text)
+            except Exception as error:
+                errors += 1
+                output(f"{name}: send failed: {error}")
+                continue
+            message_timings["send"] = time.perf_counter() - send_started
+
+            for stage in STAGES:
+                timings[stage].append(message_timings[stage])
+            output(
+                f"{name}: "
+                + ", ".join(
+                    f"{stage} {message_timings[stage] * 1000:.2f}ms" for stage in STAGES
+                )
+                + f", {len(text)} characters"
+            )
+
+    elapsed = time.perf_counter() - started
+    count = len(timings["send"])
+    output(
+        f"Replayed {count} messages with {errors} errors in {elapsed:.2f}s, "
+        f"{count / elapsed if elapsed else 0:.1f} messages/s on {processes} processes"
+    )
+    for stage in STAGES:
+        values = sorted(timings[stage])
+        if values:
+            output(
+                f"  {stage:>8}: total {sum(values):.3f}s, "
+                f"mean {sum(values) / len(values) * 1000:.2f}ms, "
+                f"p50 {values[len(values) // 2] * 1000:.2f}ms, "
+                f"p99 {values[min(len(values) * 99 // 100, len(values) - 1)] * 1000:.2f}ms"
+            )
+    return {"messages": count, "errors": errors, "seconds": elapsed, "timings": timings}
@@ -0,0 +1,266 @@
+import tomllib
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .email_message import EmailMessage
+
+
+@dataclass
+class Route:
+    """Where a message goes: who gets it, how urgent it is, or that it is dropped"""
+
+    recipient: Optional[str] = None
+    priority: int = 0
+    drop: bool = False
+    rule: Optional[str] = None
+
+
+@dataclass
+class Rule:
+    """
+    A routing rule. It matches a message when the From header contains one of
+    senders, the subject contains one of subjects, the body contains one of
+    keywords, ignoring case, and the message has one of the gmail label ids in
+    labels. Conditions that are left empty always match.
+    """
+
+    name: str
+    senders: list = field(default_factory=list)
+    subjects: list = field(default_factory=list)
+    keywords: list = field(default_factory=list)
+    labels: list = field(default_factory=list)
+    # The gmail search that finds at least the mail this rule matches
+    query: Optional[str] = None
+    recipient: Optional[str] = None
+    priority: int = 0
+    drop: bool = False
+
+    def gmail_query(self) -> Optional[str]:
+        """
+        A gmail search for at least the mail this rule matches, or None if gmail
+        can't narrow it down. Without a query, one can only be made from senders
+        that are whole addresses or domains, which is how gmail matches from:.
+        """
+        if self.query is not None:
+            return self.query
+        if self.senders and all(
+            ("@" in sender or "." in sender) and " " not in sender
+            for sender in self.senders
+        ):
+            return "from:(" + " OR ".join(self.senders) + ")"
+        return None
+
+
+class _Matcher:
+    """
+    An Aho-Corasick automaton over many patterns, which finds every pattern in a
+    text in one pass over it, however many patterns there are
+    """
+
+    def __init__(self, patterns: dict):
+        """
+        :param patterns: The rules to report for each pattern, by pattern
+        """
+        self._goto: list = [{}]
+        self._fail: list = [0]
+        self._output: list = [frozenset()]
+
+        for pattern, rules in patterns.items():
+            state = 0
+            for character in pattern:
+                next_state = self._goto[state].get(character)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][character] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(frozenset())
+                state = next_state
+            self._output[state] |= frozenset(rules)
+
+        # Breadth first, so the fail state of each state is done before its
+        # children need it
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and character not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(character, 0)
+                self._output[next_state] |= self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> set:
+        """
+        The rules of all the patterns that are in the text
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        found = set()
+        if len(goto) == 1:
+            # No patterns
+            return found
+        state = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+class RuleSet:
+    """
+    Routing rules, compiled two ways. The part gmail can do becomes a search
+    query and label ids, so mail that no rule would send is never listed. The
+    rest runs locally on every message, with one Aho-Corasick matcher per header
+    so the time it takes doesn't grow with the number of rules.
+
+    The matching rule with the highest priority decides the route, the first one
+    if they tie. Mail that no rule matches is sent to the default recipient, or
+    dropped if unmatched is "drop".
+    """
+
+    # Only look for keywords in this much of the body
+    BODY_SCAN_LIMIT = 64 * 1024
+
+    def __init__(
+        self, rules: Iterable[Rule], unmatched: str = "send", label_ids: list = None
+    ):
+        """
+        :param rules: The rules, in order
+        :param unmatched: What to do with mail that no rule matches, "send" or
+        "drop"
+        :param label_ids: Only list the mail with all of these labels
+        """
+        if unmatched not in ("send", "drop"):
+            raise ValueError(f"unmatched is 'send' or 'drop', not '{unmatched}'")
+        self.rules = list(rules)
+        self.unmatched = unmatched
+        self.label_ids = label_ids or None
+
+        self._matchers = {}
+        self._conditions = []
+        self._always = set()
+        for header in ("senders", "subjects", "keywords"):
+            patterns = {}
+            for number, rule in enumerate(self.rules):
+                for pattern in getattr(rule, header):
+                    if pattern:
+                        patterns.setdefault(pattern.lower(), set()).add(number)
+            self._matchers[header] = _Matcher(patterns)
+        # Label ids are matched whole, not searched for
+        self._labels: dict = {}
+        for number, rule in enumerate(self.rules):
+            for label_id in rule.labels:
+                self._labels.setdefault(label_id, set()).add(number)
+        for number, rule in enumerate(self.rules):
+            conditions = {
+                header
+                for header in ("senders", "subjects", "keywords", "labels")
+                if getattr(rule, header)
+            }
+            self._conditions.append(conditions)
+            if not conditions:
+                self._always.add(number)
+
+    @classmethod
+    def from_file(cls, rules_file: Path) -> "RuleSet":
+        """
+        Read the rules from a TOML file like
+
+            unmatched = "drop"
+            label_ids = ["INBOX"]
+
+            [[rules]]
+            name = "bank"
+            senders = ["alerts@bank.example.com"]
+            recipient = "+12125551212"
+            priority = 10
+
+            [[rules]]
+            name = "starred"
+            labels = ["STARRED"]
+            priority = 5
+
+            [[rules]]
+            name = "newsletters"
+            subjects = ["newsletter", "unsubscribe"]
+            drop = true
+        """
+        with open(rules_file, "rb") as file:
+            config = tomllib.load(file)
+        rules = []
+        for number, rule in enumerate(config.get("rules", []), start=1):
+            rule = dict(rule)
+            rule.setdefault("name", f"rule {number}")
+            try:
+                rules.append(Rule(**rule))
+            except TypeError as error:
+                raise ValueError(f"{rules_file}: {rule['name']}: {error}")
+        return cls(
+            rules,
+            unmatched=config.get("unmatched", "send"),
+            label_ids=config.get("label_ids"),
+        )
+
+    def gmail_query(self) -> Optional[str]:
+        """
+        A gmail search that lists at least all the mail that would be sent, or
+        None if everything has to be listed
+        """
+        if self.unmatched != "drop":
+            return None
+        queries = []
+        for rule in self.rules:
+            if rule.drop:
+                continue
+            query = rule.gmail_query()
+            if query is None:
+                return None
+            queries.append(query)
+        if not queries:
+            # Everything is dropped, but it still has to be listed to be deleted
+            return None
+        if len(queries) == 1:
+            return queries[0]
+        return " OR ".join(f"({query})" for query in queries)
+
+    def route(self, message: EmailMessage) -> Route:
+        """
+        Decide where the message goes
+        """
+        # Headers that are missing from the email are None
+        body = message.body or ""
+        hits = {
+            "senders": self._matchers["senders"].search(
+                (message.from_email or "").lower()
+            ),
+            "subjects": self._matchers["subjects"].search(
+                (message.subject or "").lower()
+            ),
+            "keywords": self._matchers["keywords"].search(
+                body[: self.BODY_SCAN_LIMIT].lower()
+            ),
+            "labels": set(),
+        }
+        for label_id in message.label_ids or ():
+            hits["labels"] |= self._labels.get(label_id, set())
+        candidates = set(self._always)
+        for rules in hits.values():
+            candidates |= rules
+
+        matched = [
+            number
+            for number in candidates
+            if all(number in hits[header] for header in self._conditions[number])
+        ]
+        if not matched:
+            return Route(drop=self.unmatched == "drop")
+        rule = self.rules[min(matched, key=lambda n: (-self.rules[n].priority, n))]
+        return Route(rule.recipient, rule.priority, rule.drop, rule.name)
@@ -0,0 +1,248 @@
+import random
+import threading
+import time
+from typing import Callable
+
+
+class CircuitBreaker:
+    """
+    Stop calling a dependency that keeps failing. After failure_threshold failures
+    in a row the breaker opens, and calls are not allowed for reset_timeout
+    seconds. Then it is half open: one call is allowed, and if it works the
+    breaker closes again, if it fails the breaker opens again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.failures = 0
+        self._opened_at = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if self.clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self) -> bool:
+        """
+        Whether the dependency should be called now
+        """
+        return self.state != self.OPEN
+
+    def retry_in(self) -> float:
+        """
+        Seconds until a call is allowed again, 0 if it is allowed now
+        """
+        if self.state != self.OPEN:
+            return 0
+        return self._opened_at + self.reset_timeout - self.clock()
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = self.clock()
+
+
+class TokenBucket:
+    """
+    Let things happen at rate per second on average, with bursts of up to burst
+    at a time. Each one takes a token, and the bucket refills at rate tokens per
+    second up to burst tokens.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = 1,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """
+        :param rate: Tokens added per second
+        :param burst: The most tokens the bucket holds
+        :param clock: Returns the current time in seconds
+        :param sleep: Waits for a number of seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+
+        self.tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """
+        Take a token if there is one and return 0, otherwise return the number of
+        seconds until there will be one
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(
+                self.tokens + (now - self._updated) * self.rate, self.burst
+            )
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> float:
+        """
+        Wait for a token and take it, returning the number of seconds waited
+        """
+        waited = 0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            self.sleep(delay)
+            waited += delay
+
+
+class PollScheduler:
+    """
+    Decide how long to wait before the next poll. While mail is coming in, poll
+    every active_interval seconds. Every poll that finds nothing doubles the
+    interval, up to idle_interval. Errors back off exponentially with jitter, up
+    to max_backoff, and nothing is polled while a circuit breaker is open.
+    """
+
+    # The idle interval grows from at least this many seconds, so an
+    # active_interval of 0 doesn't poll an empty mailbox nonstop
+    MIN_IDLE_STEP = 0.5
+
+    def __init__(
+        self,
+        active_interval: float = 2,
+        idle_interval: float = 30,
+        base_backoff: float = 1,
+        max_backoff: float = 60 * 10,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = None,
+        random_number: Callable[[], float] = random.random,
+    ):
+        """
+        :param active_interval: Seconds between polls while there is mail
+        :param idle_interval: The longest time between polls when there is no mail
+        :param base_backoff: Seconds to wait after the first error
+        :param max_backoff: The longest time to wait after errors
+        :param clock: Returns the current time in seconds
+        :param sleep: Waits for a number of seconds, by default until the time is
+        up or stop() or wake() is called
+        :param random_number: Returns a random number between 0 and 1, for jitter
+        """
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.random_number = random_number
+
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self.sleep = self._sleep if sleep is None else sleep
+
+        self.interval = active_interval
+        self.errors = 0
+        self._more = False
+
+        # The dependencies that get a circuit breaker
+        self.breakers = {
+            "gmail": CircuitBreaker("gmail", 5, 60, clock=clock),
+            "sender": CircuitBreaker("sender", 3, 60 * 10, clock=clock),
+        }
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def stop(self):
+        """
+        Wake up a waiting poll loop and tell it to stop
+        """
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def wake(self):
+        """
+        Cut the wait short and poll now, because there is new mail
+        """
+        self._wake_event.set()
+
+    def _sleep(self, seconds: float):
+        if self.stopped:
+            return
+        self._wake_event.wait(seconds)
+        # The mail of a wake that came in until now is found by the poll that
+        # follows, one that comes in during that poll cuts the next wait short
+        self._wake_event.clear()
+
+    def record_poll(self, found: int, more: bool = False):
+        """
+        A poll worked, and found this many messages. If there are more waiting,
+        the next poll is right away.
+        """
+        self.errors = 0
+        self._more = more
+        if found:
+            self.interval = self.active_interval
+        else:
+            self.interval = min(
+                max(self.interval * 2, self.MIN_IDLE_STEP), self.idle_interval
+            )
+
+    def record_error(self):
+        self.errors += 1
+        self._more = False
+
+    def next_delay(self) -> float:
+        """
+        Seconds to wait before the next poll
+        """
+        if self.errors:
+            backoff = min(self.base_backoff * 2 ** (self.errors - 1), self.max_backoff)
+            # "Equal jitter": at least half the backoff, so retries from several
+            # instances spread out without ever retrying right away
+            delay = backoff / 2 + backoff / 2 * self.random_number()
+        elif self._more:
+            delay = 0
+        else:
+            delay = self.interval
+
+        for breaker in self.breakers.values():
+            delay = max(delay, breaker.retry_in())
+        return delay
+
+    def wait(self, max_delay: float = None) -> float:
+        """
+        Wait until the next poll, but no longer than max_delay seconds, returning
+        the number of seconds waited
+        """
+        delay = self.next_delay()
+        if max_delay is not None:
+            delay = min(delay, max_delay)
+        if delay > 0:
+            self.sleep(delay)
+        return delay
@@ -1,6 +1,37 @@
+import itertools
+import logging
 import os
+import queue
+import select
 import sys
 import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable
+
+from .scheduler import TokenBucket
+
+# The order queued messages are sent in, and the end of the queue
+_URGENT = 0
+_NORMAL = 1
+_CLOSE = 2
+
+
+class SendError(Exception):
+    """A message could not be sent"""
+
+
+def send(sender, message: str, urgent: bool = False) -> None:
+    """
+    Send the message with the sender. An urgent message goes ahead of the ones
+    waiting to be sent, if the sender has a send_urgent method.
+    """
+    if urgent and hasattr(sender, "send_urgent"):
+        sender.send_urgent(message)
+    else:
+        sender.send_message(message)
 
 
 class SendImessage:
@@ -8,13 +39,15 @@ class SendImessage:
     Using applescript on a local machine running messages, send a message
     """
 
-    def __init__(self, buddy: str) -> None:
+    def __init__(self, buddy: str, timeout: float = 60) -> None:
         """
         Buddy can be either a phone number with countrycode (eg +12125551212) or an
-        email address registered with iMessage
+        email address registered with iMessage. A send that takes longer than
+        timeout seconds is killed.
         """
 
         self.buddy = buddy
+        self.timeout = timeout
         self.applescript_file = os.path.join(
             os.path.dirname(sys.modules[__name__].__file__), "messageTexter.applescript"
         )
@@ -30,5 +63,325 @@ class SendImessage:
                 self.applescript_file,
                 self.buddy,
                 message,
+            ],
+            timeout=self.timeout,
+        )
+
+
+class FanOutSender:
+    """
+    Send every message to several recipients, each with its own sender
+    """
+
+    def __init__(self, senders: list):
+        """
+        :param senders: The senders for the recipients, with a send_message(text)
+        method
+        """
+        self.senders = senders
+        self.logger = logging.getLogger("iMessageEmailAlert.sender")
+
+    def send_message(self, message: str) -> None:
+        """
+        Send the message to every recipient. Raises SendError only if it couldn't
+        be sent to any of them, so the ones that got it don't get it again.
+        """
+        self._send_all(message, urgent=False)
+
+    def send_urgent(self, message: str) -> None:
+        """
+        Send the message to every recipient, ahead of the messages waiting to be
+        sent to them
+        """
+        self._send_all(message, urgent=True)
+
+    def _send_all(self, message: str, urgent: bool):
+        errors = []
+        for sender in self.senders:
+            try:
+                send(sender, message, urgent)
+            except Exception as error:
+                errors.append(error)
+                self.logger.error(
+                    f"An error occurred sending to {getattr(sender, 'buddy', sender)}:"
+                    f"{error}"
+                )
+        if errors and len(errors) == len(self.senders):
+            raise SendError(f"The message could not be sent to anyone: {errors[0]}")
+
+
+class SendStats:
+    """
+    Count the sends, and keep the latencies of the most recent ones for the
+    percentiles
+    """
+
+    def __init__(self, window: int = 1000, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.sends = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=window)
+        self._started = clock()
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, ok: bool = True):
+        with self._lock:
+            if ok:
+                self.sends += 1
+            else:
+                self.failures += 1
+            self.latencies.append(seconds)
+
+    def percentile(self, percent: float) -> float:
+        """
+        The latency that percent of the recent sends were faster than, 0 if there
+        were none
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return 0
+        index = min(int(len(latencies) * percent / 100), len(latencies) - 1)
+        return latencies[index]
+
+    def summary(self) -> dict:
+        elapsed = self.clock() - self._started
+        return {
+            "sends": self.sends,
+            "failures": self.failures,
+            "sends_per_second": self.sends / elapsed if elapsed > 0 else 0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class PersistentSender:
+    """
+    Send iMessages through one long lived helper process, instead of starting
+    osascript for every message. Messages wait in a bounded queue and a worker
+    thread sends them in order, no faster than the rate limiter allows. Urgent
+    messages go ahead of the queue and don't wait for the rate limiter. A send
+    that takes longer than timeout seconds fails, and the helper is restarted.
+
+    The helper is given the buddy as its last argument. It reads each message as
+    its length in bytes on a line followed by the UTF-8 bytes of the message, and
+    answers each one with a line of "ok" or "error <reason>".
+    """
+
+    def __init__(
+        self,
+        buddy: str,
+        command: list = None,
+        timeout: float = 30,
+        rate: float = 1,
+        burst: float = 10,
+        queue_size: int = 100,
+        report_interval: float = 60 * 10,
+    ):
+        """
+        :param buddy: The phone number or email address of the recipient
+        :param command: The helper command, osascript running
+        messageSender.js by default
+        :param timeout: Seconds to wait for the helper to send a message
+        :param rate: The average number of messages to send per second
+        :param burst: The number of messages that can be sent at once
+        :param queue_size: The number of messages that can wait to be sent, not
+        counting urgent ones
+        :param report_interval: Seconds between logging the send statistics
+        """
+        self.buddy = buddy
+        if command is None:
+            command = [
+                "osascript",
+                "-l",
+                "JavaScript",
+                os.path.join(
+                    os.path.dirname(sys.modules[__name__].__file__), "messageSender.js"
+                ),
             ]
+        self.command = list(command) + [buddy]
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.report_interval = report_interval
+        self.stats = SendStats()
+        self.logger = logging.getLogger("iMessageEmailAlert.sender")
+
+        # Waiting messages, urgent ones first, then in the order they came in
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._urgent = threading.Event()
+        self._helper = None
+        self._buffer = b""
+        self._worker = None
+        self._lock = threading.Lock()
+        self._reported = time.monotonic()
+
+    def send_message(self, message: str) -> None:
+        """
+        Queue the message and wait for it to be sent. Raises SendError if the
+        queue stays full, or the message could not be sent.
+        """
+        self._start_worker()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise SendError("The send queue is full")
+        future = Future()
+        self._queue.put((_NORMAL, next(self._order), message, future))
+        future.result()
+
+    def send_urgent(self, message: str) -> None:
+        """
+        Send the message before the ones waiting in the queue, without waiting
+        for the rate limiter, and wait for it to be sent. Raises SendError if it
+        could not be sent.
+        """
+        self._start_worker()
+        future = Future()
+        self._queue.put((_URGENT, next(self._order), message, future))
+        self._urgent.set()
+        future.result()
+
+    def close(self):
+        """
+        Send the messages that are already queued, then stop the helper
+        """
+        with self._lock:
+            worker = self._worker
+            self._worker = None
+        if worker is not None:
+            self._queue.put((_CLOSE, next(self._order), None, None))
+            worker.join()
+        self._stop_helper()
+
+    def _start_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._work, name="sender", daemon=True
+                )
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            lane, _, _, future = item
+            if lane == _CLOSE:
+                return
+            try:
+                self._work_on(item)
+            except Exception as error:
+                # Whatever went wrong, the caller waiting for the message is told,
+                # and the worker carries on with the next one
+                if not future.done():
+                    future.set_exception(SendError(error))
+            finally:
+                if lane == _NORMAL and future.done():
+                    self._slots.release()
+
+            try:
+                if time.monotonic() - self._reported >= self.report_interval:
+                    self._reported = time.monotonic()
+                    self.logger.info(self.report())
+            except Exception as error:
+                self.logger.error(f"An error occurred reporting the sends:{error}")
+
+    def _work_on(self, item: tuple):
+        """
+        Send the message of a queued item, or put it back in the queue until the
+        rate limiter lets it go
+        """
+        lane, _, message, future = item
+        if lane == _NORMAL:
+            delay = self.rate_limiter.try_acquire()
+            if delay:
+                # Wait for a token with the message back in the queue, so an
+                # urgent message that comes in meanwhile goes first
+                self._queue.put(item)
+                self._urgent.wait(delay)
+                self._urgent.clear()
+                return
+        else:
+            # Urgent messages still use up a token if there is one, so they
+            # count towards the rate
+            self.rate_limiter.try_acquire()
+        if not future.set_running_or_notify_cancel():
+            return
+
+        started = time.monotonic()
+        try:
+            self._send(message)
+        except SendError as error:
+            self.stats.record(time.monotonic() - started, ok=False)
+            future.set_exception(error)
+        except Exception as error:
+            # Whatever state the helper is in, start over with a new one
+            self.stats.record(time.monotonic() - started, ok=False)
+            future.set_exception(SendError(error))
+            self._stop_helper(kill=True)
+        else:
+            self.stats.record(time.monotonic() - started)
+            future.set_result(None)
+
+    def report(self) -> str:
+        summary = self.stats.summary()
+        return (
+            f"Sent {summary['sends']} messages, {summary['failures']} failed, "
+            f"{summary['sends_per_second']:.2f}/s, "
+            f"p50 {summary['p50'] * 1000:.0f}ms, p99 {summary['p99'] * 1000:.0f}ms"
         )
+
+    def _send(self, message: str):
+        deadline = time.monotonic() + self.timeout
+        helper = self._start_helper()
+        data = message.encode()
+        helper.stdin.write(b"%d\n%s" % (len(data), data))
+        helper.stdin.flush()
+
+        reply = self._read_line(helper, deadline)
+        if reply != "ok":
+            raise SendError(reply.partition(" ")[2] or reply)
+
+    def _start_helper(self) -> subprocess.Popen:
+        if self._helper is None or self._helper.poll() is not None:
+            self._buffer = b""
+            self._helper = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+        return self._helper
+
+    def _stop_helper(self, kill: bool = False):
+        """
+        Stop the helper, letting it finish by closing its stdin, or killing it if
+        it is stuck
+        """
+        helper = self._helper
+        self._helper = None
+        if helper is None:
+            return
+        try:
+            if kill:
+                helper.kill()
+            helper.stdin.close()
+            helper.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            helper.kill()
+            helper.wait()
+        helper.stdout.close()
+
+    def _read_line(self, helper: subprocess.Popen, deadline: float) -> str:
+        """
+        Read a line that the helper writes, failing if it takes until deadline
+        """
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            ready, _, _ = select.select([helper.stdout], [], [], max(remaining, 0))
+            if not ready:
+                self._stop_helper(kill=True)
+                raise SendError(f"Sending took more than {self.timeout} seconds")
+            chunk = os.read(helper.stdout.fileno(), 4096)
+            if not chunk:
+                self._stop_helper()
+                raise SendError(f"The helper exited with {helper.wait()}")
+            self._buffer += chunk
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return line.decode(errors="replace").strip()
@@ -0,0 +1,82 @@
+import json
+import random
+import sys
+import threading
+import time
+
+import click
+
+
+class StubImessage:
+    """
+    Stands in for SendImessage in tests and benchmarks. Sending takes latency
+    seconds, a fraction error_rate of the sends fail, and the messages that were
+    sent are kept in sent, with the time they were sent.
+    """
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, seed: int = None):
+        """
+        :param latency: Seconds each send takes
+        :param error_rate: The fraction of sends that fail
+        :param seed: Seed for the random failures, so a run can be repeated
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.sent: list = []
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, message: str) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.failures += 1
+                raise RuntimeError("Stub send failed")
+            self.sent.append((time.monotonic(), message))
+
+
+@click.command()
+@click.argument("buddy")
+@click.option(
+    "--latency",
+    default=0.0,
+    type=click.FloatRange(min=0),
+    help="Seconds each send takes",
+)
+@click.option("--fail-on", help="Fail to send messages containing this text")
+@click.option("--hang-on", help="Never answer for messages containing this text")
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False),
+    help="File to append the messages to, as JSON lines",
+)
+def stub_sender(buddy, latency, fail_on, hang_on, output):
+    """Stands in for the messageSender.js helper where there is no Messages app,
+    for testing. Speaks the same protocol, but only records the messages sent to
+    BUDDY."""
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout
+    while True:
+        header = stdin.readline()
+        if not header:
+            return
+        message = stdin.read(int(header)).decode()
+
+        if hang_on is not None and hang_on in message:
+            time.sleep(60 * 60 * 24)
+        if latency:
+            time.sleep(latency)
+        if fail_on is not None and fail_on in message:
+            stdout.write(f"error not sending '{fail_on}'\n")
+        else:
+            if output is not None:
+                with open(output, "a") as file:
+                    file.write(json.dumps({"buddy": buddy, "message": message}) + "\n")
+            stdout.write("ok\n")
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    stub_sender()
@@ -0,0 +1,53 @@
+import pytest
+from google.oauth2.credentials import Credentials
+
+from imessage_email_alert import iMessageEmailAlert
+from imessage_email_alert.fake_gmail import FakeGmail
+from imessage_email_alert.get_email_message import GetEmailMessage
+from imessage_email_alert.stub_sender import StubImessage
+
+
+@pytest.fixture
+def fake_gmail():
+    return FakeGmail()
+
+
+@pytest.fixture
+def connect():
+    """
+    Connects a GetEmailMessage to a FakeGmail, with any other GetEmailMessage
+    options
+    """
+
+    def connect(fake_gmail: FakeGmail, **options) -> GetEmailMessage:
+        return GetEmailMessage(
+            credentials=Credentials(token="fake-token"),
+            transport_factory=fake_gmail.http,
+            **options,
+        )
+
+    return connect
+
+
+@pytest.fixture
+def gmail(fake_gmail, connect):
+    return connect(fake_gmail)
+
+
+@pytest.fixture
+def make_alert(tmp_path, connect):
+    """
+    Makes an iMessageEmailAlert that reads from a FakeGmail and sends with a
+    StubImessage, unless it is given another sender. The gmail_options are passed
+    on to GetEmailMessage.
+    """
+
+    def make_alert(
+        fake_gmail: FakeGmail, gmail_options: dict = None, **options
+    ) -> iMessageEmailAlert:
+        options.setdefault("sender", StubImessage())
+        alert = iMessageEmailAlert("+15555550100", log_dir=tmp_path, **options)
+        alert.gmail = connect(fake_gmail, **(gmail_options or {}))
+        return alert
+
+    return make_alert
@@ -0,0 +1,82 @@
+import pickle
+
+import pytest
+
+from imessage_email_alert.archive import (
+    ArchiveError,
+    MessageArchive,
+    SegmentReader,
+    load_saved_messages,
+)
+from imessage_email_alert.get_email_message import EmailMessage
+
+
+def email(i: int) -> EmailMessage:
+    return EmailMessage(
+        from_email="sender@example.com",
+        to_email="me@example.com",
+        subject=f"Subject {i} ✓",
+        body="Body line\n" * 50,
+        message_id=f"{i:016x}",
+    )
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_messages_read_back_in_order_across_segments(tmp_path, compress):
+    archive = MessageArchive(tmp_path, compress=compress, segment_size=1000)
+    for i in range(100):
+        archive.append(email(i))
+
+    assert len(archive.segments()) > 1
+    assert list(archive) == [email(i) for i in range(100)]
+    # Messages saved in the same second are all kept
+    assert len(list(MessageArchive(tmp_path).locate())) == 100
+
+
+def test_time_range_is_found_with_the_index(tmp_path):
+    archive = MessageArchive(tmp_path, segment_size=1000)
+    for i in range(100):
+        archive.append(email(i), timestamp=2000 + i)
+    # The timestamps never go backwards
+    archive.append(email(100), timestamp=0)
+
+    found = list(archive.read(start=2050, end=2060))
+    assert [message for _, message in found] == [email(i) for i in range(50, 60)]
+    assert [timestamp for timestamp, _ in archive.read(start=2099)] == [2099, 2099]
+
+
+def test_partly_written_record_is_dropped(tmp_path):
+    archive = MessageArchive(tmp_path)
+    for i in range(3):
+        archive.append(email(i))
+    archive.close()
+    segment = archive.segments()[0]
+    with open(segment, "ab") as file:
+        file.write(b"\x10\x00\x00")
+    with open(segment.with_suffix(".idx"), "ab") as file:
+        file.write(b"\x01\x02")
+
+    archive = MessageArchive(tmp_path)
+    archive.append(email(3))
+
+    assert list(archive) == [email(i) for i in range(4)]
+
+
+def test_damaged_record_is_detected(tmp_path):
+    archive = MessageArchive(tmp_path, compress=False)
+    archive.append(email(0))
+    archive.close()
+    segment = archive.segments()[0]
+    data = bytearray(segment.read_bytes())
+    data[-5] ^= 0xFF
+    segment.write_bytes(bytes(data))
+
+    with pytest.raises(ArchiveError):
+        SegmentReader().read(segment, 0)
+
+
+def test_old_pickle_directories_still_load(tmp_path):
+    for i in range(3):
+        (tmp_path / f"2023010100000{i}").write_bytes(pickle.dumps(email(i)))
+
+    assert list(load_saved_messages(tmp_path)) == [email(i) for i in range(3)]
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from imessage_email_alert.credentials import CredentialManager
+
+
+class TokenEndpoint(ThreadingHTTPServer):
+    """
+    A stand-in for the google token endpoint, handing out numbered tokens
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), TokenHandler)
+        self.requests = 0
+        self.delay = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/token"
+
+
+class TokenHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            failing = server.failures > 0
+            server.failures -= failing
+            number = server.requests
+        if failing:
+            status, body = 400, {"error": "invalid_request"}
+        else:
+            status = 200
+            body = {
+                "access_token": f"token-{number}",
+                "expires_in": 3600,
+                "token_type": "Bearer",
+            }
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    server = TokenEndpoint()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_credentials(endpoint, expires_in: float) -> Credentials:
+    return Credentials(
+        token="old-token",
+        refresh_token="refresh-token",
+        token_uri=endpoint.url,
+        client_id="client",
+        client_secret="secret",
+        expiry=datetime.now(timezone.utc).replace(tzinfo=None)
+        + timedelta(seconds=expires_in),
+    )
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_concurrent_workers_share_one_refresh(endpoint, tmp_path):
+    endpoint.delay = 0.2
+    token_file = tmp_path / "token.json"
+    manager = CredentialManager(make_credentials(endpoint, -60), token_file)
+
+    threads = [threading.Thread(target=manager.ensure_valid) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert endpoint.requests == 1
+    assert manager.credentials.token == "token-1"
+    assert json.loads(token_file.read_text())["token"] == "token-1"
+    assert token_file.stat().st_mode & 0o777 == 0o600
+
+
+def test_valid_token_is_neither_refreshed_nor_rewritten(endpoint, tmp_path):
+    credentials = make_credentials(endpoint, 3600)
+    token_file = tmp_path / "token.json"
+    token_file.write_text(credentials.to_json())
+    inode = token_file.stat().st_ino
+
+    manager = CredentialManager(credentials, token_file)
+    manager.ensure_valid()
+    manager.save()
+
+    assert endpoint.requests == 0
+    assert token_file.stat().st_ino == inode
+
+
+def test_token_is_refreshed_in_the_background_before_it_expires(endpoint, tmp_path):
+    manager = CredentialManager(
+        make_credentials(endpoint, 3600),
+        tmp_path / "token.json",
+        refresh_margin=3600,
+        retry_interval=0.05,
+    ).start()
+    try:
+        assert wait_for(lambda: manager.credentials.token != "old-token")
+    finally:
+        manager.stop()
+
+    assert manager.credentials.valid
+    assert "token-" in (tmp_path / "token.json").read_text()
+
+
+def test_failed_background_refresh_is_retried(endpoint):
+    endpoint.failures = 2
+    manager = CredentialManager(
+        make_credentials(endpoint, 3600), refresh_margin=3600, retry_interval=0.05
+    ).start()
+    try:
+        assert wait_for(lambda: manager.refreshes >= 1)
+    finally:
+        manager.stop()
+
+    assert endpoint.requests >= 3
+    assert manager.credentials.token.startswith("token-")
@@ -0,0 +1,113 @@
+from imessage_email_alert.dedup import DuplicateCache
+from imessage_email_alert.email_message import EmailMessage
+from imessage_email_alert.stub_sender import StubImessage
+
+
+def message(from_email="alerts@bank.example.com", subject="Deposit", body="$100"):
+    return EmailMessage(from_email=from_email, subject=subject, body=body)
+
+
+def test_copies_of_an_email_have_the_same_fingerprint():
+    cache = DuplicateCache()
+    original = cache.fingerprint(message())
+
+    assert cache.fingerprint(message("Bank <Alerts@Bank.example.com>")) == original
+    assert cache.fingerprint(message(subject="Fwd: RE:  deposit")) == original
+    assert cache.fingerprint(message(body="\n  $100  \n\n")) == original
+    assert cache.fingerprint(message(body="$100" + "." * 500)) != original
+    assert cache.fingerprint(message(subject="Withdrawal")) != original
+
+
+def test_entries_expire_and_the_least_recently_seen_are_evicted():
+    now = [0.0]
+    cache = DuplicateCache(window=60, max_entries=2, clock=lambda: now[0])
+
+    assert not cache.check(message(subject="a"))
+    assert cache.check(message(subject="a"))
+    now[0] = 61
+    assert not cache.check(message(subject="a"))
+
+    cache.check(message(subject="b"))
+    cache.check(message(subject="c"))
+    assert len(cache) == 2
+    assert not cache.check(message(subject="a"))
+    assert (cache.hits, cache.misses) == (1, 5)
+
+
+def test_a_duplicate_counts_as_recently_seen(tmp_path):
+    now = [0.0]
+    path = tmp_path / "dedup.sqlite"
+    cache = DuplicateCache(window=60, max_entries=2, path=path, clock=lambda: now[0])
+
+    cache.check(message(subject="a"))
+    now[0] = 1
+    cache.check(message(subject="b"))
+    now[0] = 2
+    assert cache.check(message(subject="a"))
+    now[0] = 3
+    cache.check(message(subject="c"))
+    cache.close()
+
+    # b was the least recently seen, so it made room for c, and the order is
+    # kept in the file too
+    cache = DuplicateCache(window=60, max_entries=2, path=path, clock=lambda: now[0])
+    assert cache.check(message(subject="a"))
+    assert cache.check(message(subject="c"))
+    assert not cache.check(message(subject="b"))
+
+
+def test_discarded_emails_are_not_duplicates():
+    cache = DuplicateCache()
+    cache.check(message())
+    cache.discard(message())
+
+    assert not cache.check(message())
+
+
+def test_cache_survives_a_restart(tmp_path):
+    now = [1000.0]
+    path = tmp_path / "dedup.sqlite"
+    cache = DuplicateCache(window=60, path=path, clock=lambda: now[0])
+    cache.check(message(subject="old"))
+    now[0] = 1050
+    cache.check(message(subject="new"))
+    cache.close()
+
+    now[0] = 1070
+    cache = DuplicateCache(window=60, path=path, clock=lambda: now[0])
+
+    assert len(cache) == 1
+    assert cache.check(message(subject="new"))
+    assert not cache.check(message(subject="old"))
+
+
+def test_duplicate_alerts_are_deleted_without_being_sent(fake_gmail, make_alert):
+    fake_gmail.add_message(from_email="alerts@bank.example.com", subject="Deposit")
+    fake_gmail.add_message(
+        from_email="Bank <alerts@bank.example.com>", subject="Fwd: Deposit"
+    )
+    fake_gmail.add_message(from_email="alerts@bank.example.com", subject="Deposit")
+    fake_gmail.add_message(from_email="alerts@bank.example.com", subject="Statement")
+    alert = make_alert(fake_gmail, drain_size=10, dedup_window=60)
+
+    alert._drain_messages()
+
+    assert len(alert.imessage.sent) == 2
+    assert not fake_gmail.messages
+    assert alert.metrics.messages.value(("duplicate",)) == 2
+    assert alert.metrics.dedup.value(("hit",)) == 2
+    assert alert.metrics.dedup.value(("miss",)) == 2
+
+
+def test_an_email_whose_alert_failed_is_sent_again(fake_gmail, make_alert):
+    fake_gmail.add_message(subject="Deposit")
+    alert = make_alert(
+        fake_gmail, drain_size=10, sender=StubImessage(error_rate=1), dedup_window=60
+    )
+
+    alert._drain_messages()
+    alert.imessage.error_rate = 0
+    alert._drain_messages()
+
+    assert len(alert.imessage.sent) == 1
+    assert not fake_gmail.messages
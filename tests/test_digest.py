@@ -0,0 +1,75 @@
+from imessage_email_alert.digest import AlertCoalescer, render_digests
+from imessage_email_alert.get_email_message import EmailMessage
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def email(i: int, body: str = "Hello") -> EmailMessage:
+    return EmailMessage(
+        message_id=f"id{i}",
+        to_email="me@example.com",
+        subject=f"Subject {i}",
+        body=body,
+    )
+
+
+def test_coalescer_is_due_after_window_or_count():
+    clock = FakeClock()
+    coalescer = AlertCoalescer(window=30, max_count=3, clock=clock)
+    assert not coalescer.due()
+    assert coalescer.time_left() is None
+
+    coalescer.add(email(1))
+    clock.now += 10
+    coalescer.add(email(2))
+    assert "id2" in coalescer
+    assert not coalescer.due()
+    assert coalescer.time_left() == 20
+
+    clock.now += 20
+    assert coalescer.due()
+
+    coalescer.add(email(3))
+    assert [message.message_id for message in coalescer.take()] == [
+        "id1",
+        "id2",
+        "id3",
+    ]
+    assert len(coalescer) == 0
+
+    for i in range(3):
+        coalescer.add(email(i))
+    assert coalescer.due()
+
+
+def test_digest_summarizes_each_email():
+    digests = render_digests(
+        [email(1, "Short body"), email(2, "word " * 100)],
+        digest_length=2000,
+        summary_length=20,
+    )
+
+    assert len(digests) == 1
+    text, messages = digests[0]
+    assert [message.message_id for message in messages] == ["id1", "id2"]
+    assert text == (
+        "2 new emails\n\n"
+        "To: me@example.com\nSubject: Subject 1\nShort body\n\n"
+        "To: me@example.com\nSubject: Subject 2\n" + "word word word word ..."
+    )
+
+
+def test_digests_respect_the_length_limit():
+    messages = [email(i, "x" * 150) for i in range(50)]
+
+    digests = render_digests(messages, digest_length=1000)
+
+    assert all(len(text) <= 1000 for text, _ in digests)
+    assert sum(len(digested) for _, digested in digests) == 50
+    assert digests[0][0].startswith(f"5 new emails (1 of {len(digests)})")
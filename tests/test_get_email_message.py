@@ -0,0 +1,203 @@
+import pytest
+
+from imessage_email_alert.fake_gmail import mime_part
+from imessage_email_alert.imessage_email_alert import render_message
+
+
+def test_get_and_delete_message(fake_gmail, gmail):
+    message_id = fake_gmail.add_message(subject="Hello", body="Hi there")
+
+    message = gmail.get_next_message()
+    assert message.message_id == message_id
+    assert message.subject == "Hello"
+    assert message.body == "Hi there"
+
+    gmail.delete_message(message_id)
+    assert gmail.get_next_message() is None
+
+
+def test_service_is_built_once_for_many_polls(fake_gmail, gmail):
+    for _ in range(5):
+        fake_gmail.add_message()
+
+    for _ in range(2000):
+        message = gmail.get_next_message()
+        if message is not None:
+            gmail.delete_message(message.message_id)
+
+    assert not fake_gmail.messages
+    assert gmail.client_stats.clients_built == 1
+    assert gmail.client_stats.connections_built == 1
+    assert gmail.client_stats.requests == 2000 + 5 * 2
+
+
+def test_transport_failure_rebuilds_service(fake_gmail, gmail):
+    assert gmail.get_next_message() is None
+
+    fake_gmail.fail_next_request(ConnectionResetError("connection reset"))
+    with pytest.raises(ConnectionResetError):
+        gmail.get_next_message()
+
+    assert gmail.get_next_message() is None
+    assert gmail.client_stats.clients_built == 2
+    assert gmail.client_stats.connections_built == 2
+
+
+@pytest.fixture
+def incremental_gmail(fake_gmail, connect):
+    return connect(fake_gmail, incremental=True)
+
+
+def test_incremental_sync_only_asks_for_new_mail(fake_gmail, incremental_gmail):
+    for _ in range(1200):
+        fake_gmail.add_message()
+
+    # The first sync lists the whole mailbox
+    assert len(incremental_gmail.list_message_ids(max_results=2000)) == 1200
+    assert fake_gmail.calls["messages.list"] == 3
+
+    # After that, polls only ask for the history, whatever the mailbox size
+    for _ in range(50):
+        assert len(incremental_gmail.list_message_ids(max_results=2000)) == 1200
+    assert fake_gmail.calls["messages.list"] == 3
+    assert fake_gmail.calls["history.list"] == 50
+
+    new_id = fake_gmail.add_message(subject="New")
+    assert incremental_gmail.list_message_ids(max_results=1) == [new_id]
+    assert incremental_gmail.get_next_message().subject == "New"
+
+    incremental_gmail.delete_message(new_id)
+    assert new_id not in incremental_gmail.list_message_ids(max_results=2000)
+    assert fake_gmail.calls["messages.list"] == 3
+
+
+def test_incremental_sync_resyncs_when_history_expires(fake_gmail, incremental_gmail):
+    first_id = fake_gmail.add_message()
+    assert incremental_gmail.list_message_ids() == [first_id]
+
+    second_id = fake_gmail.add_message()
+    fake_gmail.expire_history()
+
+    assert incremental_gmail.list_message_ids() == [second_id, first_id]
+    assert fake_gmail.calls["messages.list"] == 2
+    assert incremental_gmail.history_id == str(fake_gmail.history_id)
+
+
+def test_incremental_sync_skips_messages_deleted_elsewhere(
+    fake_gmail, incremental_gmail
+):
+    message_id = fake_gmail.add_message()
+    assert incremental_gmail.list_message_ids() == [message_id]
+
+    del fake_gmail.messages[message_id]
+    assert incremental_gmail.get_next_message() is None
+    assert incremental_gmail.list_message_ids() == []
+
+
+def test_get_messages_batches_and_isolates_failures(fake_gmail, gmail):
+    message_ids = [fake_gmail.add_message(subject=f"{i}") for i in range(120)]
+    del fake_gmail.messages[message_ids[5]]
+
+    messages, errors = gmail.get_messages(message_ids)
+
+    assert [message.message_id for message in messages] == (
+        message_ids[:5] + message_ids[6:]
+    )
+    assert errors == {}
+    assert fake_gmail.calls["batch"] == 3
+    assert fake_gmail.calls["messages.get"] == 120
+
+
+def test_delete_messages_uses_one_batch_delete(fake_gmail, gmail):
+    message_ids = [fake_gmail.add_message() for _ in range(200)]
+
+    gmail.delete_messages(message_ids)
+
+    assert not fake_gmail.messages
+    assert fake_gmail.calls["messages.batchDelete"] == 1
+    assert fake_gmail.calls["messages.delete"] == 0
+
+
+def marketing_payload() -> dict:
+    return mime_part(
+        "multipart/mixed",
+        parts=[
+            mime_part(
+                "multipart/alternative",
+                parts=[
+                    mime_part("text/plain", "Plain text " * 2000),
+                    mime_part(
+                        "multipart/related",
+                        parts=[
+                            mime_part("text/html", "<p>Html</p>" * 20000),
+                            mime_part("image/png", "png" * 1000, filename="logo.png"),
+                        ],
+                    ),
+                ],
+            ),
+            mime_part("text/calendar", "BEGIN:VCALENDAR" * 1000),
+        ],
+    )
+
+
+def test_lazy_body_gets_and_decodes_only_the_needed_part(fake_gmail, connect):
+    full = connect(fake_gmail)
+    lazy = connect(fake_gmail, lazy_body=True, body_limit=100)
+    message_id = fake_gmail.add_message(subject="Sale", payload=marketing_payload())
+
+    full.get_message(message_id)
+    lazy_message = lazy.get_message(message_id)
+
+    assert lazy_message.subject == "Sale"
+    assert lazy_message.body == ("Plain text " * 10)[:100]
+    assert lazy.client_stats.bytes_decoded < 500
+    assert full.client_stats.bytes_decoded > 200000
+    assert lazy.client_stats.bytes_transferred < full.client_stats.bytes_transferred / 5
+
+
+def test_a_body_cut_short_is_rendered_as_cut_short(fake_gmail, gmail):
+    # Shortening the tracking URLs leaves less text than fits in the alert
+    link = "https://shop.example.com/sale?" + "utm=x&" * 50 + "\n"
+    short_id = fake_gmail.add_message(body="Short")
+    long_id = fake_gmail.add_message(body=link * 100)
+    html_id = fake_gmail.add_message(body=f"<p>{link}</p>" * 100, mime_type="text/html")
+    gmail.body_limit = 1000
+
+    assert not gmail.get_message(short_id).truncated
+    assert gmail.get_message(html_id).truncated
+    gmail.lazy_body = True
+    short = gmail.get_message(short_id)
+    long = gmail.get_message(long_id)
+
+    assert not short.truncated
+    assert long.truncated
+    assert not render_message(short, 800).endswith("........")
+    assert len(render_message(long, 800)) < 800
+    assert render_message(long, 800).endswith("........")
+
+
+def test_full_body_stops_extracting_at_the_body_limit(fake_gmail, gmail):
+    gmail.body_limit = 100
+    html_id = fake_gmail.add_message(
+        body="<p>Html text</p>\n" * 20000, mime_type="text/html"
+    )
+    plain_id = fake_gmail.add_message(body="Plain text " * 2000)
+
+    html = gmail.get_message(html_id)
+    plain = gmail.get_message(plain_id)
+
+    assert html.truncated and len(html.body) < 200
+    assert plain.truncated and plain.body == ("Plain text " * 10)[:100]
+
+
+def test_lazy_body_gets_big_parts_as_attachments(fake_gmail, gmail):
+    gmail.lazy_body = True
+    message_id = fake_gmail.add_message(
+        payload=mime_part(
+            "multipart/mixed",
+            parts=[mime_part("text/html", "<b>Hi</b> there", attachment=True)],
+        )
+    )
+
+    assert gmail.get_message(message_id).body == "Hi there"
+    assert fake_gmail.calls["attachments.get"] == 1
@@ -0,0 +1,42 @@
+from imessage_email_alert.html_text import (
+    HtmlTextExtractor,
+    extract_text,
+    html_to_text,
+)
+
+
+def test_visible_text_only():
+    html = (
+        "<html><head><title>T</title><style>p {color: red}</style>"
+        "<script>var x = '<p>no</p>';</script></head>"
+        "<body><p>Hi &amp; <b>there</b></p><!-- comment -->"
+        "<div>x&nbsp;y</div></body></html>"
+    )
+    assert html_to_text(html) == "THi & therex\xa0y"
+
+
+def test_stops_once_it_has_enough_text():
+    html = "<table>" + "<tr><td>cell</td></tr>" * 100000 + "</table>"
+
+    extractor = HtmlTextExtractor(limit=10)
+    extractor.feed(html[:100])
+    assert extractor.done
+    assert extractor.text == "cellcellce"
+
+    assert html_to_text(html, limit=10) == "cellcellce"
+    assert html_to_text(html, limit=None) == "cell" * 100000
+
+
+def test_indentation_does_not_count_towards_the_limit():
+    row = "\n        <tr>\n            <td>cell</td>\n        </tr>"
+    html = "<table>" + row * 1000 + "\n</table>"
+
+    text = html_to_text(html, limit=40)
+
+    assert text.split() == ["cell"] * 10
+
+
+def test_text_of_exactly_the_limit_is_not_truncated():
+    assert extract_text("<p>abcde</p>\n", limit=5) == ("abcde\n", False)
+    assert extract_text("<p>abc</p><p>de</p>", limit=5) == ("abcde", False)
+    assert extract_text("<p>abcde</p><p>f</p>", limit=5) == ("abcde", True)
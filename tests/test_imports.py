@@ -0,0 +1,62 @@
+import json
+import subprocess
+import sys
+
+import click
+import pytest
+
+import imessage_email_alert
+
+HEAVY_MODULES = {
+    "googleapiclient",
+    "google.auth",
+    "google_auth_oauthlib",
+    "httplib2",
+    "bs4",
+    "asyncio",
+}
+
+
+def modules_loaded_by(code: str) -> set:
+    """
+    The modules a fresh interpreter has imported after running the code
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"{code}\nimport json, sys\nprint(json.dumps(sorted(sys.modules)))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(json.loads(result.stdout.splitlines()[-1]))
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "import imessage_email_alert",
+        "from imessage_email_alert import imessage_email_alert\n"
+        "imessage_email_alert.main(['--help'], standalone_mode=False)",
+        "from imessage_email_alert import iMessageEmailAlert, replay\n"
+        "from imessage_email_alert.email_message import EmailMessage",
+    ],
+    ids=["import", "help", "replay"],
+)
+def test_startup_does_not_import_the_gmail_client(code):
+    assert not modules_loaded_by(code) & HEAVY_MODULES
+
+
+def test_public_names_are_imported_when_used():
+    from imessage_email_alert import AsyncPipeline, GetEmailMessage, __version__
+
+    assert GetEmailMessage.__module__ == "imessage_email_alert.get_email_message"
+    assert AsyncPipeline.__name__ == "AsyncPipeline"
+    assert __version__
+    # Importing the modules never hides the command behind the module of the same
+    # name
+    assert isinstance(imessage_email_alert.imessage_email_alert, click.Command)
+    with pytest.raises(AttributeError):
+        imessage_email_alert.no_such_name
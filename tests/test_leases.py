@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pytest
+
+from imessage_email_alert import iMessageEmailAlert
+from imessage_email_alert.fake_gmail import FakeGmail
+from imessage_email_alert.leases import LabelLeases
+from imessage_email_alert.stub_sender import StubImessage
+
+
+@pytest.fixture
+def make_worker(make_alert):
+    def make_worker(fake_gmail, worker_id, **kwargs) -> iMessageEmailAlert:
+        return make_alert(
+            fake_gmail,
+            sender=StubImessage(latency=0.005),
+            worker_id=worker_id,
+            **kwargs,
+        )
+
+    return make_worker
+
+
+def sent_subjects(alert: iMessageEmailAlert) -> list:
+    return [text.split("\n")[1] for _, text in alert.imessage.sent]
+
+
+def test_workers_share_the_mailbox_without_duplicate_alerts(make_worker):
+    fake_gmail = FakeGmail(latency=0.002)
+    subjects = [f"Subject: Message {i}" for i in range(120)]
+    for subject in subjects:
+        fake_gmail.add_message(subject=subject.split(": ", 1)[1])
+    workers = [make_worker(fake_gmail, f"worker-{n}", drain_size=10) for n in range(4)]
+
+    def run(worker):
+        deadline = time.monotonic() + 60
+        while fake_gmail.messages and time.monotonic() < deadline:
+            worker._drain_messages()
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    sent = [subject for worker in workers for subject in sent_subjects(worker)]
+    assert sorted(sent) == sorted(subjects)
+    assert not fake_gmail.messages
+    # Each worker did its share
+    assert all(worker.imessage.sent for worker in workers)
+
+
+def test_only_one_of_two_racing_claims_is_kept(fake_gmail, connect):
+    message_id = fake_gmail.add_message()
+    gmail = connect(fake_gmail)
+    first = LabelLeases("first")
+    second = LabelLeases("second")
+    first.renew(gmail)
+    second.renew(gmail)
+
+    # The first claim is read back before the second is made
+    first.claim(gmail, [message_id])
+    assert first.keep_won(gmail, [gmail.get_message(message_id)])
+    second.claim(gmail, [message_id])
+    assert not second.keep_won(gmail, [gmail.get_message(message_id)])
+
+    # Both claims are made before either is read back, so both back off
+    first.release(gmail, [message_id])
+    first.claim(gmail, [message_id])
+    second.claim(gmail, [message_id])
+    message = gmail.get_message(message_id)
+    assert not first.keep_won(gmail, [message])
+    assert not second.keep_won(gmail, [message])
+    assert fake_gmail.messages[message_id]["labelIds"] == ["INBOX"]
+
+
+def test_expired_leases_are_reclaimed_and_live_ones_skipped(
+    fake_gmail, connect, make_worker
+):
+    abandoned = fake_gmail.add_message(subject="Abandoned")
+    held = fake_gmail.add_message(subject="Held")
+    gmail = connect(fake_gmail)
+
+    # A worker that stopped two minutes ago, its one minute lease ran out
+    dead = LabelLeases("dead", lease_seconds=60, clock=lambda: time.time() - 120)
+    dead.renew(gmail)
+    dead.claim(gmail, [abandoned])
+    busy = LabelLeases("busy", lease_seconds=60)
+    busy.renew(gmail)
+    busy.claim(gmail, [held])
+
+    worker = make_worker(fake_gmail, "worker", lease_seconds=60)
+    # Claim whatever is listed, as if the ownership had not been agreed yet
+    worker.leases.choose = lambda message_ids, count: message_ids[:count]
+    worker._drain_messages()
+
+    assert sent_subjects(worker) == ["Subject: Abandoned"]
+    assert list(fake_gmail.messages) == [held]
+    assert fake_gmail.messages[held]["labelIds"] == ["INBOX", busy._label_id]
+    names = [label["name"] for label in fake_gmail.labels.values()]
+    assert not any("/dead/" in name for name in names)
+
+
+def test_failed_sends_are_released_for_any_worker(fake_gmail, make_worker):
+    message_id = fake_gmail.add_message()
+    worker = make_worker(fake_gmail, "worker")
+    worker.imessage.error_rate = 1
+
+    assert worker._drain_messages() == (1, 1, 0)
+    assert fake_gmail.messages[message_id]["labelIds"] == ["INBOX"]
+
+
+def test_lease_has_to_outlast_the_digest_window(fake_gmail, make_worker):
+    with pytest.raises(ValueError, match="digest window"):
+        make_worker(fake_gmail, "worker", digest_window=200, lease_seconds=300)
+    with pytest.raises(ValueError, match="Worker id"):
+        LabelLeases("has/slash")
+
+
+def test_mail_for_other_workers_doesnt_keep_a_worker_busy(
+    fake_gmail, connect, make_worker
+):
+    for i in range(10):
+        fake_gmail.add_message(subject=f"Subject {i}")
+    other = LabelLeases("other")
+    other.renew(connect(fake_gmail))
+    worker = make_worker(fake_gmail, "worker", drain_size=5)
+    # Everything listed belongs to the other worker
+    worker.leases.choose = lambda message_ids, count: []
+
+    worker.poll()
+
+    assert fake_gmail.calls["messages.list"] == 1
+    assert worker.scheduler.next_delay() > 0
+    assert len(fake_gmail.messages) == 10
@@ -0,0 +1,87 @@
+import json
+import logging
+import sys
+
+from imessage_email_alert.logs import AsyncLogWriter, DuplicateFilter, JsonFormatter
+
+
+def make_record(message, level=logging.ERROR, **extra):
+    record = logging.makeLogRecord(
+        {"name": "test", "levelno": level, "levelname": "ERROR", "msg": message}
+    )
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_includes_extra_fields_and_exceptions():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.getLogger("test").makeRecord(
+            "test",
+            logging.ERROR,
+            __file__,
+            1,
+            "Failed %s",
+            ("send",),
+            exc_info=sys.exc_info(),
+            extra={"message_id": "abc"},
+        )
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry["message"] == "Failed send"
+    assert entry["level"] == "ERROR"
+    assert entry["message_id"] == "abc"
+    assert "ValueError: boom" in entry["exception"]
+
+
+def test_duplicate_filter_drops_and_counts_repeats():
+    now = [0.0]
+    duplicates = DuplicateFilter(window=60, clock=lambda: now[0])
+
+    assert duplicates.filter(make_record("gmail is down"))
+    for _ in range(5):
+        assert not duplicates.filter(make_record("gmail is down"))
+    assert duplicates.filter(make_record("something else"))
+    assert duplicates.filter(make_record("info", level=logging.INFO))
+    assert duplicates.filter(make_record("info", level=logging.INFO))
+
+    now[0] = 61
+    record = make_record("gmail is down")
+    assert duplicates.filter(record)
+    assert record.repeated == 5
+
+
+def test_writer_writes_json_lines_and_rotates(tmp_path):
+    log_file = tmp_path / "alert.log"
+    writer = AsyncLogWriter(log_file, max_bytes=1000, backup_count=2).start()
+    logger = logging.getLogger("test_logs.rotate")
+    logger.propagate = False
+    logger.addHandler(writer.handler)
+    try:
+        for i in range(50):
+            logger.error(f"Error number {i}")
+    finally:
+        writer.stop()
+        logger.removeHandler(writer.handler)
+
+    lines = log_file.read_text().splitlines()
+    assert json.loads(lines[-1])["message"] == "Error number 49"
+    assert (tmp_path / "alert.log.1").exists()
+    assert not (tmp_path / "alert.log.3").exists()
+
+
+def test_records_are_dropped_instead_of_waiting_for_the_writer(tmp_path):
+    # Not started, so nothing is taken off the queue
+    writer = AsyncLogWriter(tmp_path / "alert.log", queue_size=2)
+    logger = logging.getLogger("test_logs.full")
+    logger.propagate = False
+    logger.addHandler(writer.handler)
+    try:
+        for i in range(5):
+            logger.error(f"Error number {i}")
+    finally:
+        logger.removeHandler(writer.handler)
+
+    assert writer.handler.dropped == 3
@@ -0,0 +1,116 @@
+import time
+import urllib.request
+
+import pytest
+
+from imessage_email_alert.email_message import EmailMessage
+from imessage_email_alert.metrics import (
+    AlertMetrics,
+    MetricsFileWriter,
+    MetricsRegistry,
+    MetricsServer,
+)
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("took_seconds", "Took", ("stage",), (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, ("send",))
+
+    assert histogram.count(("send",)) == 4
+    assert histogram.sum(("send",)) == pytest.approx(5.65)
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP took_seconds Took", "# TYPE took_seconds histogram"]
+    assert lines[2:5] == [
+        'took_seconds_bucket{stage="send",le="0.1"} 2',
+        'took_seconds_bucket{stage="send",le="1"} 3',
+        'took_seconds_bucket{stage="send",le="+Inf"} 4',
+    ]
+    assert lines[-1] == 'took_seconds_count{stage="send"} 4'
+
+
+def test_registry_shares_metrics_by_name():
+    registry = MetricsRegistry()
+    counter = registry.counter("sent", "Sent")
+    registry.counter("sent", "Sent").inc(2)
+
+    assert counter.value() == 2
+    assert "sent_total 2" in registry.render()
+    with pytest.raises(ValueError):
+        registry.histogram("sent", "Sent")
+
+
+def test_metrics_are_served_and_written(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter("sent", "Sent").inc()
+
+    server = MetricsServer(registry, 0).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert "sent_total 1" in response.read().decode()
+    finally:
+        server.stop()
+
+    writer = MetricsFileWriter(registry, tmp_path / "alert.prom", interval=60).start()
+    writer.stop()
+    assert (tmp_path / "alert.prom").read_text() == registry.render()
+
+
+def test_metrics_file_writer_keeps_going_after_a_failed_write(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter("sent_total", "Sent").inc()
+    directory = tmp_path / "metrics"
+    writer = MetricsFileWriter(registry, directory / "alert.prom", interval=0.01)
+    writer.start()
+    try:
+        # The directory doesn't exist yet, so the first writes fail
+        time.sleep(0.1)
+        assert writer._thread.is_alive()
+        directory.mkdir()
+        deadline = time.monotonic() + 5
+        while not (directory / "alert.prom").exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        writer.stop()
+
+    assert (directory / "alert.prom").read_text() == registry.render()
+
+
+def test_alert_records_stage_timings_and_delivery_latency(fake_gmail, make_alert):
+    metrics = AlertMetrics()
+    alert = make_alert(
+        fake_gmail,
+        gmail_options={"metrics": metrics},
+        drain_size=10,
+        metrics=metrics,
+    )
+    fake_gmail.add_message(subject="Plain")
+    fake_gmail.add_message(
+        subject="HTML", body="<html><p>Hi</p></html>", mime_type="text/html"
+    )
+
+    assert alert._drain_messages() == (2, 0, 2)
+
+    for stage in ("list", "get", "decode", "html", "delete"):
+        assert metrics.stage_seconds.count((stage,)) >= 1
+    for stage in ("render", "send"):
+        assert metrics.stage_seconds.count((stage,)) == 2
+    assert metrics.delivery_seconds.count() == 2
+    assert metrics.messages.value(("sent",)) == 2
+    assert metrics.messages.value(("deleted",)) == 2
+
+
+def test_deliveries_are_checked_against_the_slo_of_their_lane():
+    metrics = AlertMetrics(lane_slos={"urgent": 60, "normal": 600})
+    late = EmailMessage(received=time.time() - 120)
+
+    metrics.delivered([late], "urgent")
+    metrics.delivered([late, EmailMessage(received=time.time())])
+
+    assert metrics.lane_delivery_seconds.count(("urgent",)) == 1
+    assert metrics.lane_delivery_seconds.count(("normal",)) == 2
+    assert metrics.slo_misses.value(("urgent",)) == 1
+    assert metrics.slo_misses.value(("normal",)) == 0
+    assert metrics.delivery_seconds.count() == 3
@@ -0,0 +1,175 @@
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from imessage_email_alert import imessage_email_alert
+from imessage_email_alert.fake_gmail import FakeGmail
+from imessage_email_alert.multi_account import (
+    AccountConfig,
+    MultiAccountAlert,
+    load_accounts,
+)
+from imessage_email_alert.stub_sender import StubImessage
+
+
+def test_load_accounts(tmp_path):
+    config_file = tmp_path / "accounts.toml"
+    config_file.write_text("""
+workers = 2
+
+[[accounts]]
+name = "personal"
+credentials_file = "~/personal.json"
+token_file = "/tmp/personal-token.json"
+recipients = ["+15555550100", "me@example.com"]
+drain_size = 20
+outbox = "~/personal.sqlite3"
+
+[[accounts]]
+credentials_file = "work.json"
+token_file = "work-token.json"
+recipients = "+15555550101"
+""")
+
+    accounts, config = load_accounts(config_file)
+
+    assert config == {"workers": 2}
+    personal, work = accounts
+    assert personal.name == "personal"
+    assert personal.credentials_file.is_absolute()
+    assert personal.recipients == ["+15555550100", "me@example.com"]
+    assert personal.options["drain_size"] == 20
+    assert personal.options["outbox"].is_absolute()
+    assert work.name == "account 2"
+    assert work.recipients == ["+15555550101"]
+    assert work.options["quota_units"] == 200
+
+
+def test_unknown_account_setting_is_an_error(tmp_path):
+    config_file = tmp_path / "accounts.toml"
+    config_file.write_text(
+        '[[accounts]]\ncredentials_file = "a"\ntoken_file = "b"\n'
+        'recipients = ["c"]\ndrian_size = 5\n'
+    )
+
+    with pytest.raises(ValueError, match="drian_size"):
+        load_accounts(config_file)
+
+
+def test_single_account_options_are_rejected_with_a_config_file(tmp_path):
+    config_file = tmp_path / "accounts.toml"
+    config_file.write_text(
+        '[[accounts]]\ncredentials_file = "a"\ntoken_file = "b"\nrecipients = ["c"]\n'
+    )
+
+    result = CliRunner().invoke(
+        imessage_email_alert,
+        ["--config", str(config_file), "--drain", "5", "--quota-units", "100"],
+    )
+
+    assert result.exit_code == 2
+    assert "--drain, --quota-units can't be used with --config" in result.output
+
+
+def test_accounts_are_polled_fairly_over_a_shared_pool(connect, tmp_path):
+    accounts = [
+        AccountConfig(
+            name, tmp_path / "c.json", tmp_path / "t.json", recipients, options
+        )
+        for name, recipients, options in [
+            ("busy", ["+15555550100"], {"drain_size": 5}),
+            ("quiet", ["+15555550101", "+15555550100"], {}),
+            ("empty", ["+15555550102"], {}),
+        ]
+    ]
+    senders = {}
+
+    def make_sender(recipient):
+        senders[recipient] = StubImessage(latency=0.005)
+        return senders[recipient]
+
+    multi_account = MultiAccountAlert(
+        accounts, make_sender, workers=2, log_dir=tmp_path
+    )
+    mailboxes = {name: FakeGmail() for name in multi_account.alerts}
+    for name, alert in multi_account.alerts.items():
+        alert.scheduler.active_interval = 0.01
+        alert.scheduler.idle_interval = 0.05
+        alert.gmail = connect(mailboxes[name])
+    for i in range(100):
+        mailboxes["busy"].add_message(subject=f"Busy {i}")
+    mailboxes["quiet"].add_message(subject="Quiet")
+
+    runner = threading.Thread(target=multi_account.run)
+    runner.start()
+    deadline = time.monotonic() + 30
+    while any(m.messages for m in mailboxes.values()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    multi_account.stop()
+    runner.join()
+
+    assert len(senders) == 3
+    assert len(multi_account.senders) == 3
+    busy_sent = [text for _, text in senders["+15555550100"].sent]
+    assert len(busy_sent) == 101
+    # The quiet account didn't have to wait for the busy one to drain
+    assert busy_sent.index(next(t for t in busy_sent if "Quiet" in t)) < 20
+    assert [text for _, text in senders["+15555550101"].sent][0].endswith("Body")
+    assert senders["+15555550102"].sent == []
+    assert mailboxes["empty"].calls["messages.list"] > 1
+
+
+def test_accounts_that_cannot_connect_do_not_hold_the_workers(connect, tmp_path):
+    accounts = [
+        AccountConfig(name, tmp_path / "c.json", tmp_path / "t.json", [recipient])
+        for name, recipient in [
+            ("broken 1", "+15555550101"),
+            ("broken 2", "+15555550102"),
+            ("healthy", "+15555550100"),
+        ]
+    ]
+    senders = {}
+
+    def make_sender(recipient):
+        senders[recipient] = StubImessage()
+        return senders[recipient]
+
+    multi_account = MultiAccountAlert(
+        accounts, make_sender, workers=2, log_dir=tmp_path
+    )
+    attempts = {"broken 1": 0, "broken 2": 0}
+    for name, alert in multi_account.alerts.items():
+        alert.scheduler.active_interval = 0.01
+        alert.scheduler.idle_interval = 0.05
+        alert.scheduler.base_backoff = 0.01
+        alert.scheduler.max_backoff = 0.05
+        if name in attempts:
+
+            def fail(name=name):
+                attempts[name] += 1
+                raise ConnectionError("invalid_grant")
+
+            alert._open_gmail = fail
+    healthy = FakeGmail()
+    multi_account.alerts["healthy"].gmail = connect(healthy)
+    for i in range(5):
+        healthy.add_message(subject=f"Healthy {i}")
+
+    runner = threading.Thread(target=multi_account.run)
+    runner.start()
+    deadline = time.monotonic() + 10
+    while healthy.messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    multi_account.stop()
+    runner.join()
+
+    assert not healthy.messages
+    assert len(senders["+15555550100"].sent) == 5
+    for name, recipient in [("broken 1", "+15555550101"), ("broken 2", "+15555550102")]:
+        assert attempts[name] > 1
+        # One text for the failures in a row
+        assert len(senders[recipient].sent) == 1
+        assert "invalid_grant" in senders[recipient].sent[0][1]
@@ -0,0 +1,25 @@
+from imessage_email_alert.normalize_text import normalize_text
+
+
+def test_cleans_lines_and_drops_blank_ones():
+    text = "  Hello&nbsp;there \r\n\r\n\u200c\r\n  second&zwnj; line&#847;\n\n\n"
+    assert normalize_text(text) == ("Hellothere\n\nsecond line", False)
+
+
+def test_shortens_every_url_on_a_line():
+    text = (
+        "See https://example.com/a?utm_source=x&id=1 and "
+        "http://example.org/b/c?track=2, or https://example.net/plain"
+    )
+    assert normalize_text(text) == (
+        "See https://example.com/a and http://example.org/b/c or "
+        "https://example.net/plain",
+        False,
+    )
+
+
+def test_stops_at_the_limit():
+    text = "line\n" * 1000
+    assert normalize_text(text, limit=15) == ("line\n\nline\n\nlin", True)
+    # Exactly filling the limit is not cutting it
+    assert normalize_text("line\nline", limit=10) == ("line\n\nline", False)
@@ -0,0 +1,40 @@
+from imessage_email_alert.outbox import Outbox
+
+
+def test_states_survive_reopening(tmp_path):
+    outbox = Outbox(tmp_path / "outbox.sqlite3")
+    outbox.mark(["a", "b", "c"], Outbox.FETCHED)
+    outbox.mark(["a", "b"], Outbox.SENT)
+    outbox.mark(["a"], Outbox.DELETED)
+    outbox.close()
+
+    outbox = Outbox(tmp_path / "outbox.sqlite3")
+    assert outbox.state("a") == Outbox.DELETED
+    assert outbox.state("b") == Outbox.SENT
+    assert outbox.state("c") == Outbox.FETCHED
+    assert outbox.state("d") is None
+    assert outbox.sent(["a", "b", "c", "d"]) == {"a", "b"}
+    assert outbox.sent_not_deleted() == ["b"]
+
+
+def test_fetching_again_does_not_forget_sent(tmp_path):
+    outbox = Outbox(tmp_path / "outbox.sqlite3")
+    outbox.mark(["a"], Outbox.SENT)
+    outbox.mark(["a"], Outbox.FETCHED)
+    assert outbox.state("a") == Outbox.SENT
+
+
+def test_uses_wal_and_indexed_lookups(tmp_path):
+    outbox = Outbox(tmp_path / "outbox.sqlite3")
+    connection = outbox._connection
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    plan = connection.execute(
+        "EXPLAIN QUERY PLAN SELECT state FROM outbox WHERE message_id = ?", ("a",)
+    ).fetchall()
+    assert "USING PRIMARY KEY" in plan[0][-1]
+    plan = connection.execute(
+        "EXPLAIN QUERY PLAN SELECT message_id FROM outbox WHERE state = ?",
+        (Outbox.SENT,),
+    ).fetchall()
+    assert "INDEX outbox_state" in plan[0][-1]
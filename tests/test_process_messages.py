@@ -0,0 +1,323 @@
+import asyncio
+import pickle
+import threading
+import time
+
+import pytest
+
+from imessage_email_alert import AsyncPipeline
+from imessage_email_alert.digest import AlertCoalescer
+from imessage_email_alert.fake_gmail import FakeGmail
+from imessage_email_alert.get_email_message import EmailMessage
+from imessage_email_alert.outbox import Outbox
+from imessage_email_alert.stub_sender import StubImessage
+
+
+class RecordingSender:
+    def __init__(self, fail_on: str = None):
+        self.sent = []
+        self.fail_on = fail_on
+
+    def send_message(self, message: str):
+        if self.fail_on is not None and self.fail_on in message:
+            raise RuntimeError("send failed")
+        self.sent.append(message)
+
+
+@pytest.fixture
+def alert(fake_gmail, make_alert):
+    return make_alert(
+        fake_gmail,
+        drain_size=100,
+        poll_interval=0.01,
+        idle_interval=0.01,
+        sender=RecordingSender(),
+    )
+
+
+def test_drain_sends_and_deletes_backlog_in_batches(fake_gmail, alert):
+    for i in range(250):
+        fake_gmail.add_message(subject=f"Subject {i}")
+
+    assert alert._drain_messages() == (100, 0, 100)
+    assert alert._drain_messages() == (100, 0, 100)
+    assert alert._drain_messages() == (50, 0, 50)
+    assert alert._drain_messages() == (0, 0, 0)
+
+    assert len(alert.imessage.sent) == 250
+    assert not fake_gmail.messages
+    assert fake_gmail.calls["messages.batchDelete"] == 3
+    assert fake_gmail.calls["messages.delete"] == 0
+
+
+def test_drain_only_deletes_delivered_messages(fake_gmail, alert):
+    message_ids = [fake_gmail.add_message(subject=f"Subject {i}") for i in range(10)]
+    alert.imessage = RecordingSender(fail_on="Subject 3\n")
+
+    assert alert._drain_messages() == (10, 1, 9)
+
+    assert len(alert.imessage.sent) == 9
+    assert list(fake_gmail.messages) == [message_ids[3]]
+
+
+def test_async_pipeline_sends_and_deletes_everything(fake_gmail, alert):
+    for i in range(30):
+        fake_gmail.add_message(subject=f"Subject {i}")
+    pipeline = AsyncPipeline(
+        alert,
+        workers={"render": 2, "send": 3},
+        queue_size=2,
+        batch_size=5,
+    )
+    depths = []
+
+    async def run():
+        task = asyncio.create_task(pipeline.run_async())
+        while fake_gmail.messages:
+            depths.append(pipeline.queue_depths())
+            await asyncio.sleep(0.01)
+        pipeline.stop()
+        await task
+
+    asyncio.run(run())
+
+    assert sorted(alert.imessage.sent) == sorted(
+        f"To: me@example.com\nSubject: Subject {i}\n\nBody" for i in range(30)
+    )
+    assert set(depths[-1]) == {"render", "send", "delete"}
+    assert all(depth <= 2 for sample in depths for depth in sample.values())
+
+
+def test_async_pipeline_survives_failing_stages(fake_gmail, alert, monkeypatch):
+    for i in range(5):
+        fake_gmail.add_message(subject=f"Subject {i}")
+    pipeline = AsyncPipeline(alert, workers={"send": 1, "delete": 1}, batch_size=5)
+
+    def fail_delete(message_id):
+        raise RuntimeError("delete failed")
+
+    lane = alert._lane
+    failed = []
+
+    def fail_first_lane(route):
+        if not failed:
+            failed.append(route)
+            raise RuntimeError("lane failed")
+        return lane(route)
+
+    monkeypatch.setattr(alert.gmail, "delete_message", fail_delete)
+    monkeypatch.setattr(alert, "_lane", fail_first_lane)
+    # The text about the failed delete can't be sent either
+    alert.imessage = RecordingSender(fail_on="delete")
+
+    async def run():
+        task = asyncio.create_task(pipeline.run_async())
+        while len(set(alert.imessage.sent)) < 5:
+            await asyncio.sleep(0.01)
+        pipeline.stop()
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(run())
+
+    assert set(alert.imessage.sent) == {
+        f"To: me@example.com\nSubject: Subject {i}\n\nBody" for i in range(5)
+    }
+    assert alert.metrics.errors.value(("send",)) == 1
+    assert alert.metrics.errors.value(("delete",)) >= 5
+
+
+def test_async_pipeline_keeps_fetching_after_bookkeeping_errors(
+    fake_gmail, alert, monkeypatch
+):
+    for i in range(5):
+        fake_gmail.add_message(subject=f"Subject {i}")
+    pipeline = AsyncPipeline(alert, batch_size=5)
+    failures = {"_already_sent": 1, "_route": 2}
+
+    def fail_first(name):
+        function = getattr(alert, name)
+
+        def wrapper(*args):
+            if failures[name]:
+                failures[name] -= 1
+                raise RuntimeError(f"{name} failed")
+            return function(*args)
+
+        monkeypatch.setattr(alert, name, wrapper)
+
+    fail_first("_already_sent")
+    fail_first("_route")
+
+    async def run():
+        task = asyncio.create_task(pipeline.run_async())
+        while fake_gmail.messages:
+            await asyncio.sleep(0.01)
+        pipeline.stop()
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(run())
+
+    assert sorted(alert.imessage.sent) == sorted(
+        f"To: me@example.com\nSubject: Subject {i}\n\nBody" for i in range(5)
+    )
+    assert alert.metrics.errors.value(("gmail",)) == 3
+    assert not pipeline._in_flight
+
+
+def test_async_pipeline_stages_need_a_worker(alert):
+    with pytest.raises(ValueError, match="send"):
+        AsyncPipeline(alert, workers={"render": 2, "send": 0})
+    with pytest.raises(ValueError, match="fetsh"):
+        AsyncPipeline(alert, workers={"fetsh": 1})
+
+
+def test_outbox_prevents_resending_after_failed_delete(fake_gmail, alert, tmp_path):
+    alert.outbox = Outbox(tmp_path / "outbox.sqlite3")
+    for i in range(3):
+        fake_gmail.add_message(subject=f"Subject {i}")
+
+    real_delete_messages = alert.gmail.delete_messages
+    alert.gmail.delete_messages = lambda message_ids: 1 / 0
+    assert alert._drain_messages() == (3, 0, 3)
+    assert len(fake_gmail.messages) == 3
+
+    alert.gmail.delete_messages = real_delete_messages
+    assert alert._drain_messages() == (3, 0, 0)
+    alerts = [text for text in alert.imessage.sent if text.startswith("To:")]
+    assert len(alerts) == 3
+    assert not fake_gmail.messages
+    assert fake_gmail.calls["messages.get"] == 3
+
+
+def test_outbox_resumes_deletes_after_restart(fake_gmail, alert, tmp_path):
+    message_id = fake_gmail.add_message()
+    outbox = Outbox(tmp_path / "outbox.sqlite3")
+    outbox.mark([message_id], Outbox.SENT)
+    alert.outbox = outbox
+
+    alert._resume_outbox()
+
+    assert not fake_gmail.messages
+    assert outbox.state(message_id) == Outbox.DELETED
+    assert alert.imessage.sent == []
+
+
+def test_gmail_errors_back_off_instead_of_spinning(alert):
+    class BrokenGmail:
+        calls = 0
+
+        def list_message_ids(self, max_results: int = 100):
+            BrokenGmail.calls += 1
+            raise ConnectionError("no network")
+
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 8:
+            alert.stop()
+
+    alert.drain_size = None
+    alert.gmail = BrokenGmail()
+    alert._connect_gmail = lambda: None
+    alert.scheduler.sleep = sleep
+    alert.scheduler.base_backoff = 1
+    alert.scheduler.random_number = lambda: 1.0
+
+    alert.process_messages()
+
+    assert sleeps[:4] == [1, 2, 4, 8]
+    # After 5 failures the gmail circuit breaker opens for a minute
+    assert all(seconds >= 16 for seconds in sleeps[4:])
+    assert BrokenGmail.calls == alert.metrics.errors.value(("gmail",)) >= 5
+
+
+def test_digest_coalesces_a_burst_into_one_imessage(fake_gmail, alert):
+    alert.coalescer = AlertCoalescer(window=60, max_count=20)
+    alert.drain_size = 20
+    for i in range(5):
+        fake_gmail.add_message(subject=f"Subject {i}")
+
+    # Within the window, nothing is sent or deleted, and nothing is fetched twice
+    assert alert._drain_messages() == (5, 0, 0)
+    for i in range(5, 50):
+        fake_gmail.add_message(subject=f"Subject {i}")
+    # The newest are listed first, so the count is reached with the five waiting
+    assert alert._drain_messages() == (20, 0, 25)
+    assert fake_gmail.calls["messages.get"] == 25
+    assert len(alert.imessage.sent) == 1
+    assert alert.imessage.sent[0].startswith("25 new emails\n\nTo:")
+    assert len(fake_gmail.messages) == 25
+
+    assert alert._drain_messages() == (20, 0, 20)
+    assert alert._drain_messages() == (5, 0, 0)
+    alert.coalescer.window = 0
+    # The five listed were already waiting for the digest, so none are new
+    assert alert._drain_messages() == (0, 0, 5)
+    assert len(alert.imessage.sent) == 3
+    assert all(len(text) <= alert.digest_length for text in alert.imessage.sent)
+    assert not fake_gmail.messages
+
+
+def test_emails_waiting_for_the_digest_dont_keep_gmail_busy(fake_gmail, alert):
+    alert.coalescer = AlertCoalescer(window=60, max_count=20)
+    alert.drain_size = 5
+    for i in range(5):
+        fake_gmail.add_message(subject=f"Subject {i}")
+
+    alert.poll()
+    # A full batch was new, so there may be more right away
+    assert alert.scheduler.next_delay() == 0
+    alert.poll()
+    # All that is listed is waiting for the digest, so wait before listing again
+    assert alert.scheduler.next_delay() > 0
+    assert fake_gmail.calls["messages.list"] == 2
+
+
+def test_digest_of_one_email_is_a_normal_alert(fake_gmail, alert):
+    alert.coalescer = AlertCoalescer(window=0)
+    fake_gmail.add_message(subject="Only one")
+
+    assert alert._drain_messages() == (1, 0, 1)
+    assert alert.imessage.sent[0].startswith("To: ")
+
+
+def test_loop_delivers_everything_despite_gmail_errors(make_alert, tmp_path):
+    fake_gmail = FakeGmail(error_rate=0.2, seed=3)
+    sender = StubImessage()
+    alert = make_alert(
+        fake_gmail,
+        drain_size=10,
+        poll_interval=0.01,
+        idle_interval=0.01,
+        sender=sender,
+    )
+    alert.scheduler.base_backoff = 0.01
+    message_ids = fake_gmail.add_saved_messages(save_messages(tmp_path, 30))
+
+    loop = threading.Thread(target=alert.process_messages)
+    loop.start()
+    deadline = time.monotonic() + 30
+    while fake_gmail.messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    alert.stop()
+    loop.join()
+
+    assert len(message_ids) == 30
+    assert fake_gmail.calls["errors"] > 0
+    assert not fake_gmail.messages
+    subjects = {
+        text.split("\n")[1] for _, text in sender.sent if text.startswith("To:")
+    }
+    assert subjects == {f"Subject: Saved {i}" for i in range(30)}
+
+
+def save_messages(tmp_path, count: int):
+    directory = tmp_path / "saved"
+    directory.mkdir()
+    for i in range(count):
+        message = EmailMessage(
+            to_email="me@example.com", subject=f"Saved {i}", body="Hi"
+        )
+        (directory / f"{i:04d}").write_bytes(pickle.dumps(message))
+    return directory
@@ -0,0 +1,104 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+from google.oauth2.credentials import Credentials
+from googleapiclient.http import HttpMockSequence
+
+from imessage_email_alert.push import LocalSubscriber, PubSubSubscriber
+
+TOPIC = "projects/test/topics/gmail"
+
+
+@pytest.fixture
+def start_alert(make_alert):
+    def start_alert(fake_gmail, subscriber, **kwargs):
+        alert = make_alert(
+            fake_gmail,
+            gmail_options={"incremental": True},
+            poll_interval=0.05,
+            subscriber=subscriber,
+            watch_topic=TOPIC,
+            **kwargs,
+        )
+        loop = threading.Thread(target=alert.process_messages)
+        loop.start()
+        return alert, loop
+
+    return start_alert
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_notifications_trigger_a_poll_right_away(fake_gmail, start_alert):
+    subscriber = LocalSubscriber()
+    fake_gmail.add_topic(TOPIC, subscriber)
+    alert, loop = start_alert(fake_gmail, subscriber, safety_interval=60)
+    try:
+        assert wait_for(lambda: fake_gmail.watch is not None)
+        # Long enough for the poll loop to go idle
+        time.sleep(0.5)
+        polls = fake_gmail.calls["history.list"]
+
+        fake_gmail.add_message(subject="Pushed")
+        added = time.monotonic()
+        assert wait_for(lambda: alert.imessage.sent)
+        assert alert.imessage.sent[0][0] - added < 1
+    finally:
+        alert.stop()
+        loop.join()
+
+    assert fake_gmail.watch["labelIds"] == ["INBOX"]
+    assert subscriber.published == 1
+    # Only the pushed change was polled for while idle
+    assert fake_gmail.calls["history.list"] - polls < 10
+
+
+def test_safety_net_poll_finds_mail_without_notifications(fake_gmail, start_alert):
+    # The topic doesn't exist, so the watch keeps failing
+    alert, loop = start_alert(fake_gmail, LocalSubscriber(), safety_interval=0.2)
+    try:
+        fake_gmail.add_message(subject="Polled")
+        assert wait_for(lambda: alert.imessage.sent)
+    finally:
+        alert.stop()
+        loop.join()
+
+    assert fake_gmail.watch is None
+
+
+def test_pubsub_notifications_are_decoded_and_acknowledged():
+    notification = {"emailAddress": "me@example.com", "historyId": 1234}
+    data = base64.b64encode(json.dumps(notification).encode()).decode()
+    http = HttpMockSequence(
+        [
+            (
+                {"status": "200"},
+                json.dumps(
+                    {
+                        "receivedMessages": [
+                            {"ackId": "ack-1", "message": {"data": data}}
+                        ]
+                    }
+                ),
+            ),
+            ({"status": "200"}, "{}"),
+            ({"status": "200"}, "{}"),
+        ]
+    )
+    subscriber = PubSubSubscriber(
+        "projects/test/subscriptions/gmail",
+        credentials=Credentials(token="fake-token"),
+        transport_factory=lambda: http,
+    )
+
+    assert subscriber.pull(timeout=1) == [notification]
+    assert subscriber.pull(timeout=1) == []
+    assert len(http._iterable) == 0
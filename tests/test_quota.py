@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from imessage_email_alert.fake_gmail import FakeGmail
+from imessage_email_alert.quota import CLEANUP, FETCH, QuotaBudget, rate_limit_delay
+
+
+def test_spending_waits_for_the_window_to_slide():
+    budget = QuotaBudget(units_per_second=100, window=0.2)
+
+    budget.acquire(15)
+    assert budget.remaining() == 5
+    budget.acquire(10)
+
+    assert 0.15 < budget.waited < 0.5
+    assert budget.remaining() == 10
+
+
+def test_waiting_calls_are_served_by_priority():
+    budget = QuotaBudget(units_per_second=100, window=0.2)
+    budget.acquire(20)
+    order = []
+
+    def spend(name, priority):
+        budget.acquire(20, priority)
+        order.append(name)
+
+    cleanup = threading.Thread(target=spend, args=("delete", CLEANUP))
+    cleanup.start()
+    time.sleep(0.05)
+    fetch = threading.Thread(target=spend, args=("get", FETCH))
+    fetch.start()
+    cleanup.join()
+    fetch.join()
+
+    assert order == ["get", "delete"]
+
+
+def test_pause_holds_back_every_call():
+    budget = QuotaBudget(units_per_second=100)
+    budget.pause(0.2)
+
+    assert budget.remaining() == 0
+    budget.acquire(1)
+    assert budget.waited > 0.15
+
+
+def test_rate_limit_errors_are_recognized(connect):
+    fake_gmail = FakeGmail(quota_units=5, retry_after=3)
+    fake_gmail.add_message()
+    gmail = connect(fake_gmail)
+    gmail.list_message_ids()
+    try:
+        gmail.list_message_ids()
+    except Exception as error:
+        assert rate_limit_delay(error) == 3
+    else:
+        raise AssertionError("The second list should be rate limited")
+    assert rate_limit_delay(ValueError()) is None
+
+
+@pytest.fixture
+def drain(make_alert, connect, tmp_path):
+    def drain(fake_gmail, quota_units):
+        alert = make_alert(
+            fake_gmail,
+            drain_size=20,
+            # A delete that is rate limited is tried again, not the send
+            outbox=tmp_path / "outbox.sqlite",
+            quota_units=quota_units,
+        )
+        alert.gmail = connect(fake_gmail, metrics=alert.metrics, quota=alert.quota)
+        deadline = time.monotonic() + 30
+        while fake_gmail.messages and time.monotonic() < deadline:
+            delay = alert.poll()
+            if delay:
+                time.sleep(delay)
+        return alert
+
+    return drain
+
+
+def test_sustained_load_stays_under_the_limit(drain):
+    # 60 gets, 4 lists and 3 deletes are 470 units, about two seconds of quota.
+    # The budget keeps a margin, as the requests reach gmail a little after
+    # they are counted.
+    fake_gmail = FakeGmail(quota_units=250)
+    for i in range(60):
+        fake_gmail.add_message(subject=f"Message {i}")
+
+    alert = drain(fake_gmail, quota_units=225)
+
+    assert not fake_gmail.messages
+    assert len(alert.imessage.sent) == 60
+    assert fake_gmail.calls["rateLimitExceeded"] == 0
+    assert alert.quota.waited > 0.5
+    assert "imessage_email_alert_quota_remaining_units" in (
+        alert.metrics.registry.render()
+    )
+
+
+def test_rate_limits_are_waited_out_without_a_budget(drain):
+    fake_gmail = FakeGmail(quota_units=250, retry_after=0.2)
+    for i in range(60):
+        fake_gmail.add_message(subject=f"Message {i}")
+
+    alert = drain(fake_gmail, quota_units=None)
+
+    assert not fake_gmail.messages
+    assert len(alert.imessage.sent) == 60
+    assert fake_gmail.calls["rateLimitExceeded"] > 0
+    # Being told to slow down doesn't count as gmail failing
+    assert alert.scheduler.breakers["gmail"].allow()
+    assert alert.metrics.errors.value(("quota",)) > 0
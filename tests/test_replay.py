@@ -0,0 +1,102 @@
+import pickle
+from functools import partial
+
+from imessage_email_alert.archive import MessageArchive
+from imessage_email_alert.get_email_message import EmailMessage
+from imessage_email_alert.imessage_email_alert import render_message
+from imessage_email_alert.replay import DryRunSender, replay_messages
+
+
+class RecordingSender:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, message: str):
+        self.sent.append(message)
+
+
+def save_messages(directory, count: int):
+    directory.mkdir()
+    for i in range(count):
+        message = EmailMessage(
+            to_email="me@example.com", subject=f"Saved {i}", body="word " * 1000
+        )
+        (directory / f"{i:04d}").write_bytes(pickle.dumps(message))
+
+
+def test_replay_renders_every_message_on_a_pool(tmp_path):
+    save_messages(tmp_path / "saved", 25)
+    (tmp_path / "saved" / "broken").write_bytes(b"not a pickle")
+    (tmp_path / "saved" / "directory").mkdir()
+    sender = RecordingSender()
+    lines = []
+
+    summary = replay_messages(
+        tmp_path / "saved",
+        partial(render_message, message_length=100),
+        sender,
+        processes=2,
+        output=lines.append,
+    )
+
+    assert summary["messages"] == 25
+    assert summary["errors"] == 1
+    assert all(len(summary["timings"][stage]) == 25 for stage in summary["timings"])
+    assert sorted(text.split("\n")[1] for text in sender.sent) == sorted(
+        f"Subject: Saved {i}" for i in range(25)
+    )
+    assert all(text.endswith("........") for text in sender.sent)
+
+    assert any(line.startswith("broken: UnpicklingError") for line in lines)
+    assert sum("load" in line and "send" in line for line in lines) == 25
+    assert lines[-4].startswith("Replayed 25 messages with 1 errors")
+    assert [line.split(":")[0].strip() for line in lines[-3:]] == [
+        "load",
+        "render",
+        "send",
+    ]
+
+
+def test_dry_run_sends_nothing(tmp_path):
+    save_messages(tmp_path / "saved", 3)
+    sender = DryRunSender()
+
+    replay_messages(
+        tmp_path / "saved",
+        partial(render_message, message_length=100),
+        sender,
+        processes=1,
+        output=lambda line: None,
+    )
+
+    assert sender.sends == 3
+
+
+def test_replay_a_time_range_of_an_archive(tmp_path):
+    archive = MessageArchive(tmp_path / "archive", segment_size=2000)
+    for i in range(40):
+        archive.append(
+            EmailMessage(
+                message_id=f"id{i}", subject=f"Archived {i}", body="word " * 100
+            ),
+            timestamp=1000 + i,
+        )
+    archive.close()
+    sender = RecordingSender()
+    lines = []
+
+    summary = replay_messages(
+        tmp_path / "archive",
+        partial(render_message, message_length=100),
+        sender,
+        processes=2,
+        output=lines.append,
+        start=1010,
+        end=1030,
+    )
+
+    assert summary["messages"] == 20
+    assert [text.split("\n")[1] for text in sender.sent] == [
+        f"Subject: Archived {i}" for i in range(10, 30)
+    ]
+    assert lines[0].startswith("id10: load")
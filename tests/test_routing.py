@@ -0,0 +1,204 @@
+import random
+
+import pytest
+
+from imessage_email_alert.get_email_message import EmailMessage
+from imessage_email_alert.routing import Rule, RuleSet, _Matcher
+from imessage_email_alert.stub_sender import StubImessage
+
+
+def message(from_email="someone@example.com", subject="Hello", body="Hi"):
+    return EmailMessage(
+        from_email=from_email, to_email="me@example.com", subject=subject, body=body
+    )
+
+
+def test_matcher_finds_the_same_patterns_as_a_naive_search():
+    generator = random.Random(1)
+    patterns = {
+        "".join(generator.choice("abc") for _ in range(generator.randint(1, 4))): {n}
+        for n in range(50)
+    }
+    matcher = _Matcher(patterns)
+
+    for _ in range(200):
+        text = "".join(generator.choice("abcd") for _ in range(30))
+        expected = set()
+        for pattern, rules in patterns.items():
+            if pattern in text:
+                expected |= rules
+        assert matcher.search(text) == expected
+
+
+def test_highest_priority_wins_and_the_first_rule_breaks_ties():
+    rules = RuleSet(
+        [
+            Rule("low", senders=["bank.example.com"], recipient="a", priority=1),
+            Rule("first", subjects=["fraud"], recipient="b", priority=5),
+            Rule("second", keywords=["fraud"], recipient="c", priority=5),
+        ]
+    )
+
+    route = rules.route(
+        message("alerts@bank.example.com", "Possible FRAUD", "fraud alert")
+    )
+    assert (route.rule, route.recipient, route.priority) == ("first", "b", 5)
+
+    route = rules.route(message("alerts@bank.example.com", "Statement"))
+    assert (route.rule, route.recipient) == ("low", "a")
+
+
+def test_every_condition_of_a_rule_has_to_match():
+    rules = RuleSet(
+        [Rule("both", senders=["@bank.example.com"], subjects=["statement"])]
+    )
+
+    assert rules.route(message("x@bank.example.com", "Your Statement")).rule == "both"
+    assert rules.route(message("x@bank.example.com", "Hello")).rule is None
+    assert rules.route(message("x@shop.example.com", "Statement")).rule is None
+
+
+def test_drop_rules_and_unmatched_mail():
+    rules = RuleSet([Rule("news", subjects=["newsletter"], drop=True)])
+    assert rules.route(message(subject="Weekly newsletter")).drop
+    assert not rules.route(message(subject="Lunch?")).drop
+
+    rules = RuleSet([Rule("boss", senders=["boss@"])], unmatched="drop")
+    assert not rules.route(message("boss@example.com")).drop
+    assert rules.route(message("other@example.com")).drop
+
+
+def test_labels_match_whole_label_ids():
+    rules = RuleSet([Rule("starred", labels=["STARRED"], senders=["bank"])])
+    starred = message("alerts@bank.example.com")
+    starred.label_ids = ["INBOX", "STARRED"]
+    unstarred = message("alerts@bank.example.com")
+    unstarred.label_ids = ["INBOX", "STARRED_BY_FILTER"]
+
+    assert rules.route(starred).rule == "starred"
+    assert rules.route(unstarred).rule is None
+    assert rules.route(message("alerts@bank.example.com")).rule is None
+
+
+def test_mail_with_missing_headers_is_routed():
+    rules = RuleSet(
+        [
+            Rule("bank", senders=["bank.example.com"], subjects=["deposit"]),
+            Rule("lunch", keywords=["lunch"]),
+        ]
+    )
+    headless = EmailMessage(from_email=None, subject=None, body=None)
+
+    assert rules.route(headless).rule is None
+    assert not rules.route(headless).drop
+    assert rules.route(message(subject=None, body="Lunch?")).rule == "lunch"
+
+
+def test_keywords_are_only_searched_for_in_the_start_of_the_body():
+    rules = RuleSet([Rule("late", keywords=["needle"])])
+    body = "x" * RuleSet.BODY_SCAN_LIMIT + "needle"
+
+    assert rules.route(message(body=body)).rule is None
+
+
+def test_gmail_query_is_only_pushed_down_when_unmatched_mail_is_dropped():
+    rules = [
+        Rule("bank", senders=["alerts@bank.example.com", "bank.example.org"]),
+        Rule("ops", query="subject:outage", priority=10),
+        Rule("news", subjects=["newsletter"], drop=True),
+    ]
+
+    assert RuleSet(rules).gmail_query() is None
+    assert RuleSet(rules, unmatched="drop").gmail_query() == (
+        "(from:(alerts@bank.example.com OR bank.example.org)) OR (subject:outage)"
+    )
+    # A rule gmail can't narrow down means everything has to be listed
+    unpushable = rules + [Rule("lunch", subjects=["lunch"])]
+    assert RuleSet(unpushable, unmatched="drop").gmail_query() is None
+
+
+def test_rules_from_file(tmp_path):
+    rules_file = tmp_path / "rules.toml"
+    rules_file.write_text("""
+unmatched = "drop"
+label_ids = ["INBOX"]
+
+[[rules]]
+name = "bank"
+senders = ["alerts@bank.example.com"]
+recipient = "+15555550101"
+priority = 10
+
+[[rules]]
+subjects = ["newsletter"]
+drop = true
+""")
+
+    rules = RuleSet.from_file(rules_file)
+
+    assert rules.unmatched == "drop"
+    assert rules.label_ids == ["INBOX"]
+    assert [rule.name for rule in rules.rules] == ["bank", "rule 2"]
+    assert rules.rules[0].priority == 10
+
+    rules_file.write_text('[[rules]]\nname = "typo"\nsendres = ["a"]\n')
+    with pytest.raises(ValueError, match="typo"):
+        RuleSet.from_file(rules_file)
+
+
+def test_alert_lists_only_routed_mail_and_sends_it_to_its_recipient(
+    fake_gmail, make_alert
+):
+    rules = RuleSet(
+        [
+            Rule("bank", senders=["alerts@bank.example.com"], recipient="+1555010"),
+            Rule("ops", query="subject:outage", subjects=["outage"], priority=10),
+        ],
+        unmatched="drop",
+    )
+    senders = {}
+
+    def make_sender(recipient):
+        return senders.setdefault(recipient, StubImessage())
+
+    alert = make_alert(
+        fake_gmail,
+        gmail_options={"query": rules.gmail_query()},
+        drain_size=100,
+        sender=make_sender("+15555550100"),
+        rules=rules,
+        make_sender=make_sender,
+    )
+    fake_gmail.add_message(from_email="alerts@bank.example.com", subject="Deposit")
+    fake_gmail.add_message(from_email="pager@example.com", subject="Outage in db")
+    unrouted = fake_gmail.add_message(from_email="shop@example.com", subject="Sale")
+
+    assert alert._drain_messages() == (2, 0, 2)
+
+    assert ["Deposit" in text for _, text in senders["+1555010"].sent] == [True]
+    assert ["Outage" in text for _, text in senders["+15555550100"].sent] == [True]
+    # Gmail never listed the mail no rule sends, so it is left alone
+    assert list(fake_gmail.messages) == [unrouted]
+
+
+def test_urgent_mail_is_sent_without_waiting_for_the_digest(fake_gmail, make_alert):
+    rules = RuleSet(
+        [
+            Rule("pager", senders=["pager@example.com"], priority=10),
+            Rule("starred", labels=["STARRED"], priority=10),
+            Rule("bank", senders=["bank.example.com"], priority=5),
+        ]
+    )
+    alert = make_alert(fake_gmail, digest_window=60, rules=rules, urgent_priority=10)
+    newsletters = [fake_gmail.add_message(subject=f"News {i}") for i in range(3)]
+    bank = fake_gmail.add_message(from_email="alerts@bank.example.com")
+    fake_gmail.add_message(from_email="pager@example.com", subject="Outage")
+    fake_gmail.add_message(subject="Starred", label_ids=["INBOX", "STARRED"])
+
+    assert alert._drain_messages() == (6, 0, 2)
+
+    sent = [text for _, text in alert.imessage.sent]
+    assert ["Outage" in text or "Starred" in text for text in sent] == [True, True]
+    assert len(alert.coalescer) == 4
+    assert sorted(fake_gmail.messages) == sorted(newsletters + [bank])
+    assert alert.metrics.lane_delivery_seconds.count(("urgent",)) == 2
@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+from imessage_email_alert.scheduler import CircuitBreaker, PollScheduler, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def scheduler(clock):
+    return PollScheduler(
+        active_interval=2,
+        idle_interval=30,
+        base_backoff=1,
+        max_backoff=600,
+        clock=clock,
+        sleep=clock.sleep,
+        random_number=lambda: 1.0,
+    )
+
+
+def test_interval_grows_while_idle_and_resets_on_mail(scheduler):
+    delays = []
+    for found in [1, 0, 0, 0, 0, 0, 0, 1]:
+        scheduler.record_poll(found)
+        delays.append(scheduler.next_delay())
+    assert delays == [2, 4, 8, 16, 30, 30, 30, 2]
+
+
+def test_idle_interval_grows_from_a_zero_active_interval(clock):
+    scheduler = PollScheduler(active_interval=0, idle_interval=30, clock=clock)
+    delays = []
+    for found in [1, 0, 0, 0]:
+        scheduler.record_poll(found)
+        delays.append(scheduler.next_delay())
+    assert delays == [0, 0.5, 1, 2]
+
+
+def test_no_delay_while_backlog_remains(scheduler):
+    scheduler.record_poll(100, more=True)
+    assert scheduler.next_delay() == 0
+
+
+def test_errors_back_off_exponentially_with_jitter(clock, scheduler):
+    delays = []
+    for _ in range(12):
+        scheduler.record_error()
+        delays.append(scheduler.next_delay())
+    assert delays == [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 600, 600]
+
+    scheduler.random_number = lambda: 0.0
+    assert scheduler.next_delay() == 300
+
+    scheduler.record_poll(0)
+    assert scheduler.next_delay() == 4
+
+
+def test_circuit_breaker_opens_and_half_opens(clock):
+    breaker = CircuitBreaker(
+        "gmail", failure_threshold=3, reset_timeout=60, clock=clock
+    )
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_in() == 60
+
+    clock.now += 60
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+    # One failure while half open opens it again
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now += 60
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_breaker_delays_polling(clock, scheduler):
+    for _ in range(3):
+        scheduler.breakers["sender"].record_failure()
+    scheduler.record_poll(1)
+    assert scheduler.next_delay() == 600
+
+    assert scheduler.wait() == 600
+    assert clock.sleeps == [600]
+    assert scheduler.breakers["sender"].allow()
+
+
+def test_wake_cuts_the_wait_short():
+    scheduler = PollScheduler(active_interval=30, idle_interval=30)
+    threading.Timer(0.1, scheduler.wake).start()
+
+    started = time.monotonic()
+    scheduler.wait()
+    assert time.monotonic() - started < 5
+
+
+def test_token_bucket_allows_bursts_then_the_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3, clock=clock, sleep=clock.sleep)
+
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_acquire() == 0.5
+    assert bucket.acquire() == 0.5
+    clock.now += 10
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, 0.5]
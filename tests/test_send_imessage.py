@@ -0,0 +1,150 @@
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+from imessage_email_alert.send_imessage import PersistentSender, SendError, SendStats
+
+STUB = [sys.executable, "-m", "imessage_email_alert.stub_sender"]
+
+
+@pytest.fixture
+def output(tmp_path):
+    return tmp_path / "sent.jsonl"
+
+
+def sent_messages(output) -> list:
+    return [json.loads(line)["message"] for line in output.read_text().splitlines()]
+
+
+def test_one_helper_sends_every_message(output):
+    sender = PersistentSender(
+        "+15555550100", command=STUB + ["--output", str(output)], rate=1000
+    )
+    messages = [f"Message {i}\nwith ünïcode" for i in range(50)]
+    for message in messages:
+        sender.send_message(message)
+    helper = sender._helper
+    sender.close()
+
+    assert sent_messages(output) == messages
+    assert helper.returncode == 0
+    summary = sender.stats.summary()
+    assert summary["sends"] == 50
+    assert 0 < summary["p50"] <= summary["p99"]
+
+
+def test_failed_send_raises_and_keeps_the_helper(output):
+    sender = PersistentSender(
+        "+15555550100",
+        command=STUB + ["--output", str(output), "--fail-on", "bad"],
+        rate=1000,
+    )
+    sender.send_message("good 1")
+    helper = sender._helper
+    with pytest.raises(SendError, match="not sending 'bad'"):
+        sender.send_message("bad")
+    sender.send_message("good 2")
+    assert sender._helper is helper
+    sender.close()
+
+    assert sent_messages(output) == ["good 1", "good 2"]
+    assert sender.stats.failures == 1
+
+
+def test_hung_send_times_out_and_restarts_the_helper(output):
+    sender = PersistentSender(
+        "+15555550100",
+        command=STUB + ["--output", str(output), "--hang-on", "hang"],
+        timeout=2,
+        rate=1000,
+    )
+    started = time.monotonic()
+    with pytest.raises(SendError, match="more than 2 seconds"):
+        sender.send_message("hang")
+    assert time.monotonic() - started < 10
+
+    sender.send_message("after")
+    sender.close()
+    assert sent_messages(output) == ["after"]
+
+
+def test_rate_limited_sends_from_several_threads(output):
+    sender = PersistentSender(
+        "+15555550100",
+        command=STUB + ["--output", str(output)],
+        rate=20,
+        burst=5,
+    )
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=sender.send_message, args=(f"Message {i}",))
+        for i in range(15)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    sender.close()
+
+    assert sorted(sent_messages(output)) == sorted(f"Message {i}" for i in range(15))
+    # Five right away, then ten more at 20 per second
+    assert elapsed >= 0.45
+
+
+def test_stats_percentiles():
+    stats = SendStats()
+    for i in range(1, 101):
+        stats.record(i / 1000)
+
+    assert stats.percentile(50) == 0.051
+    assert stats.percentile(99) == 0.1
+
+
+def test_urgent_messages_skip_the_queue_and_the_rate_limit(output):
+    sender = PersistentSender(
+        "+15555550100", command=STUB + ["--output", str(output)], rate=2, burst=1
+    )
+    threads = [
+        threading.Thread(target=sender.send_message, args=(f"Message {i}",))
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    # The first message is sent, the others wait for the rate limiter
+    time.sleep(0.3)
+    started = time.monotonic()
+    sender.send_urgent("Urgent")
+    elapsed = time.monotonic() - started
+    for thread in threads:
+        thread.join()
+    sender.close()
+
+    assert elapsed < 0.4
+    sent = sent_messages(output)
+    assert sent.index("Urgent") == 1
+    assert len(sent) == 5
+
+
+def test_an_unexpected_worker_error_fails_the_send_instead_of_hanging(output):
+    sender = PersistentSender(
+        "+15555550100", command=STUB + ["--output", str(output)], rate=1000
+    )
+    try_acquire = sender.rate_limiter.try_acquire
+    failures = [RuntimeError("clock went backwards")]
+
+    def broken_try_acquire():
+        if failures:
+            raise failures.pop()
+        return try_acquire()
+
+    sender.rate_limiter.try_acquire = broken_try_acquire
+    with pytest.raises(SendError, match="clock went backwards"):
+        sender.send_message("lost")
+    sender.send_message("sent")
+    sender.close()
+
+    assert sent_messages(output) == ["sent"]